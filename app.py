@@ -1,27 +1,130 @@
-from timekpr_service.service import App
-from timekpr_service import queries
 import os
+if os.environ.get("WORKER_CLASS") == "gevent":
+    # The application is built in the gunicorn master, before gunicorn
+    # patches its workers: patch before anything imports threading,
+    # socket or select
+    from gevent import monkey
+    monkey.patch_all()
+
+from timekpr_service.service import App
+from timekpr_service import queries, tracing
+from timekpr_service.auth import CredentialCache
+from timekpr_service.cache import CachedQ
+from timekpr_service.fleet import Fleet, FleetApp
+from timekpr_service.offload import OffloadedQ
+from timekpr_service.profiling import Profiler
+from timekpr_service.sqlitequeries import SQLiteQ
+from multiprocessing import cpu_count
 from logging import basicConfig, DEBUG, INFO
 
-if __name__ == '__main__':
-    app = App()
 
+def create_app():
     os.environ.setdefault("ADMIN_USERS", "")
     os.environ.setdefault("PORT", "5000")
     os.environ.setdefault("HOST", "127.0.0.1")
     os.environ.setdefault("DEBUG", "false")
+    os.environ.setdefault("PROFILE", "false")
+    os.environ.setdefault("PROFILE_DIR", "/var/tmp/timekpr-service-profiles")
+    os.environ.setdefault("PROFILE_SLOW_MS", "1000")
+    os.environ.setdefault("PROFILE_SAMPLE_RATE", "0")
+    os.environ.setdefault("PROFILER", "cprofile")
+    os.environ.setdefault("TRACE_FILE", "")
+    os.environ.setdefault("Q_BACKEND", "files")
+    os.environ.setdefault("SQLITE_PATH", "/var/lib/timekpr-service/state.db")
+    os.environ.setdefault("CACHE_SIZE", "0")
+    os.environ.setdefault("CACHE_TTL", "1")
+    os.environ.setdefault("AUTH_CACHE_TTL", "60")
+    os.environ.setdefault("AUTH_CACHE_SIZE", "256")
+    os.environ.setdefault("WORKER_CLASS", "gthread")
+    os.environ.setdefault("QUERY_THREADS", "8")
+    os.environ.setdefault("MAX_PENDING_QUERIES", "64")
+    os.environ.setdefault("FLEET_HOSTS", "")
+    os.environ.setdefault("FLEET_TIMEOUT", "5")
+
+    if os.environ['FLEET_HOSTS']:
+        # Aggregator of the instances of other machines
+        app = FleetApp(Fleet(
+            os.environ['FLEET_HOSTS'].split(),
+            timeout=float(os.environ['FLEET_TIMEOUT'])
+        ))
+    else:
+        app = App()
 
     # parse out the granted users
-    app.config["ADMIN_USERS"] = os.environ['ADMIN_USERS'].split(":")
+    app.config["ADMIN_USERS"] = [
+        u for u in os.environ['ADMIN_USERS'].split(":") if u
+    ]
+    app.config['AUTH'] = CredentialCache(
+        ttl=float(os.environ['AUTH_CACHE_TTL']),
+        size=int(os.environ['AUTH_CACHE_SIZE'])
+    )
     app.config['q'] = queries
+    if os.environ['Q_BACKEND'] == 'sqlite':
+        app.config['q'] = SQLiteQ(os.environ['SQLITE_PATH'], follow=True)
+        if app.config['q'].is_empty():
+            app.config['q'].import_work_dir()
+    if os.environ['WORKER_CLASS'] == 'gevent':
+        # Blocking queries must not stall the greenlets of the worker
+        app.config['q'] = OffloadedQ(
+            app.config['q'],
+            threads=int(os.environ['QUERY_THREADS']),
+            max_pending=int(os.environ['MAX_PENDING_QUERIES'])
+        )
+    if int(os.environ['CACHE_SIZE']) > 0:
+        app.config['q'] = CachedQ(
+            app.config['q'],
+            size=int(os.environ['CACHE_SIZE']),
+            ttl=float(os.environ['CACHE_TTL'])
+        )
     app.config['DEBUG'] = os.environ['DEBUG'] == 'true'
 
+    if os.environ['TRACE_FILE']:
+        tracing.configure(os.environ['TRACE_FILE'])
+
+    # Profiling is always available to admins (X-Profile: 1)
+    app.wsgi_app = Profiler(
+        app.wsgi_app,
+        os.environ['PROFILE_DIR'],
+        always=os.environ['PROFILE'] == 'true',
+        admins=app.config["ADMIN_USERS"],
+        slow_ms=float(os.environ['PROFILE_SLOW_MS']),
+        sample_rate=float(os.environ['PROFILE_SAMPLE_RATE']),
+        profiler=os.environ['PROFILER'],
+        check=app.config['AUTH'].check
+    )
+
     if app.config['DEBUG']:
         basicConfig(level=DEBUG)
     else:
         basicConfig(level=INFO)
 
-    app.run(
-        host=os.environ['HOST'],
-        port=int(os.environ['PORT'])
-    )
+    return app
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    if app.config['DEBUG']:
+        # Development server
+        app.run(
+            host=os.environ['HOST'],
+            port=int(os.environ['PORT']),
+            # Event streams hold their connection open
+            threaded=True
+        )
+    else:
+        from timekpr_service.server import serve
+
+        os.environ.setdefault("WORKERS", str(cpu_count() * 2 + 1))
+        os.environ.setdefault("THREADS", "8")
+        os.environ.setdefault("MAX_CONNECTIONS", "1000")
+
+        serve(
+            app,
+            host=os.environ['HOST'],
+            port=int(os.environ['PORT']),
+            workers=int(os.environ['WORKERS']),
+            threads=int(os.environ['THREADS']),
+            worker_class=os.environ['WORKER_CLASS'],
+            connections=int(os.environ['MAX_CONNECTIONS'])
+        )
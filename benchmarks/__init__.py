@@ -0,0 +1 @@
+""" Benchmarks for timekpr-service, see the Makefile bench targets """
@@ -0,0 +1,58 @@
+""" Size and CPU cost of the encodings of the index of a synthetic host.
+
+    python -m benchmarks.encoding [--users 5000] [--requests 20]
+
+    Each media type (Accept) and content coding (Accept-Encoding) that is
+    available is requested for GET / and GET /timestatus through the WSGI
+    application; the table gives the body size and the CPU time of a
+    request.
+"""
+
+import argparse
+import sys
+import time
+
+from timekpr_service import encoding, queries
+from timekpr_service.service import App
+
+from benchmarks import synthetic
+
+PATHS = ("/", "/timestatus")
+
+
+def run(users, requests):
+    """ Returns [(path, media type, coding, bytes, CPU ms per request)] """
+    rows = []
+    with synthetic.host(users):
+        app = App()
+        app.config['q'] = queries
+        client = app.test_client()
+        for path in PATHS:
+            for mimetype in encoding.MEDIA_TYPES:
+                for coding in ("identity",) + encoding.CODINGS:
+                    headers = {"Accept": mimetype, "Accept-Encoding": coding}
+                    client.get(path, headers=headers).data  # warm up
+                    start = time.clock()
+                    for _ in range(requests):
+                        r = client.get(path, headers=headers)
+                        size = len(r.data)
+                    cpu = (time.clock() - start) / requests
+                    rows.append((path, mimetype, coding, size, cpu * 1000))
+    return rows
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=20,
+                        help="requests per encoding")
+    args = parser.parse_args(argv[1:])
+
+    print("%-12s %-20s %-9s %10s %8s" % ("path", "media type", "coding", "bytes", "CPU ms"))
+    for row in run(args.users, args.requests):
+        print("%-12s %-20s %-9s %10d %8.1f" % row)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
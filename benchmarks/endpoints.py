@@ -0,0 +1,124 @@
+""" Latency and throughput of the service endpoints on synthetic hosts.
+
+    python -m benchmarks.endpoints [--users 10,1000,10000] [--requests 200]
+                                   [--save] [--compare FILE] [--threshold PCT]
+
+    Requests go through the WSGI application (Flask's test client), so the
+    numbers measure the service and timekpr files, not the network.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+
+from timekpr_service import queries
+from timekpr_service.cache import CachedQ
+from timekpr_service.sqlitequeries import SQLiteQ
+from timekpr_service.service import App, _mock_admin
+
+from benchmarks import harness, synthetic
+
+SUITE = "endpoints"
+
+
+def cases(client, names, headers):
+    """ Returns [(name, fn)], fn makes one request of the case """
+    users = itertools.cycle(names)
+    batch = itertools.cycle(names)
+
+    def get(url):
+        def fn():
+            r = client.get(url() if callable(url) else url)
+            assert r.status_code == 200, (url, r.status_code)
+            r.data  # consume streamed bodies
+        return fn
+
+    def put(url, body):
+        def fn():
+            r = client.put(url(), data=json.dumps(body()), headers=headers)
+            assert r.status_code in (200, 204), r.status_code
+        return fn
+
+    return [
+        ("GET /", get("/")),
+        ("GET /?limit=100", get("/?limit=100")),
+        ("GET /timestatus", get("/timestatus")),
+        ("GET /user/<username>",
+            get(lambda: "/user/" + next(users))),
+        ("GET /user/<username>/timestatus",
+            get(lambda: "/user/" + next(users) + "/timestatus")),
+        ("PUT /user/<username>/timestatus",
+            put(lambda: "/user/" + next(users) + "/timestatus",
+                lambda: {"time": 60, "locked": False})),
+        ("PUT /timestatus (10 users)",
+            put(lambda: "/timestatus",
+                lambda: [{"username": u, "time": 120, "locked": False}
+                         for u in itertools.islice(batch, 10)])),
+    ]
+
+
+def run(users, requests, max_seconds, cache_size=0, backend="files"):
+    results = {}
+    with synthetic.host(users) as root:
+        app = App()
+        app.config['q'] = queries
+        if backend == "sqlite":
+            app.config['q'] = SQLiteQ(os.path.join(root, "state.db"))
+            app.config['q'].import_work_dir()
+        if cache_size:
+            app.config['q'] = CachedQ(app.config['q'], size=cache_size)
+        # Credentials are checked through the cache, PAM is left out
+        admin = _mock_admin(app)
+        client = app.test_client()
+        names = [synthetic.username(i) for i in range(users)]
+        for name, fn in cases(client, names, admin):
+            results["%s N=%d" % (name, users)] = harness.measure(fn, requests, max_seconds)
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", default="10,1000,10000",
+                        help="comma separated host sizes")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per case")
+    parser.add_argument("--max-seconds", type=float, default=5.0,
+                        help="time budget per case")
+    parser.add_argument("--backend", choices=("files", "sqlite"), default="files",
+                        help="the Q backend")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="put a CachedQ of this size in front of the queries")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results in " + harness.path(SUITE))
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare to stored results")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="fail when a metric regresses by more than this %%")
+    args = parser.parse_args(argv[1:])
+
+    results = {}
+    refs = [harness.reference()]
+    for users in [int(n) for n in args.users.split(",")]:
+        results.update(run(users, args.requests, args.max_seconds,
+                           args.cache_size, args.backend))
+        refs.append(harness.reference())
+    ref = sum(refs) / len(refs)
+    harness.report(results)
+
+    status = 0
+    if args.compare:
+        (baseline, baseline_ref) = harness.load(args.compare)
+        speed = baseline_ref / ref if baseline_ref else 1.0
+        print("machine speed relative to the baseline: %.2f" % speed)
+        rows = harness.compare(baseline, results, args.threshold, speed=speed)
+        harness.report_comparison(rows)
+        status = int(any(row[-1] for row in rows))
+    if args.save:
+        print("saved " + harness.save(SUITE, results, ref))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
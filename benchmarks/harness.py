@@ -0,0 +1,199 @@
+""" Measurements and stored results shared by the benchmarks.
+
+    A result is a dict of metrics for one case: count, p50 and p99 (in
+    milliseconds) and rate (operations per second). Results are stored as
+    JSON in benchmarks/results/<suite>.json, so that a later run can be
+    compared to them.
+
+    Shared and virtual machines change speed over time. Each run also
+    times a fixed reference workload, and comparisons scale the results by
+    how much faster or slower the machine ran it than for the baseline.
+"""
+
+import json
+import os
+import platform
+import sys
+import time
+from timeit import default_timer
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Metrics where lower is better, the others are better higher
+LOWER_IS_BETTER = ("p50", "p99")
+
+
+def measure(fn, count, max_seconds=None, warmup=1, min_sample=None):
+    """ Calls fn() up to count times (or for about max_seconds) and
+        returns its latency percentiles and rate.
+
+        Operations much faster than the timer resolution can be timed in
+        loops of at least min_sample seconds, the latencies are then those
+        of the average call of each loop.
+
+        >>> r = measure(lambda: None, 10)
+        >>> r["count"], sorted(r)
+        (10, ['count', 'p50', 'p99', 'rate'])
+        >>> measure(lambda: None, 10, min_sample=0.001)["count"] > 10
+        True
+    """
+    for _ in range(warmup):
+        fn()
+    loops = calibrate(fn, min_sample) if min_sample else 1
+    latencies = []
+    start = default_timer()
+    for _ in range(count):
+        t = default_timer()
+        for _ in range(loops):
+            fn()
+        latencies.append((default_timer() - t) / loops)
+        if max_seconds is not None and default_timer() - start > max_seconds:
+            break
+    elapsed = default_timer() - start
+    latencies.sort()
+    return {
+        "count": len(latencies) * loops,
+        "p50": percentile(latencies, 50) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "rate": len(latencies) * loops / elapsed if elapsed else float("inf"),
+    }
+
+
+def calibrate(fn, min_sample):
+    """ Returns how many calls of fn take at least min_sample seconds """
+    loops = 1
+    while True:
+        t = default_timer()
+        for _ in range(loops):
+            fn()
+        if default_timer() - t >= min_sample:
+            return loops
+        loops *= 2
+
+
+def reference(repeat=5):
+    """ The best time, in seconds, of a fixed pure Python workload """
+    def workload():
+        d = {}
+        for i in range(20000):
+            d["key%d" % i] = i * i
+        return sorted(d.items())[-1]
+    times = []
+    for _ in range(repeat):
+        t = default_timer()
+        workload()
+        times.append(default_timer() - t)
+    return min(times)
+
+
+def percentile(values, p):
+    """ The p-th percentile of sorted values (nearest rank)
+
+        >>> percentile(range(1, 101), 99), percentile([3], 50)
+        (99, 3)
+    """
+    rank = max(int(round(p / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def best(runs):
+    """ Merges several runs of a suite, keeping the best value of every
+        metric: repeating a suite filters out the moments when the machine
+        was busy with something else.
+
+        >>> best([{"a": {"count": 5, "p50": 2.0, "rate": 10.0}},
+        ...       {"a": {"count": 5, "p50": 1.0, "rate": 8.0}}])
+        {'a': {'count': 10, 'p50': 1.0, 'rate': 10.0}}
+    """
+    merged = {}
+    for results in runs:
+        for case, result in results.items():
+            if case not in merged:
+                merged[case] = dict(result)
+                continue
+            for metric, value in result.items():
+                if metric == "count":
+                    merged[case][metric] += value
+                elif metric in LOWER_IS_BETTER:
+                    merged[case][metric] = min(merged[case][metric], value)
+                else:
+                    merged[case][metric] = max(merged[case][metric], value)
+    return merged
+
+
+def path(suite):
+    return os.path.join(RESULTS_DIR, suite + ".json")
+
+
+def save(suite, results, ref=None, f=None):
+    """ Stores {case: result} of a suite, with a description of the machine
+        and its reference() time.
+    """
+    f = f or path(suite)
+    if not os.path.isdir(os.path.dirname(f)):
+        os.makedirs(os.path.dirname(f))
+    with open(f, "w") as fh:
+        json.dump({
+            "suite": suite,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.platform(),
+            "reference": ref,
+            "results": results,
+        }, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+    return f
+
+
+def load(f):
+    """ Returns the stored results and reference time """
+    with open(f) as fh:
+        stored = json.load(fh)
+    return stored["results"], stored.get("reference")
+
+
+def compare(baseline, results, threshold=None, metrics=None, speed=1.0):
+    """ Compares results to baseline, case by case. Returns rows of
+        (case, metric, baseline, current, change in %, regressed) where
+        regressed is set when the metric got worse by more than threshold %.
+        Only the given metrics (default: all) can regress.
+
+        The current results are first scaled by speed, the reference time
+        of the baseline divided by the current one.
+
+        >>> compare({"a": {"rate": 100.0}}, {"a": {"rate": 80.0}}, 10)
+        [('a', 'rate', 100.0, 80.0, -20.0, True)]
+        >>> compare({"a": {"p50": 1.0}}, {"a": {"p50": 2.0}}, 10, speed=0.5)
+        [('a', 'p50', 1.0, 1.0, 0.0, False)]
+    """
+    rows = []
+    for case in sorted(results):
+        if case not in baseline:
+            continue
+        for metric in sorted(results[case]):
+            if metric == "count" or metric not in baseline[case]:
+                continue
+            before = baseline[case][metric]
+            after = results[case][metric]
+            after = after * speed if metric in LOWER_IS_BETTER else after / speed
+            change = (after - before) * 100.0 / before if before else 0.0
+            worse = change > 0 if metric in LOWER_IS_BETTER else change < 0
+            regressed = (threshold is not None and worse and abs(change) > threshold
+                         and (metrics is None or metric in metrics))
+            rows.append((case, metric, before, after, round(change, 1), regressed))
+    return rows
+
+
+def report(results, out=sys.stdout):
+    out.write("%-40s %8s %10s %10s %10s\n" % ("case", "count", "p50 ms", "p99 ms", "rate/s"))
+    for case in sorted(results):
+        r = results[case]
+        out.write("%-40s %8d %10.3f %10.3f %10.1f\n" % (
+            case, r["count"], r["p50"], r["p99"], r["rate"]))
+
+
+def report_comparison(rows, out=sys.stdout):
+    out.write("%-40s %6s %12s %12s %8s\n" % ("case", "metric", "baseline", "current", "change"))
+    for case, metric, before, after, change, regressed in rows:
+        out.write("%-40s %6s %12.3f %12.3f %+7.1f%%%s\n" % (
+            case, metric, before, after, change, "  REGRESSION" if regressed else ""))
@@ -0,0 +1,151 @@
+""" Import time of the service modules, in fresh interpreters: what every
+    worker spawn pays before serving its first request.
+
+    python -m benchmarks.imports [--runs 20] [--save] [--compare FILE]
+                                 [--threshold PCT] [--tree MODULE]
+
+    Each module is imported --runs times, each time in a new interpreter.
+    With --compare, exits with an error when the median import time of a
+    module regresses by more than --threshold percent (default 25), or when
+    a module imports one of its FORBIDDEN modules. --tree prints the
+    imports of a module like `python -X importtime` (Python 3.7) does.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+from benchmarks import harness
+
+SUITE = "imports"
+
+MODULES = ("timekpr_service.queries", "timekpr_service.service", "app")
+
+# Modules that must not be loaded by importing the key
+FORBIDDEN = {
+    "timekpr_service.queries": ("pyparsing", "inspect", "ctypes.util"),
+    "timekpr_service.service": ("pyparsing",),
+}
+
+# The metric that fails the comparison: the median import time
+GATED = ("p50",)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_TIMED = """
+import sys
+from timeit import default_timer
+start = default_timer()
+import {0}
+elapsed = default_timer() - start
+sys.stdout.write("%f %s" % (elapsed, " ".join(sorted(sys.modules))))
+"""
+
+_TREE = """
+import sys
+import __builtin__
+from timeit import default_timer
+_import = __builtin__.__import__
+# The time spent in the imports of each import being timed
+children = [0.0]
+depth = [0]
+
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return _import(name, *args, **kwargs)
+    children.append(0.0)
+    depth[0] += 1
+    start = default_timer()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        elapsed = default_timer() - start
+        depth[0] -= 1
+        inner = children.pop()
+        children[-1] += elapsed
+        sys.stderr.write("import time: %9d | %10d | %s%s\\n" % (
+            (elapsed - inner) * 1e6, elapsed * 1e6, "  " * depth[0], name))
+
+__builtin__.__import__ = timed_import
+sys.stderr.write("import time: self [us] | cumulative | imported package\\n")
+import {0}
+"""
+
+
+def timed_import(module):
+    """ Returns (seconds, loaded module names) of importing module in a
+        new interpreter
+    """
+    out = subprocess.check_output(
+        [sys.executable, "-c", _TIMED.format(module)], cwd=ROOT
+    )
+    (elapsed, modules) = out.split(" ", 1)
+    return float(elapsed), set(modules.split())
+
+
+def run(runs):
+    """ Returns ({case: result}, [forbidden imports]) """
+    results = {}
+    violations = []
+    for module in MODULES:
+        times = []
+        for _ in range(runs):
+            (elapsed, loaded) = timed_import(module)
+            times.append(elapsed)
+        times.sort()
+        results[module] = {
+            "count": runs,
+            "p50": harness.percentile(times, 50) * 1000,
+            "p99": harness.percentile(times, 99) * 1000,
+            "rate": runs / sum(times),
+        }
+        violations.extend(
+            "%s imports %s" % (module, name)
+            for name in FORBIDDEN.get(module, ()) if name in loaded
+        )
+    return results, violations
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=20,
+                        help="interpreters started per module")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results in " + harness.path(SUITE))
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare to stored results")
+    parser.add_argument("--threshold", type=float, default=25.0,
+                        help="fail when an import time regresses by more than this %%")
+    parser.add_argument("--tree", metavar="MODULE",
+                        help="print the import tree of MODULE and exit")
+    args = parser.parse_args(argv[1:])
+
+    if args.tree:
+        return subprocess.call(
+            [sys.executable, "-c", _TREE.format(args.tree)], cwd=ROOT
+        )
+
+    ref = harness.reference()
+    (results, violations) = run(args.runs)
+    ref = (ref + harness.reference()) / 2
+    harness.report(results)
+
+    status = 0
+    for violation in violations:
+        print("FORBIDDEN IMPORT: " + violation)
+        status = 1
+    if args.compare:
+        (baseline, baseline_ref) = harness.load(args.compare)
+        speed = baseline_ref / ref if baseline_ref else 1.0
+        print("machine speed relative to the baseline: %.2f" % speed)
+        rows = harness.compare(baseline, results, args.threshold, GATED, speed)
+        harness.report_comparison(rows)
+        status = status or int(any(row[-1] for row in rows))
+    if args.save:
+        print("saved " + harness.save(SUITE, results, ref))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,148 @@
+""" Microbenchmarks of timekpr.pam: parsing, locking and schedules, on
+    access.conf and time.conf files with an increasing number of users.
+
+    python -m benchmarks.pamconf [--users 100,1000,10000] [--repeat 3]
+                                 [--save] [--compare FILE] [--threshold PCT]
+
+    The suite runs --repeat times and keeps the best of each case. With
+    --compare, exits with an error when the rate of a case regresses by
+    more than --threshold percent (default 20).
+"""
+
+import argparse
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+
+from timekpr_service import dirs
+from timekpr_service.timekpr import pam, schedule
+
+from benchmarks import harness, pamparser, synthetic
+
+SUITE = "pamconf"
+
+# The metric that fails the comparison: throughput
+GATED = ("rate",)
+
+# Fast cases are timed in loops of at least this many seconds
+MIN_SAMPLE = 0.002
+
+# Larger configurations take seconds to parse with pyparsing
+PAMPARSER_MAX_USERS = 1000
+
+
+def cases(root, users):
+    """ Returns [(name, fn)] on the host at root, fn runs the case once """
+    access_conf = root + dirs._DEFAULTS['PAM_ACCESS_CONF']
+    time_conf = root + dirs._DEFAULTS['PAM_TIME_CONF']
+    names = itertools.cycle([synthetic.username(i) for i in range(users)])
+    batch = ["new%02d" % i for i in range(10)]
+    now = [1400000000]
+
+    def lock_unlock():
+        pam.lockuser("newuser", access_conf)
+        pam.unlockuser("newuser", access_conf)
+
+    def lock_unlock_batch():
+        pam.setuserslocked(lock=batch, f=access_conf)
+        pam.setuserslocked(unlock=batch, f=access_conf)
+
+    def later():
+        # Each evaluation at another minute of the week
+        now[0] += 61
+        return now[0]
+
+    result = [
+        ("getconfsection", lambda: pam.getconfsection(access_conf)),
+        ("parseaccessconf", lambda: pam.parseaccessconf(access_conf)),
+        ("parsetimeconf+parseutlist",
+            lambda: pam.parseutlist(pam.parsetimeconf(time_conf))),
+        ("lockuser+unlockuser", lock_unlock),
+        ("setuserslocked (10 users)", lock_unlock_batch),
+        ("schedule.compilelimits",
+            lambda: schedule.compilelimits(pam.parseutlist(pam.parsetimeconf(time_conf)))),
+        ("schedule.load", lambda: schedule.load(time_conf)),
+        ("Schedule.isallowed",
+            lambda: schedule.load(time_conf).isallowed(next(names), later())),
+        ("Schedule.nextchange",
+            lambda: schedule.load(time_conf).nextchange(next(names), later())),
+        ("Schedule.allowedusers",
+            lambda: schedule.load(time_conf).allowedusers(later())),
+        ("isuserlimitednow",
+            lambda: pam.isuserlimitednow(next(names), time_conf)),
+    ]
+    if users <= PAMPARSER_MAX_USERS:
+        # pamparser only recognizes the lines it wrote itself
+        for type, templates in (("time.conf", pamparser.TIME_CONF_LINES),
+                                ("access.conf", pamparser.ACCESS_CONF_LINES)):
+            f = os.path.join(root, "pamparser-" + type)
+            with open(f, "w") as fh:
+                fh.write(pamparser.generate(templates, users))
+            result.append((
+                "pamparser " + type,
+                lambda type=type, f=f: pam.pamparser(type=type, input="file", file=f)
+            ))
+    return result
+
+
+def run(users, requests, max_seconds):
+    results = {}
+    root = tempfile.mkdtemp(prefix="timekpr-pam-")
+    try:
+        # One access.conf and one time.conf line per user
+        synthetic.build(root, users, locked_every=1, limited_every=1)
+        for name, fn in cases(root, users):
+            results["%s N=%d" % (name, users)] = harness.measure(
+                fn, requests, max_seconds, min_sample=MIN_SAMPLE)
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", default="100,1000,10000",
+                        help="comma separated numbers of users in the files")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="runs per case")
+    parser.add_argument("--max-seconds", type=float, default=1.0,
+                        help="time budget per case")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of the suite, the best of each case is kept")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results in " + harness.path(SUITE))
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare to stored results")
+    parser.add_argument("--threshold", type=float, default=20.0,
+                        help="fail when a rate regresses by more than this %%")
+    args = parser.parse_args(argv[1:])
+
+    runs = []
+    refs = [harness.reference()]
+    for _ in range(args.repeat):
+        results = {}
+        for users in [int(n) for n in args.users.split(",")]:
+            results.update(run(users, args.requests, args.max_seconds))
+        runs.append(results)
+        refs.append(harness.reference())
+    results = harness.best(runs)
+    ref = sum(refs) / len(refs)
+    harness.report(results)
+
+    status = 0
+    if args.compare:
+        (baseline, baseline_ref) = harness.load(args.compare)
+        speed = baseline_ref / ref if baseline_ref else 1.0
+        print("machine speed relative to the baseline: %.2f" % speed)
+        rows = harness.compare(baseline, results, args.threshold, GATED, speed)
+        harness.report_comparison(rows)
+        status = int(any(row[-1] for row in rows))
+    if args.save:
+        print("saved " + harness.save(SUITE, results, ref))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,69 @@
+""" Parse time of timekpr.pam.pamparser on generated configuration files.
+
+    python -m benchmarks.pamparser [lines] [repeat]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+from timekpr_service.timekpr import pam
+
+TIME_CONF_LINES = [
+    "*;*;%s;Al0800-2000 # Added by timekpr",
+    "login ; tty* ; %s ; !Wk0000-0700 & !Wd0000-0900 # Added by timekpr",
+    "*;*;%s;WdMo0000-2400 | Tu0800-2400 # Added by timekpr",
+]
+
+ACCESS_CONF_LINES = [
+    "- : %s : ALL # Added by timekpr",
+    "+ : %s : .foo.bar.org # Added by timekpr",
+]
+
+
+def generate(templates, lines, duplicate_every=100):
+    """ Returns a configuration with `lines` recognized lines, one user per
+        line except for a duplicate of the previous user every
+        `duplicate_every` lines, plus some comments and foreign lines.
+    """
+    out = ["# generated by benchmarks.pamparser", "xsh ; ttyp* ; root ; !WdMo0200-1500"]
+    user = 0
+    for i in range(lines):
+        if not duplicate_every or i % duplicate_every:
+            user += 1
+        out.append(templates[i % len(templates)] % ("user%d" % user))
+    return "\n".join(out) + "\n"
+
+
+def bench(type, text, repeat):
+    """ Returns the best time of parsing text from a fresh file """
+    d = tempfile.mkdtemp()
+    try:
+        f = os.path.join(d, type)
+        best = None
+        for _ in range(repeat):
+            with open(f, "w") as fh:
+                fh.write(text)
+            start = default_timer()
+            pam.pamparser(type=type, input="file", file=f)
+            elapsed = default_timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    finally:
+        shutil.rmtree(d)
+
+
+def main(argv):
+    lines = int(argv[1]) if len(argv) > 1 else 10000
+    repeat = int(argv[2]) if len(argv) > 2 else 3
+    for type, templates in (("time.conf", TIME_CONF_LINES),
+                            ("access.conf", ACCESS_CONF_LINES)):
+        elapsed = bench(type, generate(templates, lines), repeat)
+        print("%-12s %6d lines %8.3f s %10.0f lines/s" % (
+            type, lines, elapsed, lines / elapsed))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,94 @@
+""" Synthetic timekpr hosts: a root directory with the account databases,
+    login.defs, the pam configuration and the timekpr work directory of
+    a given number of users.
+
+    with synthetic.host(1000) as root:
+        ...  # timekpr_service.dirs points into root
+"""
+
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from timekpr_service import dirs
+
+UID_MIN = 1000
+UID_MAX = 60000
+
+SYSTEM_USERS = [("root", 0), ("daemon", 1), ("nobody", 65534)]
+
+TIME_CONF_LIMITS = [
+    "Al0000-2400",
+    "Su0700-2200 | Mo0700-2200 | Tu0700-2200 | We0700-2200 | Th0700-2200 | Fr0700-2200 | Sa0900-2200",
+]
+
+
+def username(i):
+    return "user%05d" % i
+
+
+def build(root, users, locked_every=10, limited_every=3):
+    """ Writes a host of `users` normal users under root: every user has a
+        .time file, one in `locked_every` is locked (.lock file and
+        access.conf line) and one in `limited_every` has time.conf limits.
+    """
+    names = [username(i) for i in range(users)]
+
+    def path(p):
+        f = root.rstrip("/") + p
+        if not os.path.isdir(os.path.dirname(f)):
+            os.makedirs(os.path.dirname(f))
+        return f
+
+    accounts = SYSTEM_USERS + [(u, UID_MIN + i) for i, u in enumerate(names)]
+    with open(path(dirs._DEFAULTS['PASSWD']), "w") as fh:
+        for u, uid in accounts:
+            fh.write("%s:x:%d:%d::/home/%s:/bin/sh\n" % (u, uid, uid, u))
+    with open(path(dirs._DEFAULTS['SHADOW']), "w") as fh:
+        for u, uid in accounts:
+            fh.write("%s:!:16000:0:99999:7:::\n" % u)
+    with open(path(dirs._DEFAULTS['LOGIN_DEFS']), "w") as fh:
+        fh.write("UID_MIN %d\nUID_MAX %d\n" % (UID_MIN, UID_MAX))
+
+    locked = names[::locked_every] if locked_every else []
+    limited = names[::limited_every] if limited_every else []
+
+    with open(path(dirs._DEFAULTS['PAM_ACCESS_CONF']), "w") as fh:
+        fh.write("# access.conf of a synthetic host\n"
+                 "+ : root : LOCAL\n"
+                 "## TIMEKPR START\n")
+        for u in locked:
+            fh.write("-:%s:ALL\n" % u)
+        fh.write("## TIMEKPR END\n")
+
+    with open(path(dirs._DEFAULTS['PAM_TIME_CONF']), "w") as fh:
+        fh.write("# time.conf of a synthetic host\n"
+                 "## TIMEKPR START\n")
+        for i, u in enumerate(limited):
+            fh.write("*;*;%s;%s\n" % (u, TIME_CONF_LIMITS[i % len(TIME_CONF_LIMITS)]))
+        fh.write("## TIMEKPR END\n")
+
+    work_dir = path(dirs._DEFAULTS['WORK_DIR'] + "/")
+    for i, u in enumerate(names):
+        with open(os.path.join(work_dir, u + ".time"), "w") as fh:
+            fh.write(str(i * 60 % 86400))
+    for u in locked:
+        open(os.path.join(work_dir, u + ".lock"), "w").close()
+
+    return names
+
+
+@contextmanager
+def host(users, **kwargs):
+    """ Builds a host in a temporary directory and points
+        timekpr_service.dirs to it for the duration of the block.
+    """
+    root = tempfile.mkdtemp(prefix="timekpr-host-")
+    try:
+        build(root, users, **kwargs)
+        dirs.configure(root)
+        yield root
+    finally:
+        dirs.configure()
+        shutil.rmtree(root)
@@ -0,0 +1,370 @@
+""" Accounting of the time the users spend logged in.
+
+    Every interval seconds the accounting looks up who has a session in
+    utmp and adds the time they spent logged in to their .time counters,
+    through a Q backend (queries, or SQLiteQ), in a single batch update.
+
+    Users are not polled for expiry. When a user logs in, or the counter or
+    limits of a logged in user change, the moment they run out is computed
+    once: the earliest of the end of their daily limit (limit) and of their
+    allowed hours in time.conf (schedule). It goes into one heap shared by
+    all the users, and the accounting sleeps until the earliest of these
+    moments or the next tick, then locks the user (q.io_update_timestatus,
+    which calls pam.lockuser) right on time. A single thread keeps up with
+    thousands of users: a tick is one read and one write per logged in
+    user, a lock is a pop from the heap.
+
+    Counters are per day: on the first tick of each day, those of all the
+    users start again from 0, and the users locked for running out of their
+    limit are unlocked. The time of a locked user does not count. When the
+    accounting starts, the counters are taken as those of the day.
+
+    python -m timekpr_service.accounting [--interval 60] [--sqlite PATH]
+"""
+
+import argparse
+import heapq
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+from logging import basicConfig, getLogger, INFO
+from threading import Event
+
+from timekpr import schedule
+
+from timekpr_service import dirs, utmp
+from timekpr_service.queries import TimeStatus
+
+# The state of a logged in user: their time at since (seconds since the
+# epoch), whether they are locked, and the generation of their pending
+# expiry in the heap
+Account = namedtuple("Account", ["time", "since", "locked", "generation"])
+
+log = getLogger(__name__)
+
+
+def utmp_sessions():
+    """
+    The usernames of the open sessions.
+    """
+    return set(utmp.sessions_index())
+
+
+def read_limit(username, t):
+    """
+    The seconds username may spend logged in on the day of t, from the
+    first line of SETTINGS_DIR/username as timekpr writes it,
+    "limit=( Su Mo Tu We Th Fr Sa )"; None when there is no limit.
+
+    >>> import shutil, tempfile
+    >>> monday = time.mktime((2020, 1, 6, 12, 0, 0, 0, 0, -1))
+    >>> root = tempfile.mkdtemp()
+    >>> try:
+    ...     dirs.configure(root); os.makedirs(dirs.SETTINGS_DIR)
+    ...     with open(os.path.join(dirs.SETTINGS_DIR, "eric"), "w") as fh:
+    ...         fh.write("limit=( 7200 3600 3600 3600 3600 3600 7200 )\\n")
+    ...     print(read_limit("eric", monday), read_limit("ana", monday))
+    ... finally:
+    ...     dirs.configure(); shutil.rmtree(root)
+    (3600, None)
+    """
+    try:
+        with open(os.path.join(dirs.SETTINGS_DIR, username)) as fh:
+            limits = re.findall(r"\d+", fh.readline())
+    except IOError:
+        return None
+    if len(limits) < 7:
+        return None
+    return int(limits[schedule.minuteofweek(t) // schedule.DAY])
+
+
+def load_schedule():
+    """
+    The Schedule of time.conf, None without a timekpr section.
+    """
+    try:
+        return schedule.load(dirs.PAM_TIME_CONF)
+    except (IOError, OSError, SystemExit):
+        return None
+
+
+class Accounting(object):
+    """
+    >>> from timekpr_service.service import MockQ
+    >>> from timekpr_service import queries
+    >>> q = MockQ([queries.User("eric"), queries.User("ana"), queries.User("bob")], {
+    ...     "eric": queries.TimeStatus(3000, False),
+    ...     "bob": queries.TimeStatus(3000, False)
+    ... })
+    >>> logged_in = set(["eric", "ana"])
+    >>> accounting = Accounting(q, sessions=lambda: logged_in,
+    ...                         limit=lambda username, t: 3600,
+    ...                         schedule=lambda: None, interval=60)
+    >>> noon = time.mktime((2020, 1, 6, 12, 0, 0, 0, 0, -1))
+    >>> accounting.step(noon) - noon
+    60.0
+
+    eric runs out 10 minutes later, ana keeps going
+
+    >>> accounting.step(noon + 600) - noon
+    660.0
+    >>> q.io_timestatus("eric"), q.io_timestatus("ana")
+    (TimeStatus(time=3600, locked=True), TimeStatus(time=600, locked=False))
+
+    ana logs out; an admin gives eric a new hour
+
+    >>> logged_in.discard("ana")
+    >>> q.io_update_timestatus("eric", queries.TimeStatus(0, False))
+    >>> accounting.step(noon + 660) - noon
+    720.0
+    >>> accounting.step(noon + 4260) - noon
+    4320.0
+    >>> q.io_timestatus("eric"), q.io_timestatus("ana")
+    (TimeStatus(time=3600, locked=True), TimeStatus(time=660, locked=False))
+
+    eric stays logged in, locked: his time no longer counts
+
+    >>> accounting.step(noon + 7200) - noon
+    7260.0
+    >>> q.io_timestatus("eric")
+    TimeStatus(time=3600, locked=True)
+
+    The next day every counter starts again from 0: eric, locked overnight,
+    is unlocked, and bob, who used 3000s the day before and only logs in
+    now, has a whole hour too
+
+    >>> logged_in.add("bob")
+    >>> tomorrow = time.mktime((2020, 1, 7, 9, 0, 0, 0, 0, -1))
+    >>> accounting.step(tomorrow) - tomorrow
+    60.0
+    >>> q.io_timestatus("eric"), q.io_timestatus("ana"), q.io_timestatus("bob")
+    (TimeStatus(time=0, locked=False), TimeStatus(time=0, locked=False), TimeStatus(time=0, locked=False))
+    >>> accounting.step(tomorrow + 3600) - tomorrow
+    3660.0
+    >>> q.io_timestatus("eric"), q.io_timestatus("bob")
+    (TimeStatus(time=3600, locked=True), TimeStatus(time=3600, locked=True))
+    """
+
+    def __init__(self, q, sessions=utmp_sessions, limit=read_limit,
+                 schedule=load_schedule, clock=time.time, interval=60.0):
+        self.q = q
+        self.sessions = sessions
+        self.limit = limit
+        self.schedule = schedule
+        self.clock = clock
+        self.interval = interval
+        # {username: Account()} of the logged in users
+        self.accounts = {}
+        # [(expiry, username, generation, reason)]
+        self.heap = []
+        self.generation = 0
+        # {username: (year, month, day)} the counter of each user last
+        # started from 0
+        self.reset_days = {}
+        # {username: reason} of the users locked by _expire()
+        self.locked_by = {}
+        self.next_tick = 0
+        self.stopped = Event()
+
+    def run(self):
+        """
+        Accounts until stop() is called.
+        """
+        while not self.stopped.is_set():
+            due = self.step(self.clock())
+            self.stopped.wait(max(0, due - self.clock()))
+
+    def stop(self):
+        self.stopped.set()
+
+    def step(self, now):
+        """
+        Does what was due by now: locks the users who ran out, in order,
+        and the tick. Returns when the next thing is due.
+        """
+        while True:
+            if self.heap and self.heap[0][0] <= min(now, self.next_tick):
+                self._expire(*heapq.heappop(self.heap))
+            elif self.next_tick <= now:
+                self._tick(now)
+            else:
+                break
+        if self.heap:
+            return min(self.heap[0][0], self.next_tick)
+        return self.next_tick
+
+    def _tick(self, now):
+        """
+        Charges the time spent by the logged in users. Their lock state is
+        left to q: an admin may lock or unlock them while the tick runs.
+
+        >>> from timekpr_service.service import MockQ
+        >>> from timekpr_service import queries
+        >>> q = MockQ([queries.User("ana")], {})
+        >>> def limit(username, t):
+        ...     # Looked up between the read and the write of the tick
+        ...     q.io_update_timestatus("ana", queries.TimeStatus(None, True))
+        >>> accounting = Accounting(q, sessions=lambda: ["ana"], limit=limit,
+        ...                         schedule=lambda: None, interval=60)
+        >>> noon = time.mktime((2020, 1, 6, 12, 0, 0, 0, 0, -1))
+        >>> accounting.step(noon) - noon
+        60.0
+        >>> accounting.step(noon + 60) - noon
+        120.0
+        >>> q.io_timestatus("ana")
+        TimeStatus(time=0, locked=True)
+        """
+        day = time.localtime(now)[:3]
+        resets = self._resets(day)
+        active = set(
+            username for username in self.sessions()
+            if self.q.io_user(username) is not None
+        )
+
+        updates = []
+        for username in set(self.accounts) - active:
+            # Logged out: charge them until now
+            account = self.accounts.pop(username)
+            (time_spent, _) = self._charge(account, now)
+            status = self.q.io_timestatus(username) or TimeStatus(0, False)
+            if status.time == account.time and username not in resets:
+                updates.append((username, TimeStatus(time_spent, None)))
+
+        for username in active:
+            account = self.accounts.get(username)
+            status = self.q.io_timestatus(username) or TimeStatus(0, False)
+            reset = resets.get(username)
+            if reset is not None:
+                # New day
+                locked = status.locked if reset.locked is None else reset.locked
+                account = self._schedule(username, Account(0, now, locked, None), now)
+            elif account is None or status.time != account.time:
+                # New session, or time changed behind our back
+                account = Account(status.time, now, status.locked, None)
+                account = self._schedule(username, account, now)
+            elif status.locked != account.locked:
+                # Locked or unlocked by an admin
+                account = self._schedule(
+                    username, account._replace(locked=status.locked), now)
+            if not account.locked:
+                self.locked_by.pop(username, None)
+            (time_spent, since) = self._charge(account, now)
+            self.accounts[username] = account._replace(time=time_spent, since=since)
+            updates.append((username, TimeStatus(
+                time_spent, reset.locked if reset is not None else None)))
+
+        updates.extend(
+            (username, reset) for username, reset in resets.items()
+            if username not in active
+        )
+        for username, error in self.q.io_update_timestatus_list(updates):
+            if error is not None:
+                log.warning("Could not account for {0}: {1}".format(username, error))
+            elif username in resets:
+                self.reset_days[username] = day
+                if resets[username].locked is False:
+                    self.locked_by.pop(username, None)
+        self.next_tick = min(now + self.interval, _next_midnight(now))
+
+    def _resets(self, day):
+        """
+        {username: TimeStatus()} of the users whose counter is due to start
+        again from 0 on day; those locked for running out of their limit
+        are unlocked. A reset that fails is made again at the next tick.
+        """
+        resets = {}
+        for user in self.q.io_user_list():
+            if self.reset_days.setdefault(user.username, day) != day:
+                unlock = self.locked_by.get(user.username) == "limit"
+                resets[user.username] = TimeStatus(0, False if unlock else None)
+        return resets
+
+    def _charge(self, account, t):
+        """
+        The whole seconds spent by t, and the time they are counted from.
+        The time of a locked account does not count.
+        """
+        if account.locked:
+            return account.time, t
+        spent = account.time + (t - account.since)
+        whole = int(spent)
+        return whole, t - (spent - whole)
+
+    def _schedule(self, username, account, now):
+        """
+        Pushes the expiry of account on the heap, unless it is locked.
+        Returns the account with its new generation: any older expiry in
+        the heap is ignored.
+        """
+        self.generation += 1
+        account = account._replace(generation=self.generation)
+        if account.locked:
+            return account
+
+        expiries = []
+        limit = self.limit(username, now)
+        if limit is not None:
+            expiries.append((now + max(0, limit - account.time), "limit"))
+        sched = self.schedule()
+        if sched is not None:
+            if not sched.isallowed(username, now):
+                expiries.append((now, "schedule"))
+            else:
+                minutes = sched.nextchange(username, now)
+                if minutes is not None:
+                    expiries.append((now - now % 60 + minutes * 60, "schedule"))
+        if expiries:
+            (expiry, reason) = min(expiries)
+            heapq.heappush(self.heap, (expiry, username, self.generation, reason))
+        return account
+
+    def _expire(self, expiry, username, generation, reason):
+        account = self.accounts.get(username)
+        if account is None or account.generation != generation:
+            # Logged out or rescheduled since
+            return
+        (time_spent, since) = self._charge(account, max(expiry, account.since))
+        time_spent = int(round(time_spent))
+        log.info("{0} ran out of time ({1}), locking".format(username, reason))
+        self.q.io_update_timestatus(username, TimeStatus(time_spent, True))
+        self.locked_by[username] = reason
+        self.accounts[username] = account._replace(
+            time=time_spent, since=since, locked=True)
+
+
+def _next_midnight(t):
+    """
+    >>> noon = time.mktime((2020, 1, 6, 12, 0, 0, 0, 0, -1))
+    >>> time.localtime(_next_midnight(noon))[:6]
+    (2020, 1, 7, 0, 0, 0)
+    """
+    lt = time.localtime(t)
+    return time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--interval", type=float, default=60.0,
+                        help="seconds between two lookups of the sessions")
+    parser.add_argument("--sqlite", metavar="PATH",
+                        help="keep the time status in this SQLite database")
+    args = parser.parse_args(argv[1:])
+
+    basicConfig(level=INFO)
+    if args.sqlite:
+        from timekpr_service.sqlitequeries import SQLiteQ
+        q = SQLiteQ(args.sqlite, follow=True)
+    else:
+        from timekpr_service import queries as q
+    accounting = Accounting(q, interval=args.interval)
+    try:
+        accounting.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,124 @@
+""" Authentication of the admin users (ADMIN_USERS) against PAM """
+
+from __future__ import absolute_import
+
+import hmac
+import os
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+from timeit import default_timer
+
+import pam
+from werkzeug.http import parse_authorization_header
+
+from timekpr_service import metrics
+
+# The PAM service that checks passwords
+SERVICE = "login"
+
+AUTH_SECONDS = metrics.Histogram(
+    "timekpr_auth_duration_seconds",
+    "Checks of admin credentials",
+    ("source",)
+)
+
+AUTH_CACHE_REQUESTS = metrics.Counter(
+    "timekpr_auth_cache_requests_total",
+    "Lookups of the credential cache",
+    ("result",)
+)
+
+
+def authenticate(username, password):
+    """
+    Checks a password with PAM.
+    """
+    return pam.pam().authenticate(username, password, service=SERVICE)
+
+
+class CredentialCache(object):
+    """
+    Remembers for ttl seconds the credentials that authenticate accepted,
+    so that repeated requests skip the PAM conversation. Only a salted
+    HMAC of each password is kept, for at most size users. Rejected
+    credentials always go to authenticate, and evict the user.
+
+    >>> calls = []
+    >>> def check(username, password):
+    ...     calls.append(username)
+    ...     return password == "secret"
+    >>> now = [0]
+    >>> cache = CredentialCache(check, ttl=60, size=10, clock=lambda: now[0])
+    >>> cache.check("eric", "secret"), cache.check("eric", "secret"), len(calls)
+    (True, True, 1)
+    >>> cache.check("eric", "wrong"), cache.check("eric", "secret"), len(calls)
+    (False, True, 3)
+    >>> now[0] = 61
+    >>> cache.check("eric", "secret"), len(calls)
+    (True, 4)
+    """
+
+    def __init__(self, authenticate=authenticate, ttl=60.0, size=256, clock=time.time):
+        self.authenticate = authenticate
+        self.ttl = ttl
+        self.size = size
+        self.clock = clock
+        # {username: (expiry, salt, digest)}, least recently used first
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def check(self, username, password):
+        start = default_timer()
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.pop(username, None)
+            if entry is not None and entry[0] > now:
+                self.entries[username] = entry
+        if entry is not None and entry[0] > now:
+            if hmac.compare_digest(entry[2], _digest(entry[1], password)):
+                AUTH_CACHE_REQUESTS.inc("hit")
+                AUTH_SECONDS.observe(default_timer() - start, "cache")
+                return True
+        AUTH_CACHE_REQUESTS.inc("miss")
+
+        ok = self.authenticate(username, password)
+        AUTH_SECONDS.observe(default_timer() - start, "pam")
+        with self.lock:
+            self.entries.pop(username, None)
+            if ok and self.size > 0:
+                salt = os.urandom(16)
+                self.entries[username] = (now + self.ttl, salt, _digest(salt, password))
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return ok
+
+
+def _digest(salt, password):
+    if isinstance(password, unicode):
+        password = password.encode("utf-8")
+    return hmac.new(salt, password, sha256).digest()
+
+
+def is_admin(authorization, admins, check=authenticate):
+    """
+    Are the credentials of the Authorization header those of an admin?
+    check(username, password) verifies them (e.g. CredentialCache.check).
+
+    >>> is_admin(None, ["eric"])
+    False
+    >>> is_admin("Basic " + "nobody:secret".encode("base64").strip(), ["eric"])
+    False
+    >>> is_admin("Basic " + ":".encode("base64").strip(), [""])
+    False
+    >>> is_admin("Basic " + "eric:secret".encode("base64").strip(), ["eric"],
+    ...          lambda username, password: password == "secret")
+    True
+    """
+    credentials = parse_authorization_header(authorization)
+    if credentials is None or not credentials.username:
+        return False
+    if credentials.username not in admins:
+        return False
+    return check(credentials.username, credentials.password)
@@ -0,0 +1,152 @@
+""" Read-through cache in front of any Q backend (queries, MockQ, ...) """
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from timekpr_service import metrics
+
+CACHE_REQUESTS = metrics.Counter(
+    "timekpr_cache_requests_total",
+    "Reads of the query cache",
+    ("query", "result")
+)
+
+_MISSING = object()
+
+
+class CachedQ(object):
+    """
+    Caches the answers of q for at most ttl seconds, keeping the size most
+    recently used ones. Updates go through to q and invalidate what they
+    change, and so do the changes q reports (io_timestatus_changes).
+
+    A version (ETag) and the data it describes are one entry, the version
+    being read from q first: the version of an answer is never newer than
+    the data, so a stale answer can't be served with a fresh ETag.
+
+    Other attributes of q (e.g. io_timestatus_list) are used directly.
+
+    >>> from timekpr_service.service import MockQ
+    >>> from timekpr_service import queries
+    >>> now = [0]
+    >>> q = CachedQ(MockQ(
+    ...    [queries.User("eric")],
+    ...    {"eric": queries.TimeStatus(10, False)}
+    ... ), size=10, ttl=5, clock=lambda: now[0])
+    >>> q.io_timestatus("eric"); q.io_timestatus("eric")
+    TimeStatus(time=10, locked=False)
+    TimeStatus(time=10, locked=False)
+    >>> q.stats()
+    {'hits': 1, 'misses': 1}
+    >>> q.io_update_timestatus("eric", queries.TimeStatus(0, True))
+    >>> q.io_timestatus("eric")
+    TimeStatus(time=0, locked=True)
+    >>> q.q.data['timestatus']['eric'] = queries.TimeStatus(5, True)
+    >>> q.io_timestatus("eric")
+    TimeStatus(time=0, locked=True)
+    >>> now[0] = 6
+    >>> q.io_timestatus_version("eric"), q.io_timestatus("eric")
+    (TimeStatus(time=5, locked=True), TimeStatus(time=5, locked=True))
+
+    Changes made behind its back are invalidated as they are reported
+
+    >>> changes = q.io_timestatus_changes(0.01)
+    >>> q.q.io_update_timestatus("eric", queries.TimeStatus(7, False))
+    >>> next(changes), q.io_timestatus("eric")
+    (set(['eric']), TimeStatus(time=7, locked=False))
+    """
+
+    def __init__(self, q, size=1024, ttl=1.0, clock=time.time):
+        self.q = q
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        # {key: (expiry, value)}, least recently used first
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidation, see _get()
+        self.generation = 0
+
+    def __getattr__(self, name):
+        return getattr(self.q, name)
+
+    def io_user(self, username):
+        return self._get(("io_user", username), lambda: (None, self.q.io_user(username)))[1]
+
+    def io_user_list(self):
+        return iter(self._user_list()[1])
+
+    def io_user_list_version(self):
+        return self._user_list()[0]
+
+    def io_timestatus(self, username):
+        return self._timestatus(username)[1]
+
+    def io_timestatus_version(self, username):
+        return self._timestatus(username)[0]
+
+    def io_timestatus_changes(self, timeout=None):
+        for usernames in self.q.io_timestatus_changes(timeout):
+            self._invalidate(usernames)
+            yield usernames
+
+    def io_update_timestatus(self, username, timestatus, precondition=None):
+        try:
+            return self.q.io_update_timestatus(username, timestatus, precondition)
+        finally:
+            self._invalidate([username])
+
+    def io_update_timestatus_list(self, updates):
+        updates = list(updates)
+        try:
+            return self.q.io_update_timestatus_list(updates)
+        finally:
+            self._invalidate([username for username, _ in updates])
+
+    def _user_list(self):
+        return self._get(("io_user_list",), lambda: (
+            self.q.io_user_list_version(), tuple(self.q.io_user_list())
+        ))
+
+    def _timestatus(self, username):
+        return self._get(("io_timestatus", username), lambda: (
+            self.q.io_timestatus_version(username), self.q.io_timestatus(username)
+        ))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _get(self, key, query):
+        """
+        The (version, data) entry of key, from query() on a miss.
+        """
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.pop(key, _MISSING)
+            if entry is not _MISSING and entry[0] > now:
+                # Most recently used go last
+                self.entries[key] = entry
+                self.hits += 1
+                CACHE_REQUESTS.inc(key[0], "hit")
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+        CACHE_REQUESTS.inc(key[0], "miss")
+
+        value = query()
+        with self.lock:
+            # An update during the query may have made value stale
+            if generation == self.generation:
+                self.entries[key] = (now + self.ttl, value)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return value
+
+    def _invalidate(self, usernames):
+        with self.lock:
+            self.generation += 1
+            for username in usernames:
+                self.entries.pop(("io_timestatus", username), None)
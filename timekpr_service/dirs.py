@@ -18,6 +18,13 @@
 # Points to file with login defaults
 LOGIN_DEFS = '/etc/login.defs'
 
+# Points to user account databases (used to detect user list changes)
+PASSWD = '/etc/passwd'
+SHADOW = '/etc/shadow'
+
+# Points to the record of the open login sessions, see utmp(5)
+UTMP = '/var/run/utmp'
+
 # Points to log file
 LOG_FILE = '/var/log/timekpr.log'
 
@@ -32,3 +39,33 @@ SETTINGS_DIR = '/etc/timekpr'
 WORK_DIR = '/var/lib/timekpr'
 SHARED_DIR = '/usr/share/timekpr'
 DAEMON_DIR = '/etc/init.d'
+
+# ==============================================================================
+# ACCOUNTS
+# Read the user accounts through NSS (pwd/spwd); when False, PASSWD and SHADOW
+# are read as files (e.g. in a synthetic root, see configure())
+USE_NSS = True
+
+_PATHS = ('LOGIN_DEFS', 'PASSWD', 'SHADOW', 'UTMP', 'LOG_FILE', 'PAM_TIME_CONF',
+          'PAM_ACCESS_CONF', 'SETTINGS_DIR', 'WORK_DIR', 'SHARED_DIR',
+          'DAEMON_DIR')
+_DEFAULTS = dict((name, globals()[name]) for name in _PATHS + ('USE_NSS',))
+
+
+def configure(root=None):
+    """ Moves every path under root, e.g. a test or benchmark tree, and reads
+        the accounts from its files; configure() restores the defaults.
+        Paths are looked up when used, so this takes effect immediately.
+
+        >>> import timekpr_service.dirs as dirs
+        >>> configure("/tmp/host"); dirs.PAM_ACCESS_CONF, dirs.USE_NSS
+        ('/tmp/host/etc/security/access.conf', False)
+        >>> configure(); dirs.PAM_ACCESS_CONF, dirs.USE_NSS
+        ('/etc/security/access.conf', True)
+    """
+    g = globals()
+    g.update(_DEFAULTS)
+    if root is not None:
+        for name in _PATHS:
+            g[name] = root.rstrip('/') + _DEFAULTS[name]
+        g['USE_NSS'] = False
@@ -0,0 +1,241 @@
+""" Encodings of the documents: media types and content codings.
+
+    The media type is negotiated with Accept:
+    - application/json (default), with compact separators,
+    - application/msgpack, with the msgpack package,
+    - application/cbor, with the cbor package,
+    the binary ones being for machine clients.
+
+    The body is then compressed as negotiated with Accept-Encoding: gzip,
+    or zstd / br with the zstandard / brotli packages, once it is at least
+    MIN_SIZE bytes. Streamed bodies are compressed as they are sent.
+
+    Every representation of a resource has a strong ETag of its own: the
+    ETag of the resource, suffixed with the media type when it is not JSON
+    ("-msgpack") and with the content coding ("-gzip"). Conditional
+    requests strip the suffixes to compare against the resource.
+"""
+
+import zlib
+
+from flask import json, request
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor
+except ImportError:
+    cbor = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+
+# No space after "," and ":"
+SEPARATORS = (",", ":")
+
+# Smaller bodies are not worth compressing
+MIN_SIZE = 1024
+
+# Compression levels: fast ones, the documents are built per request
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+# By order of preference, for the same quality
+MEDIA_TYPES = tuple(mimetype for mimetype, available in [
+    (JSON, True),
+    (MSGPACK, msgpack is not None),
+    (CBOR, cbor is not None),
+] if available)
+
+# Suffixes of the ETags of the representations, see suffix_etag()
+MEDIA_SUFFIXES = {MSGPACK: "-msgpack", CBOR: "-cbor"}
+CODING_SUFFIXES = ("-zstd", "-br", "-gzip")
+
+CODINGS = tuple(coding for coding, available in [
+    ("zstd", zstandard is not None),
+    ("br", brotli is not None),
+    ("gzip", True),
+] if available)
+
+
+def media_type(accept):
+    """
+    The media type of the answer to a request accepting accept (a
+    werkzeug MIMEAccept); JSON when nothing else matches.
+
+    >>> from werkzeug.datastructures import MIMEAccept
+    >>> media_type(MIMEAccept([("*/*", 1)]))
+    'application/json'
+    >>> media_type(MIMEAccept([("text/html", 1)]))
+    'application/json'
+    >>> media_type(MIMEAccept([(MSGPACK, 1), (JSON, 0.5)])) == (MSGPACK if msgpack else JSON)
+    True
+    """
+    return accept.best_match(MEDIA_TYPES) or JSON
+
+
+def dumps(data, mimetype=JSON):
+    """
+    >>> dumps({"time": 10, "locked": False})
+    '{"locked":false,"time":10}'
+    >>> msgpack is None or msgpack.unpackb(dumps({"time": 10}, MSGPACK)) == {"time": 10}
+    True
+    """
+    if mimetype == MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    if mimetype == CBOR:
+        return cbor.dumps(data)
+    return json.dumps(data, separators=SEPARATORS, sort_keys=True)
+
+
+def compress_response(response):
+    """
+    Compresses the response as negotiated with the Accept-Encoding of the
+    request (an after_request function).
+
+    >>> from timekpr_service.service import App, MockQ
+    >>> from timekpr_service import queries
+    >>> app = App()
+    >>> app.config['q'] = MockQ([queries.User("user%d" % i) for i in range(100)], {})
+    >>> c = app.test_client()
+    >>> r = c.get("/", headers={"Accept-Encoding": "gzip"})
+    >>> r.headers["Content-Encoding"], r.headers["ETag"].endswith('-gzip"')
+    ('gzip', True)
+    >>> len(json.loads(zlib.decompress(r.data, 31))["user"])
+    100
+    >>> c.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": r.headers["ETag"]}).status_code
+    304
+    >>> "Content-Encoding" in c.get("/").headers
+    False
+    >>> "Content-Encoding" in c.get("/context", headers={"Accept-Encoding": "gzip"}).headers
+    False
+    """
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.mimetype not in MEDIA_TYPES
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+
+    coding = request.accept_encodings.best_match(CODINGS)
+    if coding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compressed(response.response, coding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data("".join(_compressed([data], coding)))
+    response.headers["Content-Encoding"] = coding
+    suffix_etag(response, "-" + coding)
+    return response
+
+
+def suffix_etag(response, suffix):
+    """
+    Makes the strong ETag of response that of one of the representations
+    of its resource.
+    """
+    (etag, weak) = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag + suffix)
+
+
+def base_etag(etag):
+    """
+    The ETag of the resource of a representation, without its suffixes.
+
+    >>> base_etag("abc-msgpack-gzip"), base_etag("abc-br"), base_etag("abc")
+    ('abc', 'abc', 'abc')
+    """
+    for suffix in CODING_SUFFIXES:
+        if etag.endswith(suffix):
+            etag = etag[:-len(suffix)]
+            break
+    for suffix in MEDIA_SUFFIXES.values():
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)]
+    return etag
+
+
+def etag_matches(etags, etag, weak=True):
+    """
+    The tag of etags (the werkzeug ETags of an If-None-Match or If-Match
+    header) of a representation of the resource whose ETag is etag, None
+    if there is none. If-Match must compare strongly (RFC 7232): weak
+    tags never match it.
+
+    >>> from werkzeug.http import parse_etags
+    >>> etag_matches(parse_etags('"x", "abc-gzip"'), "abc", weak=False)
+    'abc-gzip'
+    >>> etag_matches(parse_etags('W/"abc"'), "abc", weak=False) is None
+    True
+    >>> etag_matches(parse_etags('W/"abc"'), "abc"), etag_matches(parse_etags('*'), "abc")
+    ('abc', 'abc')
+    """
+    if etags.star_tag:
+        return etag
+    for tag in etags.as_set(include_weak=weak):
+        if base_etag(tag) == etag:
+            return tag
+    return None
+
+
+def decompress(data, coding):
+    """
+    >>> decompress("".join(_compressed(["a" * 10, "b"], "gzip")), "gzip")
+    'aaaaaaaaaab'
+    """
+    if coding == "gzip":
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if coding == "br":
+        return brotli.decompress(data)
+    if coding == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def _compressed(chunks, coding):
+    """
+    Compresses chunks, flushing after each one so that a streamed body
+    keeps going out as it is generated.
+    """
+    try:
+        if coding == "gzip":
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compress = lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            finish = compressor.flush
+        elif coding == "br":
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            compress = lambda chunk: compressor.process(chunk) + compressor.flush()
+            finish = compressor.finish
+        else:
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            compress = lambda chunk: compressor.compress(chunk) + compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+            finish = compressor.flush
+
+        for chunk in chunks:
+            if chunk:
+                yield compress(chunk)
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
@@ -0,0 +1,424 @@
+""" Aggregator of a fleet of timekpr-service instances (one per machine).
+
+    FleetApp serves, from one URL, the users and time statuses of every
+    instance, fetched concurrently, and fans updates out to them:
+
+    GET /           => Index of the users of every host
+    GET /timestatus => TimeStatusCollection of every host
+    PUT /timestatus => [{host, username, time, locked}], sent to each host
+                       as one batch; updates without a host go to all
+
+    Every member carries the "host" it comes from. A host that fails or
+    does not answer within the timeout is listed under "error" and the
+    others are still served.
+"""
+
+import httplib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from socket import error as socket_error
+from timeit import default_timer
+from urlparse import urljoin, urlsplit
+
+from flask import Flask, Response, json, jsonify, request, url_for
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from timekpr_service import encoding, lazy, metrics, tracing
+from timekpr_service.service import CONTEXT, bad_request
+
+FLEET_CONTEXT = dict(CONTEXT, **{
+    "host": "vocab:host",
+    "error": "vocab:error",
+})
+
+FLEET_REQUEST_SECONDS = metrics.Histogram(
+    "timekpr_fleet_request_duration_seconds",
+    "Requests of the aggregator to the hosts of the fleet",
+    ("method", "host", "outcome")
+)
+
+# Requests in flight at once, over all hosts
+MAX_WORKERS = 32
+
+
+class HostError(Exception):
+    def __init__(self, message, status=None):
+        super(HostError, self).__init__(message)
+        # The HTTP status of the answer of the host, if any
+        self.status = status
+
+
+class Fleet(object):
+    """
+    The instances at hosts (base URLs), queried concurrently.
+
+    >>> from timekpr_service.service import App, MockQ
+    >>> from timekpr_service import queries
+    >>> fleet = Fleet(["http://lab1/", "http://lab2/"], transport=_mock_transport({
+    ...     "http://lab1/": [("eric", queries.TimeStatus(10, False))],
+    ...     "http://lab2/": [("eric", queries.TimeStatus(0, True))],
+    ... }))
+    >>> [(d['@id'], e) for (_, d, e) in fleet.get("user/eric/timestatus")]
+    [(u'http://lab1/user/eric/timestatus', None), (u'http://lab2/user/eric/timestatus', None)]
+    >>> [(h, e) for (h, _, e) in fleet.get("user/nobody")]
+    [('http://lab1/', HostError('HTTP 404',)), ('http://lab2/', HostError('HTTP 404',))]
+    """
+
+    def __init__(self, hosts, timeout=5.0, transport=None, headers=None):
+        self.hosts = [host.rstrip("/") + "/" for host in hosts]
+        self.timeout = timeout
+        self.transport = transport or HTTPTransport()
+        self.headers = headers or {}
+        self.pool = lazy.PerProcess(lambda: ThreadPoolExecutor(
+            max(1, min(MAX_WORKERS, len(self.hosts)))
+        ))
+
+    def get(self, path, headers=None):
+        """
+        GETs path of every host.
+        Returns [(host, document | None, Exception() | None)], in the
+        order of the hosts.
+        """
+        return self._map(lambda host: self._request(
+            "GET", host, path, headers=headers
+        ), self.hosts)
+
+    def put(self, path, bodies, headers=None):
+        """
+        PUTs the JSON document bodies[host] to path of each host in bodies.
+        Returns [(host, document | None, Exception() | None)].
+        """
+        return self._map(lambda host: self._request(
+            "PUT", host, path, bodies[host], headers
+        ), [host for host in self.hosts if host in bodies])
+
+    def index(self, url, headers=None):
+        """
+        The merged Index of the hosts.
+
+        >>> from timekpr_service import queries
+        >>> fleet = Fleet(["http://lab1/", "http://lab2/"], transport=_mock_transport({
+        ...     "http://lab1/": [("eric", queries.TimeStatus(10, False))],
+        ... }))
+        >>> data = fleet.index("/")
+        >>> [(u['host'], u['username']) for u in data['user']]
+        [('http://lab1/', u'eric')]
+        >>> data['error']
+        [{'host': 'http://lab2/', 'error': 'unknown host'}]
+        """
+        return self._merge(self.get("", headers), {
+            "@type": "Index",
+            "@id": url,
+        }, "user")
+
+    def timestatus_list(self, url, headers=None):
+        """
+        The merged TimeStatusCollection of the hosts.
+        """
+        return self._merge(self.get("timestatus", headers), {
+            "@type": "TimeStatusCollection",
+            "@id": url,
+        }, "member")
+
+    def put_timestatus_list(self, updates, headers=None):
+        """
+        Sends the updates ({host, username, time, locked}) of each host as
+        one batch. Updates without a host are sent to every host.
+        Returns {"result": [{host, username, status[, error]}]}.
+
+        >>> from timekpr_service import queries
+        >>> fleet = Fleet(["http://lab1/", "http://lab2/"], transport=_mock_transport({
+        ...     "http://lab1/": [("eric", queries.TimeStatus(10, False))],
+        ...     "http://lab2/": [("eric", queries.TimeStatus(10, False))],
+        ... }))
+        >>> admin = {"Authorization": "Basic " + "admin:secret".encode("base64").strip()}
+        >>> for result in fleet.put_timestatus_list([
+        ...     {"username": "eric", "locked": True},
+        ...     {"host": "http://lab3/", "username": "eric"},
+        ... ], admin)["result"]:
+        ...     print(result['host'], result['username'], result['status'])
+        ('http://lab3/', 'eric', 404)
+        ('http://lab1/', u'eric', 204)
+        ('http://lab2/', u'eric', 204)
+        >>> [d['locked'] for (_, d, _) in fleet.get("user/eric/timestatus")]
+        [True, True]
+        """
+        bodies = OrderedDict()
+        results = []
+        for update in updates:
+            update = dict(update)
+            host = update.pop("host", None)
+            hosts = self.hosts if host is None else [host.rstrip("/") + "/"]
+            for host in hosts:
+                if host not in self.hosts:
+                    results.append({
+                        "host": host,
+                        "username": update.get("username"),
+                        "status": 404,
+                    })
+                else:
+                    bodies.setdefault(host, []).append(update)
+
+        for host, document, error in self.put("timestatus", bodies, headers):
+            if error is not None:
+                results.extend({
+                    "host": host,
+                    "username": update.get("username"),
+                    # The host refused (e.g. 401) or could not be reached
+                    "status": error.status or 502,
+                    "error": str(error),
+                } for update in bodies[host])
+                continue
+            for result in document["result"]:
+                result["host"] = host
+                results.append(result)
+        return {"result": results}
+
+    def _merge(self, responses, data, key):
+        data[key] = []
+        data["host"] = self.hosts
+        data["error"] = []
+        for host, document, error in responses:
+            if error is not None:
+                data["error"].append({"host": host, "error": str(error)})
+                continue
+            for member in document.get(key, []):
+                member["host"] = host
+                data[key].append(member)
+        return data
+
+    def _request(self, method, host, path, body=None, headers=None):
+        url = urljoin(host, path)
+        all_headers = {"Accept": "application/json"}
+        all_headers.update(self.headers)
+        all_headers.update(headers or {})
+        if body is not None:
+            body = json.dumps(body)
+            all_headers["Content-Type"] = "application/json"
+
+        start = default_timer()
+        outcome = "error"
+        try:
+            with tracing.span("fleet.request", method=method, url=url) as attrs:
+                status, data = self.transport.request(
+                    method, url, body, all_headers, self.timeout
+                )
+                attrs["status"] = status
+            if status == 204:
+                outcome = "ok"
+                return None
+            if status != 200:
+                raise HostError("HTTP {0}".format(status), status)
+            document = json.loads(data)
+            outcome = "ok"
+            return document
+        except (httplib.HTTPException, socket_error, ValueError) as e:
+            raise HostError(str(e) or e.__class__.__name__)
+        finally:
+            FLEET_REQUEST_SECONDS.observe(
+                default_timer() - start, method, host, outcome
+            )
+
+    def _map(self, request_host, hosts):
+        futures = [(host, self.pool.get().submit(request_host, host))
+                   for host in hosts]
+        results = []
+        for host, future in futures:
+            try:
+                results.append((host, future.result(), None))
+            except HostError as e:
+                results.append((host, None, e))
+        return results
+
+class HTTPTransport(object):
+    """
+    HTTP/1.1 requests over keep-alive connections, pooled per host.
+    """
+
+    def __init__(self, size=4):
+        # {(scheme, netloc): [idle connection]}
+        self.idle = {}
+        self.size = size
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def request(self, method, url, body, headers, timeout):
+        """
+        Returns (status, body). A connection closed by the host while it
+        was idle is retried once on a new connection.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        connection, reused = self._acquire(key, timeout)
+        try:
+            try:
+                response = self._send(connection, method, path, body, headers)
+            except (httplib.BadStatusLine, socket_error):
+                if not reused:
+                    raise
+                connection.close()
+                connection, _ = self._acquire(key, timeout, fresh=True)
+                response = self._send(connection, method, path, body, headers)
+            data = encoding.decompress(
+                response.read(), response.getheader("Content-Encoding")
+            )
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        return response.status, data
+
+    def _send(self, connection, method, path, body, headers):
+        headers = dict(headers, **{"Accept-Encoding": "gzip"})
+        connection.request(method, path, body, headers)
+        return connection.getresponse()
+
+    def _acquire(self, key, timeout, fresh=False):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Connections must not be shared with the parent process
+                self.idle = {}
+                self.pid = os.getpid()
+            idle = self.idle.get(key)
+            if idle and not fresh:
+                connection = idle.pop()
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+        scheme, netloc = key
+        cls = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        return cls(netloc, timeout=timeout), False
+
+    def _release(self, key, connection):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+
+class WSGITransport(object):
+    """
+    Requests served by local WSGI applications (e.g. service.App()
+    instances standing in for the hosts), for tests and benchmarks.
+    """
+
+    def __init__(self, apps):
+        # {base URL: WSGI application}
+        self.apps = dict((base.rstrip("/") + "/", app) for base, app in apps.items())
+
+    def request(self, method, url, body, headers, timeout):
+        for base, app in self.apps.items():
+            if url.startswith(base):
+                response = Client(app, BaseResponse).open(
+                    url[len(base) - 1:],
+                    base_url=base,
+                    method=method,
+                    data=body,
+                    headers=headers,
+                )
+                return response.status_code, response.get_data()
+        raise socket_error("unknown host")
+
+
+def FleetApp(fleet):
+    """
+    >>> from timekpr_service import queries
+    >>> c = FleetApp(Fleet(["http://lab1/"], transport=_mock_transport({
+    ...     "http://lab1/": [("eric", queries.TimeStatus(10, False))],
+    ... }))).test_client()
+    >>> data = json.loads(c.get("/timestatus").data)
+    >>> [(m['host'], m['@id'], m['time']) for m in data['member']]
+    [(u'http://lab1/', u'http://lab1/user/eric/timestatus', 10)]
+    >>> r = c.put("/timestatus", data='[{"username": "eric", "time": 0}]')
+    >>> [(r['host'], r['status'], r['error']) for r in json.loads(r.data)['result']]
+    [(u'http://lab1/', 401, u'HTTP 401')]
+    >>> admin = {"Authorization": "Basic " + "admin:secret".encode("base64").strip()}
+    >>> r = c.put("/timestatus", data='[{"username": "eric", "time": 0}]', headers=admin)
+    >>> [(r['host'], r['status']) for r in json.loads(r.data)['result']]
+    [(u'http://lab1/', 204)]
+    >>> c.put("/timestatus", data='{}').status_code
+    400
+    """
+    app = Flask(__name__)
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+    app.after_request(encoding.compress_response)
+
+    def forwarded():
+        # The hosts check the credentials of the admin
+        if "Authorization" in request.headers:
+            return {"Authorization": request.headers["Authorization"]}
+        return {}
+
+    def document(data):
+        data["@context"] = url_for("context", _external=True)
+        data["start"] = url_for("index", _external=True)
+        return jsonify(data)
+
+    @app.route("/metrics")
+    def metrics_text():
+        return Response(
+            metrics.exposition(),
+            mimetype="text/plain; version=0.0.4"
+        )
+
+    @app.route("/context")
+    def context():
+        # The vocabulary is the one of the hosts
+        vocab = fleet.hosts[0] if fleet.hosts else request.url_root
+        return jsonify({"@context": dict(
+            FLEET_CONTEXT, vocab=urljoin(vocab, "vocab#")
+        )})
+
+    @app.route("/")
+    def index():
+        return document(fleet.index(
+            url_for("index", _external=True), forwarded()
+        ))
+
+    @app.route("/timestatus")
+    def timestatus_list():
+        return document(fleet.timestatus_list(
+            url_for("timestatus_list", _external=True), forwarded()
+        ))
+
+    @app.route("/timestatus", methods=["PUT"])
+    def put_timestatus_list():
+        data = request.get_json(force=True)
+        if not isinstance(data, list) or not all(isinstance(u, dict) for u in data):
+            return bad_request("Expected a list of time statuses")
+        return jsonify(fleet.put_timestatus_list(data, forwarded()))
+
+    return app
+
+
+def _mock_transport(hosts):
+    """
+    A WSGITransport to App() instances holding
+    {host: [(username, TimeStatus())]}, administered by admin:secret.
+    """
+    from timekpr_service.service import App, MockQ, _mock_admin
+    from timekpr_service import queries
+
+    apps = {}
+    for host, statuses in hosts.items():
+        app = App()
+        app.config['q'] = MockQ(
+            [queries.User(username) for username, _ in statuses],
+            dict(statuses)
+        )
+        _mock_admin(app)
+        apps[host] = app
+    return WSGITransport(apps)
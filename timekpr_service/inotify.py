@@ -0,0 +1,91 @@
+""" Minimal inotify(7) binding, through ctypes """
+
+import ctypes
+import errno
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+_EVENT = struct.Struct("iIII")
+
+# The symbols of the process, libc's among them: ctypes.util.find_library()
+# would run ldconfig at import time
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+class Watcher(object):
+    """
+    Watches directories for changes:
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> w = Watcher()
+    >>> w.add(d, IN_CLOSE_WRITE | IN_DELETE)
+    >>> open(os.path.join(d, "eric.time"), "w").close()
+    >>> [(path == d, name, mask == IN_CLOSE_WRITE) for path, name, mask in w.read(1)]
+    [(True, 'eric.time', True)]
+    >>> w.read(0)
+    []
+    >>> w.close(); shutil.rmtree(d)
+    """
+
+    def __init__(self):
+        self.fd = _check(_libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK))
+        self.paths = {}
+
+    def add(self, path, mask):
+        wd = _check(_libc.inotify_add_watch(self.fd, path, mask))
+        self.paths[wd] = path
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for events and returns
+        them as a list of (watched path, file name, mask).
+        """
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, _, length) = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((self.paths.get(wd), name, mask))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _check(result):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
@@ -0,0 +1,94 @@
+""" Values made on first use, and made again once they are stale.
+
+    PerProcess holds a value that must not cross a fork, such as a pool of
+    threads: threads don't survive a fork, and gunicorn forks its workers
+    after loading the application.
+
+    SignatureCache holds values built from files, such as the index of the
+    account databases: each is built again only when the stat signature of
+    its files changes. Readers only take the lock when it does.
+"""
+
+import os
+from threading import Lock
+
+
+class PerProcess(object):
+    """
+    The value of factory(), made on first use in each process.
+
+    >>> made = []
+    >>> pool = PerProcess(lambda: made.append(1) or len(made))
+    >>> pool.get(), pool.get()
+    (1, 1)
+    >>> pool.pid = -1  # as in a forked child
+    >>> pool.get()
+    2
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.value = None
+        self.pid = None
+        self.lock = Lock()
+
+    def get(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.value = self.factory()
+                    self.pid = os.getpid()
+        return self.value
+
+
+class SignatureCache(object):
+    """
+    The value of build(signature(*key), *key) for each key, built again
+    only when signature(*key) changes.
+
+    >>> import tempfile
+    >>> f = tempfile.mktemp()
+    >>> reads = []
+    >>> cache = SignatureCache(lambda f: stat_signature([f]),
+    ...                        lambda signature, f: reads.append(f) or len(reads))
+    >>> cache.get(f), cache.get(f)
+    (1, 1)
+    >>> open(f, "w").close()
+    >>> cache.get(f), cache.get(f)
+    (2, 2)
+    >>> os.remove(f)
+    """
+
+    def __init__(self, signature, build):
+        self.signature = signature
+        self.build = build
+        # {key: (signature, value)}
+        self.entries = {}
+        self.lock = Lock()
+
+    def get(self, *key):
+        signature = self.signature(*key)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != signature:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None or entry[0] != signature:
+                    entry = (signature, self.build(signature, *key))
+                    self.entries[key] = entry
+        return entry[1]
+
+
+def stat_signature(paths):
+    """
+    A cheap fingerprint of a set of files; it changes whenever one of them
+    is modified, replaced, created or removed.
+    """
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            signature.append(None)
+        else:
+            signature.append((st.st_ino, st.st_size, st.st_mtime))
+    return tuple(signature)
@@ -0,0 +1,191 @@
+""" Counters and histograms, exposed in the Prometheus text format.
+
+    Metrics live in the process that records them: behind gunicorn, each
+    worker serves its own.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from timeit import default_timer
+from types import GeneratorType
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+
+
+class Counter(object):
+    """
+    >>> c = Counter("test_total", "Tests", ("result",), register=False)
+    >>> c.inc("ok"); c.inc("ok"); c.inc("failed")
+    >>> print(c.exposition())
+    # HELP test_total Tests
+    # TYPE test_total counter
+    test_total{result="failed"} 1
+    test_total{result="ok"} 2
+    """
+    type = "counter"
+
+    def __init__(self, name, help, labels=(), register=True):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+        if register:
+            _metrics.append(self)
+
+    def inc(self, *labelvalues, **kwargs):
+        amount = kwargs.get("amount", 1)
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for labelvalues, value in values:
+            yield self.name, self.labels, labelvalues, value
+
+    def exposition(self):
+        return _exposition(self)
+
+
+class Histogram(object):
+    """
+    >>> h = Histogram("test_seconds", "Test time", ("test",), (0.1, 1), register=False)
+    >>> h.observe(0.05, "a"); h.observe(0.5, "a")
+    >>> print(h.exposition())
+    # HELP test_seconds Test time
+    # TYPE test_seconds histogram
+    test_seconds_bucket{test="a",le="0.1"} 1
+    test_seconds_bucket{test="a",le="1"} 2
+    test_seconds_bucket{test="a",le="+Inf"} 2
+    test_seconds_sum{test="a"} 0.55
+    test_seconds_count{test="a"} 2
+    """
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS, register=True):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # {labelvalues: [count per bucket..., count above, sum]}
+        self.values = {}
+        self.lock = Lock()
+        if register:
+            _metrics.append(self)
+
+    def observe(self, value, *labelvalues):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labelvalues)
+            if counts is None:
+                counts = self.values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.observe(default_timer() - start, *labelvalues)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((k, list(v)) for k, v in self.values.items())
+        bounds = [_number(b) for b in self.buckets] + ["+Inf"]
+        labels = self.labels + ("le",)
+        for labelvalues, counts in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield self.name + "_bucket", labels, labelvalues + (bound,), cumulative
+            yield self.name + "_sum", self.labels, labelvalues, counts[-1]
+            yield self.name + "_count", self.labels, labelvalues, cumulative
+
+    def exposition(self):
+        return _exposition(self)
+
+
+def timed(histogram, *labelvalues):
+    """
+    Records the duration of every call of the decorated function. The
+    duration of a generator function runs until the generator is
+    exhausted or closed.
+
+    >>> h = Histogram("calls_seconds", "Calls", ("call",), register=False)
+    >>> @timed(h, "f")
+    ... def f(): pass
+    >>> f(); f()
+    >>> sum(h.values[("f",)][:-1])
+    2
+    >>> @timed(h, "g")
+    ... def g(): yield 1
+    >>> items = g()
+    >>> ("g",) in h.values, list(items), ("g",) in h.values
+    (False, [1], True)
+    """
+    def decorator(f):
+        @wraps(f)
+        def inner(*args, **kwargs):
+            start = default_timer()
+            result = None
+            try:
+                result = f(*args, **kwargs)
+            finally:
+                if not isinstance(result, GeneratorType):
+                    histogram.observe(default_timer() - start, *labelvalues)
+            if isinstance(result, GeneratorType):
+                return _timed_generator(histogram, labelvalues, start, result)
+            return result
+        return inner
+    return decorator
+
+
+def _timed_generator(histogram, labelvalues, start, generator):
+    try:
+        for item in generator:
+            yield item
+    finally:
+        histogram.observe(default_timer() - start, *labelvalues)
+
+
+def exposition():
+    """ The text of every registered metric, for GET /metrics """
+    return "".join(metric.exposition() + "\n" for metric in _metrics)
+
+
+def _exposition(metric):
+    lines = [
+        "# HELP {0} {1}".format(metric.name, metric.help),
+        "# TYPE {0} {1}".format(metric.name, metric.type),
+    ]
+    for name, labels, labelvalues, value in metric.samples():
+        if labels:
+            name += "{" + ",".join(
+                '{0}="{1}"'.format(label, _escape(labelvalue))
+                for label, labelvalue in zip(labels, labelvalues)
+            ) + "}"
+        lines.append("{0} {1}".format(name, _number(value)))
+    return "\n".join(lines)
+
+
+def _number(value):
+    """
+    >>> _number(1), _number(0.25), _number(1.0)
+    ('1', '0.25', '1')
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,137 @@
+""" Runs the blocking queries of a Q backend on a bounded pool of threads.
+
+    With gevent workers (WORKER_CLASS=gevent) every connection is a
+    greenlet, so idle connections such as event streams cost no thread.
+    The queries block in C (file reads, NSS lookups, flock) where gevent
+    can't switch greenlets, so OffloadedQ runs them on native threads:
+    the greenlet of the request waits for the result while the others
+    keep running.
+
+    At most max_pending queries run or wait for a thread at once. Others
+    wait up to max_wait seconds for their turn, then are rejected with
+    Overloaded, answered 503 Service Unavailable, instead of queueing
+    without bound.
+"""
+
+from collections import Iterator
+from threading import Condition
+from timeit import default_timer
+
+from concurrent.futures import ThreadPoolExecutor
+
+from timekpr_service import lazy, metrics
+
+OFFLOAD_WAIT_SECONDS = metrics.Histogram(
+    "timekpr_offload_wait_seconds",
+    "Time queries waited for a thread of the pool",
+    ("query",)
+)
+
+OFFLOAD_REJECTED = metrics.Counter(
+    "timekpr_offload_rejected_total",
+    "Queries rejected because too many were pending",
+    ("query",)
+)
+
+# Queries that wait for events rather than for I/O: they stay on the
+# greenlet, where gevent makes their select() cooperative
+_NOT_OFFLOADED = frozenset(["io_timestatus_changes"])
+
+
+class Overloaded(Exception):
+    pass
+
+
+class OffloadedQ(object):
+    """
+    Runs the io_* queries of q on a pool of threads. Results that are
+    iterators are consumed on the pool.
+
+    >>> from timekpr_service.service import MockQ
+    >>> from timekpr_service import queries
+    >>> q = OffloadedQ(MockQ(
+    ...    [queries.User("eric")],
+    ...    {"eric": queries.TimeStatus(10, False)}
+    ... ), threads=2, max_pending=1, max_wait=0.01)
+    >>> q.io_timestatus("eric")
+    TimeStatus(time=10, locked=False)
+    >>> list(q.io_timestatus_list())
+    [(User(username='eric'), TimeStatus(time=10, locked=False))]
+    >>> q.pending = 1  # a query running on another greenlet
+    >>> q.io_user("eric")
+    Traceback (most recent call last):
+    ...
+    Overloaded: io_user
+    """
+
+    def __init__(self, q, threads=8, max_pending=64, max_wait=1.0):
+        self.q = q
+        self.threads = threads
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.pending = 0
+        self.slots = Condition()
+        self.pool = lazy.PerProcess(lambda: _pool(threads))
+
+    def __getattr__(self, name):
+        attr = getattr(self.q, name)
+        if not name.startswith("io_") or name in _NOT_OFFLOADED:
+            return attr
+
+        def offloaded(*args, **kwargs):
+            return self._run(name, attr, args, kwargs)
+        return offloaded
+
+    def _run(self, name, f, args, kwargs):
+        self._acquire(name)
+        try:
+            queued = default_timer()
+
+            def call():
+                OFFLOAD_WAIT_SECONDS.observe(default_timer() - queued, name)
+                result = f(*args, **kwargs)
+                if isinstance(result, Iterator):
+                    return iter(list(result))
+                return result
+            return self._submit(call)
+        finally:
+            with self.slots:
+                self.pending -= 1
+                self.slots.notify()
+
+    def _acquire(self, name):
+        deadline = default_timer() + self.max_wait
+        with self.slots:
+            while self.pending >= self.max_pending:
+                remaining = deadline - default_timer()
+                if remaining <= 0:
+                    # The client may retry later, or elsewhere
+                    OFFLOAD_REJECTED.inc(name)
+                    raise Overloaded(name)
+                self.slots.wait(remaining)
+            self.pending += 1
+
+    def _submit(self, call):
+        return self.pool.get()(call)
+
+
+def _pool(threads):
+    """
+    A function running call() on one of threads native threads and
+    returning its result. Under gevent, waiting for it only blocks the
+    current greenlet.
+    """
+    try:
+        from gevent import monkey
+        gevent_patched = monkey.is_module_patched("threading")
+    except ImportError:
+        gevent_patched = False
+
+    if gevent_patched:
+        # Once threading is patched, its threads are greenlets
+        from gevent.threadpool import ThreadPool
+        pool = ThreadPool(threads)
+        return lambda call: pool.spawn(call).get()
+
+    executor = ThreadPoolExecutor(threads)
+    return lambda call: executor.submit(call).result()
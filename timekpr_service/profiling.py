@@ -0,0 +1,210 @@
+""" Per-request profiling, as a WSGI middleware.
+
+    A request is profiled when:
+    - profiling is always on (PROFILE=true),
+    - an admin asks for it with an "X-Profile: 1" header and their
+      credentials (HTTP basic authentication),
+    - it is picked by the slow request sampling (PROFILE_SAMPLE_RATE); its
+      profile is then only kept if it took more than PROFILE_SLOW_MS.
+
+    Profiles are written to PROFILE_DIR, one file per request, named after
+    the time, method, path and duration of the request:
+    - with PROFILER=cprofile (default), a pstats file (.prof) of cProfile,
+      to read with `python -m pstats` or convert to a flame graph;
+    - with PROFILER=sample, the stacks of the request thread sampled every
+      millisecond, in the collapsed format of flamegraph.pl (.folded).
+"""
+
+import cProfile
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from logging import getLogger
+from timeit import default_timer
+
+from timekpr_service import auth
+
+log = getLogger(__name__)
+
+HEADER = "HTTP_X_PROFILE"
+
+# Seconds between two samples of the sampling profiler
+SAMPLE_INTERVAL = 0.001
+
+
+class Profiler(object):
+    """
+    Wraps a WSGI application.
+
+    >>> import tempfile, shutil
+    >>> from timekpr_service.service import App
+    >>> d = tempfile.mkdtemp()
+    >>> app = App()
+    >>> app.wsgi_app = Profiler(app.wsgi_app, d, always=True)
+    >>> _ = app.test_client().get("/vocab", buffered=True)
+    >>> [f.split("-", 1)[1].rsplit("-", 1)[0] for f in os.listdir(d)]
+    ['GET-vocab']
+    >>> shutil.rmtree(d)
+    """
+
+    def __init__(self, app, directory, always=False, admins=(), slow_ms=None,
+                 sample_rate=0.0, profiler="cprofile", check=auth.authenticate):
+        self.app = app
+        self.directory = directory
+        self.always = always
+        self.admins = admins
+        self.check = check
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.profiler = {"cprofile": CProfile, "sample": Sampler}[profiler]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __call__(self, environ, start_response):
+        if self.always or self._requested(environ):
+            threshold = None
+        elif self.sample_rate and random.random() < self.sample_rate:
+            threshold = self.slow_ms
+        else:
+            return self.app(environ, start_response)
+
+        profile = self.profiler()
+        start = default_timer()
+        profile.start()
+        try:
+            app_iter = self.app(environ, start_response)
+        finally:
+            profile.stop()
+        return ProfiledIterable(app_iter, profile, lambda: self._done(
+            environ, profile, (default_timer() - start) * 1000, threshold
+        ))
+
+    def _requested(self, environ):
+        return (environ.get(HEADER) == "1"
+                and auth.is_admin(environ.get("HTTP_AUTHORIZATION"), self.admins,
+                              self.check))
+
+    def _done(self, environ, profile, ms, threshold):
+        if threshold is not None and ms < threshold:
+            return
+        name = "{0}-{1}-{2}-{3}ms{4}".format(
+            time.strftime("%Y%m%dT%H%M%S"),
+            environ.get("REQUEST_METHOD", ""),
+            re.sub(r"[^A-Za-z0-9_.]+", "_", environ.get("PATH_INFO", "")).strip("_") or "index",
+            int(ms),
+            profile.extension
+        )
+        f = os.path.join(self.directory, name)
+        try:
+            profile.dump(f)
+        except (IOError, OSError) as e:
+            log.warning("Could not write profile {0}: {1}".format(f, e))
+        else:
+            log.info("Profile of {0} {1} ({2} ms) in {3}".format(
+                environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"), int(ms), f
+            ))
+
+
+class ProfiledIterable(object):
+    """
+    The response body, profiled while it is generated. The profile is
+    written when the server closes the response.
+    """
+
+    def __init__(self, app_iter, profile, done):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.profile = profile
+        self.done = done
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self.profile.start()
+        try:
+            return next(self.iterator)
+        finally:
+            self.profile.stop()
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+        finally:
+            self.done()
+
+
+class CProfile(object):
+    extension = ".prof"
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, f):
+        self.profile.dump_stats(f)
+
+
+class Sampler(object):
+    """
+    Samples the stack of the thread that starts it, from another thread.
+
+    >>> s = Sampler()
+    >>> s.start(); time.sleep(0.05); s.stop()
+    >>> any("sleep" in stack or "<doctest" in stack for stack in s.stacks)
+    True
+    """
+    extension = ".folded"
+
+    def __init__(self):
+        self.stacks = Counter()
+        self.thread_id = None
+        self.running = None
+
+    def start(self):
+        self.thread_id = threading.current_thread().ident
+        # One flag per sampling thread, so that a restart never runs two
+        self.running = threading.Event()
+        self.running.set()
+        sampler = threading.Thread(
+            target=self._run, args=(self.running,), name="profiling.Sampler"
+        )
+        sampler.daemon = True
+        sampler.start()
+
+    def stop(self):
+        self.running.clear()
+
+    def _run(self, running):
+        while running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_folded(frame)] += 1
+            time.sleep(SAMPLE_INTERVAL)
+
+    def dump(self, f):
+        with open(f, "w") as fh:
+            for stack, count in sorted(self.stacks.items()):
+                fh.write("{0} {1}\n".format(stack, count))
+
+
+def _folded(frame):
+    """ The stack of frame, outermost first, as "f1 (file:line);f2 (...)" """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{0} ({1}:{2})".format(
+            code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+        ))
+        frame = frame.f_back
+    return ";".join(reversed(names))
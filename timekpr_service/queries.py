@@ -1,8 +1,16 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+import errno
+import fcntl
 import pwd
 import spwd
 import re
 import timekpr_service.dirs as dirs
+import timekpr_service.inotify as inotify
+import timekpr_service.lazy as lazy
+import timekpr_service.metrics as metrics
+import timekpr_service.tracing as tracing
+import timekpr_service.utmp as utmp
 import os
 from logging import getLogger
 from timekpr import pam
@@ -10,31 +18,70 @@ from timekpr import pam
 User = namedtuple("User", ["username"])
 TimeStatus = namedtuple("TimeStatus", ["time", "locked"])
 
+
+class PreconditionFailed(Exception):
+    """ The precondition of an update did not hold """
+
+# In-process index of the account databases, see _current_user_index()
+UserEntry = namedtuple("UserEntry", ["uid", "normal"])
+UserIndex = namedtuple("UserIndex", ["signature", "users", "entries"])
+
 log = getLogger(__name__)
 
+QUERY_SECONDS = metrics.Histogram(
+    "timekpr_query_duration_seconds",
+    "Time spent in query calls",
+    ("query",)
+)
+PAM_REWRITE_SECONDS = metrics.Histogram(
+    "timekpr_pam_rewrite_duration_seconds",
+    "Time spent rewriting a pam configuration file, lock wait included",
+    ("file",)
+)
+PAM_LOCK_WAIT_SECONDS = metrics.Histogram(
+    "timekpr_pam_lock_wait_seconds",
+    "Time spent waiting for the lock of a pam configuration file",
+    ("file",)
+)
+
 ###############################################################################
 ## Queries
 ###############################################################################
+@metrics.timed(QUERY_SECONDS, "io_user_list")
+@tracing.traced("queries.io_user_list")
 def io_user_list():
     """
     io_user_list() : iter(User)
-    """
-    # Read UID_MIN / UID_MAX variables
-    (uidmin, uidmax) = _read_uid_minmax()
 
-    # Check if the user is normal (not system user)
-    for userinfo in spwd.getspall():
-        if _isnormal(userinfo[0], uidmin, uidmax):
-            yield User(userinfo[0])
+    Users are ordered by username, so a listing can resume after any
+    username (see the pagination of the index).
+    """
+    return iter(_current_user_index().users)
 
 
+@metrics.timed(QUERY_SECONDS, "io_user")
+@tracing.traced("queries.io_user", "username")
 def io_user(username):
-    return next(
-        (user for user in io_user_list()
-         if user.username == username),
-        None
-    )
+    """
+    io_user(username : unicode()) : User() | None
+    """
+    entry = _current_user_index().entries.get(username)
+    if entry and entry.normal:
+        return User(username)
 
+@metrics.timed(QUERY_SECONDS, "io_user_list_version")
+@tracing.traced("queries.io_user_list_version")
+def io_user_list_version():
+    """
+    io_user_list_version() : hashable
+
+    Changes whenever io_user_list() or io_user() may answer differently.
+    """
+    return _accounts_signature()
+
+
+@metrics.timed(QUERY_SECONDS, "io_timestatus")
+@tracing.traced("queries.io_timestatus", "username")
 def io_timestatus(username):
     """
     io_timestatus(username : unicode()) : TimeStatus()
@@ -45,11 +92,7 @@ def io_timestatus(username):
     latef = os.path.join(dirs.WORK_DIR, username + '.late')
 
     if os.path.isfile(timef):
-        with open(timef) as fh:
-            try:
-                time = int(fh.read())
-            except:
-                time = 0
+        time = _read_time(timef)
     else:
         time = 0
 
@@ -64,45 +107,408 @@ def io_timestatus(username):
     )
 
 
-def io_update_timestatus(username, new_time_status):
+@metrics.timed(QUERY_SECONDS, "io_timestatus_version")
+@tracing.traced("queries.io_timestatus_version", "username")
+def io_timestatus_version(username):
     """
-    io_timestatus(username : unicode(), time_status : TimeStatus())
+    io_timestatus_version(username : unicode()) : hashable
+
+    Changes whenever io_timestatus(username) may answer differently.
     """
-    time_status = io_timestatus(username)
+    return lazy.stat_signature([
+        os.path.join(dirs.WORK_DIR, username + ext)
+        for ext in ('.time',) + _LOCK_EXTS
+    ])
 
-    log.debug("old: {}, new {}".format(time_status, new_time_status))
 
-    if new_time_status.locked is not None:
-        time_status = time_status._replace(locked=new_time_status.locked)
+@metrics.timed(QUERY_SECONDS, "io_timestatus_list")
+@tracing.traced("queries.io_timestatus_list")
+def io_timestatus_list():
+    """
+    io_timestatus_list() : iter((User, TimeStatus))
+
+    Reads the time status of every user from a single listing of WORK_DIR.
+    """
+    files = _scan_work_dir()
+    for user in io_user_list():
+        yield user, _timestatus_from_files(
+            user.username, files.get(user.username, ()))
 
-    if new_time_status.time is not None:
-        time_status = time_status._replace(time=new_time_status.time)
+
+@metrics.timed(QUERY_SECONDS, "io_sessions")
+@tracing.traced("queries.io_sessions", "username")
+def io_sessions(username):
+    """
+    io_sessions(username : unicode()) : (utmp.Session(), ...)
+
+    The open login sessions of username, from utmp.
+    """
+    return utmp.sessions_index().get(username, ())
+
+
+@metrics.timed(QUERY_SECONDS, "io_sessions_index")
+@tracing.traced("queries.io_sessions_index")
+def io_sessions_index():
+    """
+    io_sessions_index() : {unicode(): (utmp.Session(), ...)}
+
+    The open login sessions of every user who has one, from utmp.
+    """
+    return utmp.sessions_index()
+
+
+@metrics.timed(QUERY_SECONDS, "io_sessions_version")
+@tracing.traced("queries.io_sessions_version")
+def io_sessions_version():
+    """
+    io_sessions_version() : hashable
+
+    Changes whenever io_sessions() may answer differently, for any user.
+    """
+    return utmp.signature_of()
+
+
+@metrics.timed(QUERY_SECONDS, "io_update_timestatus")
+@tracing.traced("queries.io_update_timestatus", "username")
+def io_update_timestatus(username, new_time_status, precondition=None):
+    """
+    io_update_timestatus(username : unicode(), time_status : TimeStatus(),
+                         precondition : function(hashable) : bool)
+
+    With a precondition, the update is only made if
+    precondition(io_timestatus_version(username)) holds when the update
+    starts; else PreconditionFailed is raised. Updates take the lock of
+    WORK_DIR, so no other update can slip in between.
+    """
+    with _work_dir_lock():
+        if precondition is not None and not precondition(io_timestatus_version(username)):
+            raise PreconditionFailed(username)
+        _update_timestatus(username, new_time_status)
+
+
+def _update_timestatus(username, new_time_status):
+    time_status = _merge_time_status(
+        io_timestatus(username), new_time_status)
 
     _type_check_time_status(time_status)
 
     timef = os.path.join(dirs.WORK_DIR, username + '.time')
     lockf = os.path.join(dirs.WORK_DIR, username + '.lock')
     logoutf =  os.path.join(dirs.WORK_DIR, username + '.logout')
-    latef = os.path.join(dirs.WORK_DIR, username + '.latef')
+    latef = os.path.join(dirs.WORK_DIR, username + '.late')
 
 
     if time_status.locked:
-        with open(lockf, "w") as fh:
-            fh.write("")
-        pam.lockuser(username)
+        _write(lockf, "")
+        pam.lockuser(username, dirs.PAM_ACCESS_CONF)
     else:
         _rm(lockf)
         _rm(logoutf)
         _rm(latef)
-        pam.unlockuser(username)
+        pam.unlockuser(username, dirs.PAM_ACCESS_CONF)
+
+    _write(timef, str(time_status.time))
+
+
+@metrics.timed(QUERY_SECONDS, "io_update_timestatus_list")
+@tracing.traced("queries.io_update_timestatus_list")
+def io_update_timestatus_list(updates):
+    """
+    io_update_timestatus_list(updates : iter((unicode(), TimeStatus())))
+        : [(unicode(), Exception() | None)]
+
+    Applies many updates with a single rewrite of access.conf and one pass
+    of .time writes. Returns the outcome of every update, in order.
 
-    with open(timef, "w") as fh:
-        fh.write(str(time_status.time))
+    The files of each user are written first: a user whose files could not
+    be written keeps them as they were and is left out of access.conf.
+    When access.conf can't be written (or is missing, or has no timekpr
+    section), the files of every user are put back as they were.
+
+    >>> with _mock_work_dir({"ana": TimeStatus(60, False),
+    ...                      "eric": TimeStatus(120, False)}):
+    ...     # .time of eric can't be written, nor access.conf after that
+    ...     os.remove(os.path.join(dirs.WORK_DIR, "eric.time"))
+    ...     os.mkdir(os.path.join(dirs.WORK_DIR, "eric.time"))
+    ...     results = io_update_timestatus_list([
+    ...         ("ana", TimeStatus(10, True)),
+    ...         ("eric", TimeStatus(10, True)),
+    ...     ])
+    ...     print([(username, type(e).__name__) for username, e in results])
+    ...     print(sorted(pam.parseaccessconf(dirs.PAM_ACCESS_CONF)))
+    ...     print(io_timestatus("ana"))
+    ...     os.remove(dirs.PAM_ACCESS_CONF + ".lock")
+    ...     os.mkdir(dirs.PAM_ACCESS_CONF + ".lock")
+    ...     results = io_update_timestatus_list([("ana", TimeStatus(20, False))])
+    ...     print([(username, type(e).__name__) for username, e in results])
+    ...     print(io_timestatus("ana"))
+    [('ana', 'NoneType'), ('eric', 'IOError')]
+    ['ana']
+    TimeStatus(time=10, locked=True)
+    [('ana', 'IOError')]
+    TimeStatus(time=10, locked=True)
+    >>> with _mock_work_dir({"ana": TimeStatus(60, False)}):
+    ...     os.remove(dirs.PAM_ACCESS_CONF)
+    ...     results = io_update_timestatus_list([("ana", TimeStatus(10, True))])
+    ...     print([(username, type(e).__name__) for username, e in results])
+    ...     print(io_timestatus("ana"))
+    ...     _write(dirs.PAM_ACCESS_CONF, "")
+    ...     results = io_update_timestatus_list([("ana", TimeStatus(10, True))])
+    ...     print([(username, str(e).split(" in ")[0]) for username, e in results])
+    ...     print(io_timestatus("ana"))
+    [('ana', 'IOError')]
+    TimeStatus(time=60, locked=False)
+    [('ana', 'Error: Could not find timekpr section')]
+    TimeStatus(time=60, locked=False)
+    """
+    with _work_dir_lock():
+        return _update_timestatus_list(updates)
+
+
+def _update_timestatus_list(updates):
+    time_statuses = OrderedDict()
+    # The status of each user before the batch, to put back on failure
+    previous = {}
+    results = []
+    for username, new_time_status in updates:
+        time_status = time_statuses.get(username)
+        if time_status is None:
+            if username not in previous:
+                exts = _user_exts(username)
+                previous[username] = (exts, _timestatus_from_files(username, exts))
+            time_status = previous[username][1]
+        time_status = _merge_time_status(time_status, new_time_status)
+        try:
+            _type_check_time_status(time_status)
+        except TypeError as e:
+            results.append((username, e))
+            continue
+        time_statuses[username] = time_status
+        results.append((username, None))
+
+    failed = {}
+    for username, time_status in time_statuses.items():
+        try:
+            _write_status_files(username, time_status, previous[username][0])
+        except (IOError, OSError) as e:
+            _restore_status_files(username, *previous[username])
+            failed[username] = e
+
+    written = [username for username in time_statuses if username not in failed]
+    lock = [username for username in written if time_statuses[username].locked]
+    unlock = [username for username in written if not time_statuses[username].locked]
+    try:
+        error = None
+        if not pam.setuserslocked(lock, unlock, dirs.PAM_ACCESS_CONF):
+            error = IOError("Could not write {0}".format(dirs.PAM_ACCESS_CONF))
+    except (IOError, OSError) as e:
+        error = e
+    except SystemExit as e:
+        # pam exits when access.conf has no timekpr section
+        error = IOError(str(e))
+    if error is not None:
+        for username in written:
+            _restore_status_files(username, *previous[username])
+            failed[username] = error
+
+    return [(username, e or failed.get(username)) for username, e in results]
+
+
+def io_timestatus_changes(timeout=None):
+    """
+    io_timestatus_changes(timeout : float()) : iter(set(unicode()))
+
+    Waits for changes with inotify and yields the usernames whose status
+    files in WORK_DIR, or whose line in the timekpr section of access.conf,
+    changed. Yields an empty set when timeout seconds pass without changes.
+    """
+    (access_dir, access_name) = os.path.split(dirs.PAM_ACCESS_CONF)
+    watcher = inotify.Watcher()
+    try:
+        watcher.add(dirs.WORK_DIR, _WATCH_MASK)
+        # access.conf is replaced by a rename, so watch its directory
+        watcher.add(access_dir, _WATCH_MASK)
+        locked = _read_access_locked()
+
+        while True:
+            changed = set()
+            events = watcher.read(timeout)
+            for path, name, mask in events:
+                if path == dirs.WORK_DIR:
+                    (username, ext) = os.path.splitext(name)
+                    if ext in _STATUS_EXTS:
+                        changed.add(username)
+                elif name == access_name:
+                    now_locked = _read_access_locked()
+                    changed |= locked ^ now_locked
+                    locked = now_locked
+            # Events about other files are not worth a keepalive
+            if changed or not events:
+                yield changed
+    finally:
+        watcher.close()
 
 
 ###############################################################################
 ## Internal
 ###############################################################################
+# Any of these files in WORK_DIR means the user is locked out
+_LOCK_EXTS = ('.lock', '.logout', '.late')
+_STATUS_EXTS = frozenset(('.time',) + _LOCK_EXTS)
+_WATCH_MASK = (
+    inotify.IN_CLOSE_WRITE | inotify.IN_CREATE | inotify.IN_DELETE |
+    inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+)
+
+
+def _observe_rewrite(f, waited, elapsed):
+    PAM_LOCK_WAIT_SECONDS.observe(waited, f)
+    PAM_REWRITE_SECONDS.observe(elapsed, f)
+
+pam.rewriteobservers.append(_observe_rewrite)
+
+
+@contextmanager
+def _work_dir_lock():
+    """
+    Serializes the updates of the status files in WORK_DIR, across
+    threads and processes (the flock is per open file). The flock is taken
+    on WORK_DIR itself: a lock file in it would pass for the .lock file of
+    a user, and its writes for changes of that user.
+    """
+    fd = os.open(dirs.WORK_DIR, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the directory releases the lock
+        os.close(fd)
+
+
+def _scan_work_dir():
+    """
+    Groups the status files in WORK_DIR by username:
+    {username: set(['.time', '.lock', ...])}
+    """
+    files = {}
+    try:
+        names = os.listdir(dirs.WORK_DIR)
+    except OSError as e:
+        log.warning("Could not list {0}: {1}".format(dirs.WORK_DIR, e))
+        return files
+
+    for name in names:
+        (username, ext) = os.path.splitext(name)
+        if ext in _STATUS_EXTS:
+            files.setdefault(username, set()).add(ext)
+    return files
+
+
+def _user_exts(username):
+    """
+    The set of the status files of username in WORK_DIR, like
+    _scan_work_dir() but for one user.
+    """
+    return set(
+        ext for ext in _STATUS_EXTS
+        if os.path.isfile(os.path.join(dirs.WORK_DIR, username + ext))
+    )
+
+
+def _write_status_files(username, time_status, exts):
+    """
+    Writes the .time and lock files of username, who has the status files
+    exts. Raises IOError or OSError.
+    """
+    if time_status.locked:
+        if '.lock' not in exts:
+            _write(os.path.join(dirs.WORK_DIR, username + '.lock'), "")
+    else:
+        for ext in _LOCK_EXTS:
+            if ext in exts:
+                _remove(os.path.join(dirs.WORK_DIR, username + ext))
+    _write(os.path.join(dirs.WORK_DIR, username + '.time'), str(time_status.time))
+
+
+def _restore_status_files(username, exts, time_status):
+    """
+    Puts back the status files exts of username, with time_status.time in
+    .time, as well as possible.
+    """
+    try:
+        for ext in _LOCK_EXTS:
+            f = os.path.join(dirs.WORK_DIR, username + ext)
+            if ext not in exts:
+                _remove(f)
+            elif not os.path.isfile(f):
+                _write(f, "")
+        timef = os.path.join(dirs.WORK_DIR, username + '.time')
+        if '.time' in exts:
+            _write(timef, str(time_status.time))
+        else:
+            _remove(timef)
+    except (IOError, OSError) as e:
+        log.warning("Could not restore the files of {0}: {1}".format(username, e))
+
+
+def _timestatus_from_files(username, exts):
+    """
+    Builds the TimeStatus of username from the set of its files in WORK_DIR.
+    """
+    if '.time' in exts:
+        time = _read_time(os.path.join(dirs.WORK_DIR, username + '.time'))
+    else:
+        time = 0
+    locked = any(ext in exts for ext in _LOCK_EXTS)
+    return TimeStatus(time, locked)
+
+
+def _merge_time_status(time_status, new_time_status):
+    """
+    Applies the fields of new_time_status that are not None.
+
+    >>> _merge_time_status(TimeStatus(10, False), TimeStatus(None, True))
+    TimeStatus(time=10, locked=True)
+    """
+    log.debug("old: {}, new {}".format(time_status, new_time_status))
+
+    if new_time_status.locked is not None:
+        time_status = time_status._replace(locked=new_time_status.locked)
+
+    if new_time_status.time is not None:
+        time_status = time_status._replace(time=new_time_status.time)
+
+    return time_status
+
+
+def _read_access_locked():
+    try:
+        return set(pam.parseaccessconf(dirs.PAM_ACCESS_CONF))
+    except (IOError, SystemExit):
+        # Missing file or timekpr section
+        return set()
+
+
+def _read_time(timef):
+    with tracing.span("queries.read", path=timef) as attrs:
+        try:
+            with open(timef) as fh:
+                data = fh.read()
+        except IOError:
+            return 0
+        attrs["bytes"] = len(data)
+    try:
+        return int(data)
+    except ValueError:
+        return 0
+
+
+def _write(f, data):
+    with tracing.span("queries.write", path=f, bytes=len(data)):
+        with open(f, "w") as fh:
+            fh.write(data)
+
+
 def _type_check_time_status(time_status):
     if type(time_status.time) is not int:
         raise TypeError("TimeStatus.time is not an int")
@@ -110,8 +516,93 @@ def _type_check_time_status(time_status):
         raise TypeError("TimeStatus.time is not a boolean")        
 
 
+def _current_user_index():
+    """
+    Returns the user index, rebuilding it if the account databases or
+    login.defs changed since it was built.
+    """
+    return _user_index.get()
+
+
+def _accounts_signature():
+    return lazy.stat_signature([dirs.PASSWD, dirs.SHADOW, dirs.LOGIN_DEFS])
+
+
+def _build_user_index(signature):
+    """
+    Enumerates the account databases once and classifies every user.
+    """
+    # Read UID_MIN / UID_MAX variables
+    (uidmin, uidmax) = _read_uid_minmax()
+
+    users = []
+    entries = {}
+    for (username, uid) in _read_accounts():
+        normal = _isnormal(username, uid, uidmin, uidmax)
+        entries[username] = UserEntry(uid, normal)
+        # Check if the user is normal (not system user)
+        if normal:
+            users.append(User(username))
+
+    users.sort(key=lambda user: user.username)
+
+    log.debug("indexed {} users, {} normal".format(len(entries), len(users)))
+    return UserIndex(signature, tuple(users), entries)
+
+
+_user_index = lazy.SignatureCache(_accounts_signature, _build_user_index)
+
+
+def _read_accounts():
+    """
+    Returns [(username, uid)] of the accounts that have a shadow entry,
+    through NSS or, if dirs.USE_NSS is off, from the dirs.PASSWD and
+    dirs.SHADOW files.
+    """
+    if dirs.USE_NSS:
+        uids = dict((pw[0], pw[2]) for pw in pwd.getpwall())
+        shadowed = [sp[0] for sp in spwd.getspall()]
+    else:
+        uids = dict(
+            (fields[0], int(fields[2])) for fields in _read_colon_file(dirs.PASSWD)
+        )
+        shadowed = [fields[0] for fields in _read_colon_file(dirs.SHADOW)]
+
+    accounts = []
+    for username in shadowed:
+        uid = uids.get(username)
+        if uid is None and dirs.USE_NSS:
+            # Not enumerable through getpwall (e.g. some NSS backends)
+            try:
+                uid = pwd.getpwnam(username)[2]
+            except KeyError:
+                pass
+        if uid is not None:
+            accounts.append((username, uid))
+    return accounts
+
+
+def _read_colon_file(f):
+    """
+    Returns the fields of each entry of a passwd(5) style file.
+    """
+    with open(f) as fh:
+        return [
+            line.rstrip("\n").split(":") for line in fh
+            if line.strip() and not line.startswith("#")
+        ]
+
+
 # Check if it is a regular user, with userid within UID_MIN and UID_MAX.
-def _isnormal(username, uidmin, uidmax):
+def _isnormal(username, userid, uidmin, uidmax):
+    """
+    >>> _isnormal("eric", 1000, 1000, 60000)
+    True
+    >>> _isnormal("daemon", 1, 1000, 60000)
+    False
+    >>> _isnormal("daemon", 1, "ERROR", "ERROR")
+    True
+    """
     # NOTE: Hides active (current admin) user - bug #286529
     if os.getenv('SUDO_USER') and username == os.getenv('SUDO_USER'):
         return False
@@ -120,18 +611,18 @@ def _isnormal(username, uidmin, uidmax):
     if type(uidmin) == type(str()) and uidmin == "ERROR":
         return True
 
-    userid = int(pwd.getpwnam(username)[2])
-    if uidmin <= userid <= uidmax:
+    if uidmin <= int(userid) <= uidmax:
         return True
     else:
         return False
 
-def _read_uid_minmax(f=dirs.LOGIN_DEFS):
+def _read_uid_minmax(f=None):
     # NOTE: If problem with login.defs or variables, show all (system and normal) users -- bug #529770
+    f = f or dirs.LOGIN_DEFS
     try:
         logindefs = open(f)
     except IOError:
-        log.warning("Could not open file {0} -- cannot distinguish normal users from system users. All users will be shown.".format(logindefs))
+        log.warning("Could not open file {0} -- cannot distinguish normal users from system users. All users will be shown.".format(f))
         return ("ERROR", "ERROR")
 
     uidminmax = re.compile('^UID_(?:MIN|MAX)\s+(\d+)', re.M).findall(logindefs.read())
@@ -149,8 +640,41 @@ def _read_uid_minmax(f=dirs.LOGIN_DEFS):
             uidmax = int(uidminmax[0])
         return (uidmin, uidmax)
 
+@contextmanager
+def _mock_work_dir(statuses):
+    """
+    Points dirs to a temporary root holding the status files of statuses
+    ({username: TimeStatus()}) and an access.conf locking the locked ones,
+    for tests.
+    """
+    import shutil
+    import tempfile
+    root = tempfile.mkdtemp()
+    try:
+        dirs.configure(root)
+        os.makedirs(dirs.WORK_DIR)
+        os.makedirs(os.path.dirname(dirs.PAM_ACCESS_CONF))
+        for username, time_status in statuses.items():
+            _write_status_files(username, time_status, set())
+        _write(dirs.PAM_ACCESS_CONF, "## TIMEKPR START\n{0}## TIMEKPR END\n".format("".join(
+            "-:{0}:ALL\n".format(username) for username in sorted(statuses)
+            if statuses[username].locked
+        )))
+        yield root
+    finally:
+        dirs.configure()
+        shutil.rmtree(root)
+
 def _rm(f):
     try:
         os.remove(f)
     except OSError:
         pass
+
+def _remove(f):
+    """ Removes f if it exists; other errors are raised """
+    try:
+        os.remove(f)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
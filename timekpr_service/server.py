@@ -0,0 +1,63 @@
+""" Production server: gunicorn with the application preloaded in the master.
+
+    Workers are forked from a master that already imported and built the
+    application, so they start instantly and share its memory pages.
+
+    Signals to the master (see the gunicorn documentation):
+    HUP  => graceful reload: start new workers, then stop the old ones
+            once they finish their requests
+    USR2 => re-execute the master (to deploy new code), then send
+            WINCH and QUIT to the old master
+    TERM => graceful shutdown
+"""
+
+from gunicorn.app.base import BaseApplication
+
+
+class Server(BaseApplication):
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super(Server, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def options(host, port, workers, threads, keepalive=5, worker_class=None,
+            connections=1000):
+    """
+    >>> sorted(options("127.0.0.1", 5000, 3, 4).items())
+    [('bind', '127.0.0.1:5000'), ('keepalive', 5), ('preload_app', True), ('threads', 4), ('worker_class', 'gthread'), ('workers', 3)]
+    >>> sorted(options("127.0.0.1", 5000, 3, 4, worker_class="gevent").items())
+    [('bind', '127.0.0.1:5000'), ('keepalive', 5), ('preload_app', True), ('worker_class', 'gevent'), ('worker_connections', 1000), ('workers', 3)]
+    """
+    if worker_class == 'gevent':
+        # One greenlet per connection, up to connections per worker
+        concurrency = {
+            'worker_class': 'gevent',
+            'worker_connections': connections,
+        }
+    else:
+        concurrency = {
+            'threads': threads,
+            # Threaded workers keep connections alive, sync workers can't
+            'worker_class': 'gthread' if threads > 1 else 'sync',
+        }
+    return dict(concurrency, **{
+        'bind': "{0}:{1}".format(host, port),
+        'workers': workers,
+        'keepalive': keepalive,
+        'preload_app': True,
+    })
+
+
+def serve(app, host, port, workers, threads, worker_class=None, connections=1000):
+    Server(app, options(
+        host, port, workers, threads, worker_class=worker_class,
+        connections=connections
+    )).run()
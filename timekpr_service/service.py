@@ -1,10 +1,76 @@
-from timekpr_service import queries
-from flask import Flask, url_for, request, jsonify, Response
+from timekpr_service import queries, metrics, tracing, auth, encoding, lazy
+from timekpr_service.offload import Overloaded
+from flask import Flask, url_for, request, jsonify, json, Response, stream_with_context, g, current_app
 from functools import wraps
+from collections import Iterator
+from itertools import dropwhile, imap, islice
+from hashlib import sha1
 from logging import getLogger
+from Queue import Queue, Empty
+from threading import Lock, Thread, current_thread
+from timeit import default_timer
 
 log = getLogger(__name__)
 
+# The JSON-LD context of every document, served at /context
+CONTEXT = {
+    "hydra": "http://www.w3.org/ns/hydra/core#",
+    "operation": "hydra:operation",
+    "method": "hydra:method",
+    "expects": "hydra:expects", 
+    "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
+    "User": "vocab:User",
+    "Index": "vocab:Index",
+    "TimeStatus": "vocab:TimeStatus",
+    "TimeStatusCollection": "vocab:TimeStatusCollection",
+    "user": "vocab:user",
+    "time": "vocab:time",
+    "locked": "vocab:locked",
+    "timestatus": "vocab:timestatus",
+    "timestatuses": "vocab:timestatuses",
+    "Session": "vocab:Session",
+    "sessions": "vocab:sessions",
+    "line": "vocab:line",
+    "remote": "vocab:remote",
+    "login": "vocab:login",
+    "member": "hydra:member",
+    "view": "hydra:view",
+    "next": "hydra:next",
+    "start": "xhtml:start",
+    "xhtml": "http://www.w3.org/1999/xhtml/vocab#",
+}
+
+# How long clients may cache /context and /vocab, in seconds
+STATIC_MAX_AGE = 24 * 60 * 60
+
+# Largest page of the index a client may ask for
+MAX_PAGE_SIZE = 1000
+
+# Streamed responses are sent in chunks of about this many bytes
+STREAM_CHUNK_SIZE = 8 * 1024
+
+HTTP_REQUESTS = metrics.Counter(
+    "timekpr_http_requests_total",
+    "HTTP requests",
+    ("method", "route", "status")
+)
+HTTP_REQUEST_SECONDS = metrics.Histogram(
+    "timekpr_http_request_duration_seconds",
+    "Time spent serving HTTP requests, until the last byte of the body",
+    ("method", "route")
+)
+
+# Number of hosts (as in the Host header) to keep built links for
+MAX_HOSTS = 16
+_links = {}
+
+# {id(q): _ChangeFeed()} of this process, see _change_feed()
+_feeds = lazy.PerProcess(dict)
+_feeds_lock = Lock()
+
+# A change feed without streams stops after this many seconds
+FEED_IDLE_SECONDS = 15
+
 def trace(val):
     log.debug(val)
     return val
@@ -13,39 +79,278 @@ def service_response(f):
     @wraps(f)
     def inner(*args, **kwargs):
         data = f(*args, **kwargs)
-        CONTEXT = {
-            "vocab": url_for("vocab", _external=True) + "#",
-            "hydra": "http://www.w3.org/ns/hydra/core#",
-            "operation": "hydra:operation",
-            "method": "hydra:method",
-            "expects": "hydra:expects", 
-            "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
-            "User": "vocab:User",
-            "Index": "vocab:Index",
-            "TimeStatus": "vocab:TimeStatus",
-            "user": "vocab:user",
-            "time": "vocab:time",
-            "locked": "vocab:locked",
-            "timestatus": "vocab:timestatus",
-            "start": "xhtml:start",
-            "xhtml": "http://www.w3.org/1999/xhtml/vocab#",
-        }
         if data:
-            data['@context'] = CONTEXT
-            data['start'] = url_for("index", _external=True)
-            return jsonify(data)
+            return _encoded(_document(data))
+        else:
+            return Response(status=404)
+    return inner
+
+def streamed_response(f):
+    """
+    Like service_response, but the document is serialized while it is
+    sent: iterators in it (such as a lazy list of users) are only consumed
+    as the response goes out, so the first bytes leave immediately and the
+    document is never held in memory as a whole.
+
+    >>> app = App()
+    >>> app.config['q'] = MockQ([queries.User("eric"), queries.User("ana")], {})
+    >>> c = app.test_client()
+    >>> [u['username'] for u in json.loads(c.get("/").data)['user']]
+    [u'ana', u'eric']
+    >>> page = json.loads(c.get("/?limit=1").data)
+    >>> [u['username'] for u in page['user']], page['view']['next']
+    ([u'ana'], u'http://localhost/?cursor=ana&limit=1')
+    >>> page = json.loads(c.get("/?cursor=ana&limit=1").data)
+    >>> [u['username'] for u in page['user']], 'next' in page['view']
+    ([u'eric'], False)
+    >>> c.get("/?limit=none").status_code
+    400
+    """
+    @wraps(f)
+    def inner(*args, **kwargs):
+        data = f(*args, **kwargs)
+        if isinstance(data, Response):
+            return data
+        elif data and encoding.media_type(request.accept_mimetypes) != encoding.JSON:
+            # Binary encodings need the lengths of the arrays up front
+            return _encoded(_materialized(_document(data)))
+        elif data:
+            chunks = _buffered(_stream_json(_document(data)), STREAM_CHUNK_SIZE)
+            response = Response(
+                stream_with_context(chunks),
+                mimetype=encoding.JSON
+            )
+            response.vary.add("Accept")
+            return response
         else:
             return Response(status=404)
     return inner
 
+def conditional(version, validate=None):
+    """
+    Makes a GET view conditional: its ETag is derived from
+    version(*args, **kwargs), a cheap fingerprint of the state the view
+    reads, so a matching If-None-Match is answered with 304 Not Modified
+    without building the body. validate(*args, **kwargs) checks the
+    request first, returning the response to an invalid one (or None):
+    an invalid request is never Not Modified.
+
+    >>> app = App()
+    >>> app.config['q'] = MockQ(
+    ...    [queries.User("eric")],
+    ...    {"eric": queries.TimeStatus(10, False)}
+    ... )
+    >>> admin = _mock_admin(app)
+    >>> c = app.test_client()
+    >>> etag = c.get("/user/eric/timestatus").headers["ETag"]
+    >>> c.get("/user/eric/timestatus", headers={"If-None-Match": etag}).status_code
+    304
+    >>> c.put("/user/eric/timestatus", data='{"time": 0}', headers=dict(admin, **{"If-Match": '"stale"'})).status_code
+    412
+    >>> c.put("/user/eric/timestatus", data='{"time": 0}', headers=dict(admin, **{"If-Match": "W/" + etag})).status_code
+    412
+    >>> c.put("/user/eric/timestatus", data='{"time": 0}', headers=dict(admin, **{"If-Match": etag})).status_code
+    204
+    >>> c.get("/user/eric/timestatus", headers={"If-None-Match": etag}).status_code
+    200
+    >>> c.get("/?limit=0", headers={"If-None-Match": "*"}).status_code
+    400
+    """
+    def decorator(f):
+        @wraps(f)
+        def inner(*args, **kwargs):
+            if validate is not None:
+                invalid = validate(*args, **kwargs)
+                if invalid is not None:
+                    return invalid
+            etag = _etag(version(*args, **kwargs))
+            # Weak comparison, of any of the encodings of the document
+            matched = encoding.etag_matches(request.if_none_match, etag)
+            if matched is not None:
+                return not_modified(matched)
+            response = f(*args, **kwargs)
+            if response.status_code == 200:
+                response.set_etag(etag)
+                if response.mimetype in encoding.MEDIA_SUFFIXES:
+                    encoding.suffix_etag(
+                        response, encoding.MEDIA_SUFFIXES[response.mimetype])
+            return response
+        return inner
+    return decorator
+
+def admin_required(f):
+    """
+    Answers 401 Unauthorized unless the request carries the HTTP basic
+    credentials of one of the ADMIN_USERS.
+
+    >>> app = App()
+    >>> app.config['q'] = MockQ([queries.User("eric")], {})
+    >>> admin = _mock_admin(app)
+    >>> c = app.test_client()
+    >>> r = c.put("/user/eric/timestatus", data='{"time": 0}')
+    >>> r.status_code, r.headers["WWW-Authenticate"]
+    (401, 'Basic realm="timekpr-service"')
+    >>> c.put("/user/eric/timestatus", data='{"time": 0}', headers=admin).status_code
+    204
+    """
+    @wraps(f)
+    def inner(*args, **kwargs):
+        config = current_app.config
+        if not auth.is_admin(request.headers.get("Authorization"),
+                             config['ADMIN_USERS'], config['AUTH'].check):
+            return unauthorized()
+        return f(*args, **kwargs)
+    return inner
+
+def _etag(version, url=None):
+    """
+    A strong ETag for the document of url (the requested URL by default)
+    at a given state version (the URL is part of it since documents embed
+    links).
+    """
+    return sha1(repr((url or request.url, version))).hexdigest()
+
+def static_response(f):
+    """
+    For views whose document only depends on the host it is served from:
+    the document is serialized once per host, and clients may cache it.
+
+    >>> c = App().test_client()
+    >>> r = c.get("/vocab")
+    >>> r.headers["Cache-Control"]
+    'public, max-age=86400'
+    >>> c.get("/vocab", headers={"If-None-Match": r.headers["ETag"]}).status_code
+    304
+    """
+    bodies = {}
+    @wraps(f)
+    def inner():
+        body = bodies.get(request.url_root)
+        if body is None:
+            body = encoding.dumps(f())
+            _bounded_put(bodies, request.url_root, body)
+        etag = sha1(body).hexdigest()
+        matched = encoding.etag_matches(request.if_none_match, etag)
+        if matched is not None:
+            response = not_modified(matched)
+        else:
+            response = Response(body, mimetype="application/json")
+            response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        return response
+    return inner
+
+def _traced_view(endpoint, view):
+    """
+    Traces a view as a "service.<endpoint>" span.
+    """
+    @wraps(view)
+    def inner(*args, **kwargs):
+        with tracing.span("service." + endpoint, method=request.method,
+                          path=request.path, **kwargs):
+            return view(*args, **kwargs)
+    return inner
+
+def _start_timer():
+    g.start = default_timer()
+
+def _record_request(response):
+    """
+    Counts requests and times them per route.
+
+    >>> c = App().test_client()
+    >>> _ = c.get("/vocab", buffered=True)
+    >>> text = c.get("/metrics").data
+    >>> 'timekpr_http_requests_total{method="GET",route="/vocab",status="200"}' in text
+    True
+    >>> 'timekpr_http_request_duration_seconds_count{method="GET",route="/vocab"}' in text
+    True
+    """
+    start = g.start
+    method = request.method
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_REQUESTS.inc(method, route, str(response.status_code))
+    # Streamed bodies are still being generated, stop when they are sent
+    response.call_on_close(lambda: HTTP_REQUEST_SECONDS.observe(
+        default_timer() - start, method, route
+    ))
+    return response
+
+def _encoded(data):
+    """
+    The response of data, in the media type negotiated with Accept.
+
+    >>> app = App()
+    >>> app.config['q'] = MockQ([queries.User("eric")], {"eric": queries.TimeStatus(10, False)})
+    >>> r = app.test_client().get("/user/eric/timestatus")
+    >>> r.mimetype, r.headers["Vary"], '"time":10' in r.data
+    ('application/json', 'Accept, Accept-Encoding', True)
+    """
+    mimetype = encoding.media_type(request.accept_mimetypes)
+    response = Response(encoding.dumps(data, mimetype), mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
+
+def _document(data):
+    """
+    Makes data a JSON-LD document: links the context and the start.
+    """
+    links = _host_links()
+    data['@context'] = links['context']
+    data['start'] = links['start']
+    return data
+
+def _host_links():
+    """
+    The URLs every document links to, built once per host.
+    """
+    links = _links.get(request.url_root)
+    if links is None:
+        links = {
+            "context": url_for("context", _external=True),
+            "start": url_for("index", _external=True),
+            "vocab": url_for("vocab", _external=True),
+        }
+        _bounded_put(_links, request.url_root, links)
+    return links
+
+def _bounded_put(cache, key, value):
+    # The host comes from the request, don't let clients grow the cache
+    if len(cache) >= MAX_HOSTS:
+        cache.clear()
+    cache[key] = value
+
 def App():
 
     app = Flask(__name__)
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+    app.config['ADMIN_USERS'] = []
+    app.config['AUTH'] = auth.CredentialCache()
+
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.after_request(encoding.compress_response)
+    app.errorhandler(Overloaded)(lambda e: service_unavailable())
+
+    @app.route("/metrics")
+    def metrics_text():
+        return Response(
+            metrics.exposition(),
+            mimetype="text/plain; version=0.0.4"
+        )
+
+    @app.route("/context")
+    @static_response
+    def context():
+        return {
+            "@context": dict(CONTEXT, vocab=_host_links()['vocab'] + "#")
+        }
 
     @app.route("/vocab")
-    @service_response
+    @static_response
     def vocab():
-        return {
+        return _document({
             "hydra:supportedClass": [
                 {
                     "@id": "Index",
@@ -53,6 +358,11 @@ def App():
                         {
                             "@id": "user", 
                             "@type": "hydra:Link"
+                        },
+                        {
+                            "@id": "timestatuses",
+                            "@type": "hydra:Link",
+                            "rdfs:range": "TimeStatusCollection"
                         }
                     ]
                 },
@@ -66,6 +376,31 @@ def App():
                         },
                         {
                             "@id": "username"
+                        },
+                        {
+                            "@id": "sessions",
+                            "rdfs:range": "Session",
+                            "rdfs:comment": "the open login sessions of the user"
+                        }
+                    ]
+                },
+                {
+                    "@id": "Session",
+                    "hydra:supportedProperty": [
+                        {
+                            "@id": "line",
+                            "rdfs:domain": "Session",
+                            "rdfs:comment": "the terminal of the session"
+                        },
+                        {
+                            "@id": "remote",
+                            "rdfs:domain": "Session",
+                            "rdfs:comment": "the remote host or X display, if any"
+                        },
+                        {
+                            "@id": "login",
+                            "rdfs:domain": "Session",
+                            "rdfs:comment": "start of the session, in seconds since the epoch"
                         }
                     ]
                 },
@@ -88,22 +423,89 @@ def App():
                         },
                     ]
                 },
+                {
+                    "@id": "TimeStatusCollection",
+                    "rdfs:subClassOf": "hydra:Collection",
+                    "hydra:supportedProperty": [
+                        {
+                            "@id": "member",
+                            "rdfs:range": "TimeStatus",
+                            "rdfs:comment": "the time status of every user"
+                        }
+                    ]
+                },
                 
                 
             ]
-    }
+    })
+
+    def user_list_version():
+        q = app.config['q']
+        return (q.io_user_list_version(), q.io_sessions_version())
+
+    def timestatus_version(username):
+        q = app.config['q']
+        return (q.io_user_list_version(), q.io_timestatus_version(username))
+
+    def user_version(username):
+        return (timestatus_version(username), app.config['q'].io_sessions_version())
 
     @app.route("/")
-    @service_response
+    @conditional(user_list_version, validate=_invalid_page)
+    @streamed_response
     def index():
-        return _index_data(
+        cursor = request.args.get("cursor")
+        limit = _page_limit(request.args.get("limit"))
+
+        data = _index_data(
             app.config['q'],
             url_for("index", _external=True), 
-            lambda u: url_for("user", username=u.username, _external=True)
+            lambda u: url_for("user", username=u.username, _external=True),
+            cursor,
+            limit,
+            lambda c: url_for("index", cursor=c, limit=limit, _external=True)
+        )
+        data['timestatuses'] = url_for("timestatus_list", _external=True)
+        return data
+
+
+    @app.route("/timestatus")
+    @service_response
+    def timestatus_list():
+        return _timestatus_list_data(
+            app.config['q'],
+            url_for("timestatus_list", _external=True),
+            lambda u: url_for("user", username=u.username, _external=True),
+            lambda u: url_for("timestatus", username=u.username, _external=True)
+        )
+
+
+    @app.route("/timestatus/events")
+    def timestatus_events():
+        feed = _change_feed(app.config['q'])
+        keepalive = app.config.get('EVENTS_KEEPALIVE', 15)
+
+        def stream():
+            for change in feed.changes(keepalive):
+                if change is None:
+                    yield ": keepalive\n\n"
+                    continue
+                (user, timestatus) = change
+                yield _event("timestatus", _document(_map_time_status(
+                    url_for("user", username=user.username, _external=True),
+                    url_for("timestatus", username=user.username, _external=True),
+                    timestatus
+                )))
+
+        return Response(
+            stream_with_context(stream()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"}
         )
 
 
     @app.route("/user/<username>")
+    @conditional(user_version)
     @service_response
     def user(username):
         return _user_data(
@@ -115,6 +517,7 @@ def App():
 
 
     @app.route("/user/<username>/timestatus")
+    @conditional(timestatus_version)
     @service_response
     def timestatus(username):
         q = app.config['q']
@@ -127,13 +530,43 @@ def App():
             )
 
     @app.route("/user/<username>/timestatus", methods=["PUT"])
+    @admin_required
     def put_timestatus(username):
         q = app.config['q']
 
+        # Optimistic concurrency: If-Match carries the ETag of a prior GET.
+        # The backend checks it under the lock of the update, the
+        # precondition may run on a thread of OffloadedQ: no request there
+        precondition = None
+        if request.if_match:
+            (tags, url, list_version) = (request.if_match, request.url, q.io_user_list_version())
+            precondition = lambda version: encoding.etag_matches(
+                tags, _etag((list_version, version), url), weak=False
+            ) is not None
+
         timestatus = _json_to_timestatus(trace(request.get_json(force=True)))
 
-        q.io_update_timestatus(username, timestatus)
-        return no_content()
+        try:
+            q.io_update_timestatus(username, timestatus, precondition)
+        except queries.PreconditionFailed:
+            return precondition_failed()
+        response = no_content()
+        response.set_etag(_etag(timestatus_version(username)))
+        return response
+
+    @app.route("/timestatus", methods=["PUT"])
+    @admin_required
+    def put_timestatus_list():
+        q = app.config['q']
+
+        data = trace(request.get_json(force=True))
+        if not isinstance(data, list):
+            return bad_request("Expected a list of time statuses")
+
+        return jsonify(_put_timestatus_list_data(q, data))
+
+    for endpoint, view in app.view_functions.items():
+        app.view_functions[endpoint] = _traced_view(endpoint, view)
 
     return app
 
@@ -143,16 +576,44 @@ def bad_request(body):
 def no_content():
     return Response(status=204)
 
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+def precondition_failed():
+    return Response(status=412)
+
+def service_unavailable(retry_after=1):
+    """
+    >>> from timekpr_service.offload import OffloadedQ
+    >>> app = App()
+    >>> app.config['q'] = OffloadedQ(MockQ([queries.User("eric")], {}), max_pending=0, max_wait=0)
+    >>> r = app.test_client().get("/user/eric")
+    >>> r.status_code, r.headers["Retry-After"]
+    (503, '1')
+    """
+    response = Response(status=503)
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+def unauthorized():
+    response = Response(status=401)
+    response.www_authenticate.set_basic("timekpr-service")
+    return response
+
 ###############################################################################
 ## Internal
 ###############################################################################
 
 class MockQ(object):
-    def __init__(self, user_list, timestatus):
+    def __init__(self, user_list, timestatus, sessions=None):
         self.data = {
             'user_list': user_list,
-            'timestatus': timestatus
+            'timestatus': timestatus,
+            'sessions': sessions or {}
         }
+        self.changes = Queue()
 
     def io_user(self, username):
         return next(
@@ -162,45 +623,232 @@ class MockQ(object):
         )
 
     def io_user_list(self):
-        return self.data['user_list']
+        return iter(sorted(
+            self.data['user_list'],
+            key=lambda user: user.username
+        ))
 
-    def io_timestatus(self, username):
+    def io_user_list_version(self):
+        return tuple(self.data['user_list'])
+
+    def io_timestatus_version(self, username):
         return self.data['timestatus'].get(username)
 
-    def io_update_timestatus(self, username, timestatus):
-        self.data['timestatus'][username] = timestatus
+    def io_timestatus(self, username):
+        # Like the files backend: no time used and not locked by default
+        return self.data['timestatus'].get(username, queries.TimeStatus(0, False))
+
+    def io_sessions(self, username):
+        return self.data['sessions'].get(username, ())
+
+    def io_sessions_index(self):
+        return dict(self.data['sessions'])
+
+    def io_sessions_version(self):
+        return tuple(sorted(self.data['sessions'].items()))
+
+    def io_timestatus_list(self):
+        for user in self.io_user_list():
+            yield user, self.io_timestatus(user.username)
+
+    def io_update_timestatus(self, username, timestatus, precondition=None):
+        if precondition is not None and not precondition(self.io_timestatus_version(username)):
+            raise queries.PreconditionFailed(username)
+        # Like the other backends: None fields are left as they are
+        self.data['timestatus'][username] = queries._merge_time_status(
+            self.io_timestatus(username), timestatus
+        )
+        self.changes.put(username)
+
+    def io_update_timestatus_list(self, updates):
+        results = []
+        for username, timestatus in updates:
+            self.io_update_timestatus(username, timestatus)
+            results.append((username, None))
+        return results
+
+    def io_timestatus_changes(self, timeout=None):
+        while True:
+            try:
+                yield set([self.changes.get(timeout=timeout)])
+            except Empty:
+                yield set()
 
 
-def _index_data(q, url, user_url_cb):
+def _mock_admin(app, username="admin", password="secret"):
     """
-    >>> q = MockQ([queries.User("eric")], {})
-    
-    >>> _index_data(q, "/", lambda u: "/users/" + u.username)
-    {'@type': 'Index', 'user': [{'username': 'eric', '@id': '/users/eric', '@type': 'User'}]}
+    Makes username, with password, the admin of app without going through
+    PAM. Returns the headers of requests made as that admin.
     """
-    return {
+    app.config['ADMIN_USERS'] = [username]
+    app.config['AUTH'] = auth.CredentialCache(
+        lambda u, p: (u, p) == (username, password)
+    )
+    credentials = "{0}:{1}".format(username, password).encode("base64").strip()
+    return {"Authorization": "Basic " + credentials}
+
+
+def _index_data(q, url, user_url_cb, cursor=None, limit=None, page_url_cb=None):
+    """
+    The index lists the users lazily, in username order. With a limit, it
+    is a page of at most limit users after the cursor username, with a
+    link to the next page built by page_url_cb(cursor).
+
+    >>> q = MockQ([queries.User("eric"), queries.User("ana")], {})
+    >>> data = _index_data(q, "/", lambda u: "/user/" + u.username)
+    >>> data['@type'], data['@id'], list(data['user'])
+    ('Index', '/', [{'username': 'ana', '@id': '/user/ana', '@type': 'User', 'sessions': []}, {'username': 'eric', '@id': '/user/eric', '@type': 'User', 'sessions': []}])
+    >>> page_url = lambda c: "/?cursor={0}".format(c)
+    >>> data = _index_data(q, "/", lambda u: "/user/" + u.username, None, 1, page_url)
+    >>> [u['username'] for u in data['user']], data['view']['next']
+    (['ana'], '/?cursor=ana')
+    >>> data = _index_data(q, "/", lambda u: "/user/" + u.username, "ana", 1, page_url)
+    >>> [u['username'] for u in data['user']], sorted(data['view'].items())
+    (['eric'], [('@id', '/?cursor=ana'), ('@type', 'hydra:PartialCollectionView')])
+    """
+    users = q.io_user_list()
+    if cursor is not None:
+        users = dropwhile(lambda user: user.username <= cursor, users)
+
+    data = {
         "@type": "Index", 
         "@id": url,
-        "user": map(
-            lambda user: _map_user(user_url_cb(user), user),
-            q.io_user_list()
-        )
     }
 
+    if limit is not None:
+        # One more than the page tells if there is a next page
+        users = list(islice(users, limit + 1))
+        view = {
+            "@type": "hydra:PartialCollectionView",
+            "@id": page_url_cb(cursor),
+        }
+        if len(users) > limit:
+            users = users[:limit]
+            view["next"] = page_url_cb(users[-1].username)
+        data["view"] = view
+
+    # One lookup of every session before streaming: a query failing
+    # (e.g. Overloaded) once the body is sent would truncate it
+    sessions = q.io_sessions_index()
+    data["user"] = imap(
+        lambda user: _map_user(user_url_cb(user), user, sessions.get(user.username, ())),
+        iter(users)
+    )
+    return data
+
+
+def _invalid_page():
+    """
+    The answer to a listing request with invalid page arguments, None when
+    they are valid.
+    """
+    try:
+        _page_limit(request.args.get("limit"))
+    except ValueError:
+        return bad_request("limit must be a positive integer")
+
+
+def _page_limit(value):
+    """
+    Parses the limit argument of a paginated listing.
+
+    >>> _page_limit(None), _page_limit("10"), _page_limit("100000")
+    (None, 10, 1000)
+    >>> _page_limit("0")
+    Traceback (most recent call last):
+    ...
+    ValueError: 0
+    """
+    if value is None:
+        return None
+    limit = int(value)
+    if limit < 1:
+        raise ValueError(value)
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def _stream_json(value):
+    """
+    Serializes value like json.dumps, piece by piece: iterators are
+    encoded as arrays, one item at a time.
+
+    >>> ''.join(_stream_json({"b": iter([1, {"c": None}]), "a": "x"}))
+    '{"a":"x","b":[1,{"c":null}]}'
+    """
+    if isinstance(value, dict) and any(
+            isinstance(v, Iterator) for v in value.itervalues()):
+        yield "{"
+        for i, key in enumerate(sorted(value)):
+            yield ("," if i else "") + encoding.dumps(key) + ":"
+            for chunk in _stream_json(value[key]):
+                yield chunk
+        yield "}"
+    elif isinstance(value, Iterator):
+        yield "["
+        for i, item in enumerate(value):
+            if i:
+                yield ","
+            for chunk in _stream_json(item):
+                yield chunk
+        yield "]"
+    else:
+        yield encoding.dumps(value)
+
+
+def _materialized(value):
+    """
+    value with its iterators made lists.
+
+    >>> _materialized({"user": iter([1, 2]), "view": {"next": None}})
+    {'user': [1, 2], 'view': {'next': None}}
+    """
+    if isinstance(value, dict):
+        return dict((k, _materialized(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, Iterator)):
+        return [_materialized(v) for v in value]
+    return value
+
+
+def _buffered(chunks, size):
+    """
+    Joins small chunks so that each write is about size bytes.
+
+    >>> list(_buffered(iter(["a", "b", "cd", "e"]), 2))
+    ['ab', 'cd', 'e']
+    """
+    buf = []
+    length = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield "".join(buf)
+
 
 def _user_data(q, username, user_url, timestatus_url):
     """
+    >>> from timekpr_service.utmp import Session
     >>> q = MockQ(
     ...    [queries.User("eric")], 
-    ...    {"eric": queries.TimeStatus(10, False)}
+    ...    {"eric": queries.TimeStatus(10, False)},
+    ...    {"eric": (Session("tty7", ":0", 1578312000, 100),)}
     ... )
-    >>> _user_data(
+    >>> data = _user_data(
     ...   q,
     ...   "eric",
     ...   "/user/eric",
     ...   "/user/eric/timestatus"
     ... )
-    {'username': 'eric', 'timestatus': {'locked': False, 'operation': [{'@type': 'hydra:CreateResourceOperation', 'method': 'PUT'}], '@id': '/user/eric/timestatus', '@type': 'TimeStatus', 'time': 10}, '@id': '/user/eric', '@type': 'User'}
+    >>> data['@id'], data['@type'], data['username']
+    ('/user/eric', 'User', 'eric')
+    >>> [data['timestatus'][key] for key in ('@id', '@type', 'user', 'time', 'locked')]
+    ['/user/eric/timestatus', 'TimeStatus', '/user/eric', 10, False]
+    >>> [sorted(session.items()) for session in data['sessions']]
+    [[('@type', 'Session'), ('line', 'tty7'), ('login', 1578312000), ('remote', ':0')]]
     >>> _user_data(
     ...   q,
     ...   "nobody", 
@@ -211,7 +859,7 @@ def _user_data(q, username, user_url, timestatus_url):
     """
     user_record = q.io_user(username)
     if user_record:
-        user = _map_user(user_url, user_record)
+        user = _map_user(user_url, user_record, q.io_sessions(user_record.username))
         user['timestatus'] = _map_time_status(
             user_url,
             timestatus_url,
@@ -220,11 +868,227 @@ def _user_data(q, username, user_url, timestatus_url):
         return user
 
 
-def _map_user(url, user):
+def _timestatus_list_data(q, url, user_url_cb, timestatus_url_cb):
+    """
+    >>> q = MockQ(
+    ...    [queries.User("eric"), queries.User("nobody")],
+    ...    {"eric": queries.TimeStatus(10, True)}
+    ... )
+    >>> data = _timestatus_list_data(
+    ...   q,
+    ...   "/timestatus",
+    ...   lambda u: "/user/" + u.username,
+    ...   lambda u: "/user/" + u.username + "/timestatus"
+    ... )
+    >>> data['@type'], data['@id']
+    ('TimeStatusCollection', '/timestatus')
+    >>> [(m['@id'], m['time'], m['locked']) for m in data['member']]
+    [('/user/eric/timestatus', 10, True), ('/user/nobody/timestatus', 0, False)]
+    """
+    return {
+        "@type": "TimeStatusCollection",
+        "@id": url,
+        "member": [
+            _map_time_status(
+                user_url_cb(user),
+                timestatus_url_cb(user),
+                timestatus
+            )
+            for user, timestatus in q.io_timestatus_list()
+        ],
+        "operation": [
+            {
+                "@type": "hydra:Operation",
+                "method": "PUT",
+                "expects": "TimeStatus",
+                "rdfs:comment": "a list of {username, time, locked} updates"
+            }
+        ]
+    }
+
+
+def _put_timestatus_list_data(q, data):
+    """
+    >>> q = MockQ(
+    ...    [queries.User("eric")],
+    ...    {"eric": queries.TimeStatus(10, False)}
+    ... )
+    >>> for result in _put_timestatus_list_data(q, [
+    ...   {"username": "eric", "time": 0, "locked": True},
+    ...   {"username": "nobody", "time": 0},
+    ...   {"time": 0},
+    ... ])["result"]:
+    ...   print(sorted(result.items()))
+    [('status', 204), ('username', 'eric')]
+    [('error', 'unknown user'), ('status', 404), ('username', 'nobody')]
+    [('error', 'missing username'), ('status', 400), ('username', None)]
+    >>> q.io_timestatus("eric")
+    TimeStatus(time=0, locked=True)
+    """
+    results = [None] * len(data)
+    updates = []
+    for i, item in enumerate(data):
+        username = item.get('username') if isinstance(item, dict) else None
+        if not username:
+            results[i] = _update_result(username, 400, "missing username")
+        elif not q.io_user(username):
+            results[i] = _update_result(username, 404, "unknown user")
+        else:
+            updates.append((i, username, _json_to_timestatus(item)))
+
+    outcomes = q.io_update_timestatus_list(
+        [(username, timestatus) for _, username, timestatus in updates]
+    )
+    for (i, username, _), (_, error) in zip(updates, outcomes):
+        if error is None:
+            results[i] = _update_result(username, 204)
+        elif isinstance(error, TypeError):
+            results[i] = _update_result(username, 400, str(error))
+        else:
+            results[i] = _update_result(username, 500, str(error))
+
+    return {"result": results}
+
+
+def _update_result(username, status, error=None):
+    result = {
+        "username": username,
+        "status": status
+    }
+    if error:
+        result["error"] = error
+    return result
+
+
+def _timestatus_changes(q, keepalive):
+    """
+    Yields (User, TimeStatus) as users' time statuses change, and None
+    after keepalive seconds without changes.
+
+    >>> q = MockQ(
+    ...    [queries.User("eric")],
+    ...    {"eric": queries.TimeStatus(10, False)}
+    ... )
+    >>> changes = _timestatus_changes(q, 0.01)
+    >>> next(changes) is None
+    True
+    >>> q.io_update_timestatus("eric", queries.TimeStatus(20, True))
+    >>> next(changes)
+    (User(username='eric'), TimeStatus(time=20, locked=True))
+    """
+    for usernames in q.io_timestatus_changes(keepalive):
+        if not usernames:
+            yield None
+        for username in sorted(usernames):
+            user = q.io_user(username)
+            if user:
+                yield user, q.io_timestatus(username)
+
+
+class _ChangeFeed(object):
+    """
+    Reads the changes of q once for all the event streams of the process:
+    one watcher and one lookup of each changed status, however many
+    clients are connected.
+
+    >>> q = MockQ(
+    ...    [queries.User("eric")],
+    ...    {"eric": queries.TimeStatus(10, False)}
+    ... )
+    >>> feed = _change_feed(q)
+    >>> a, b = feed.changes(0.2), feed.changes(0.2)
+    >>> next(a), next(b)
+    (None, None)
+    >>> q.io_update_timestatus("eric", queries.TimeStatus(20, True))
+    >>> next(a)
+    (User(username='eric'), TimeStatus(time=20, locked=True))
+    >>> next(b)
+    (User(username='eric'), TimeStatus(time=20, locked=True))
+    """
+
+    def __init__(self, q):
+        self.q = q
+        self.subscribers = set()
+        self.lock = Lock()
+        self.thread = None
+
+    def changes(self, keepalive):
+        """
+        Yields (User, TimeStatus) as time statuses change, and None after
+        keepalive seconds without changes.
+        """
+        changes = Queue()
+        with self.lock:
+            self.subscribers.add(changes)
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="service._ChangeFeed")
+                self.thread.daemon = True
+                self.thread.start()
+        try:
+            while True:
+                try:
+                    yield changes.get(timeout=keepalive)
+                except Empty:
+                    yield None
+        finally:
+            with self.lock:
+                self.subscribers.discard(changes)
+
+    def _run(self):
+        try:
+            for change in _timestatus_changes(self.q, FEED_IDLE_SECONDS):
+                with self.lock:
+                    if not self.subscribers:
+                        self.thread = None
+                        return
+                    subscribers = list(self.subscribers)
+                if change is not None:
+                    for changes in subscribers:
+                        changes.put(change)
+        except Exception:
+            log.exception("Reading time status changes failed")
+        finally:
+            with self.lock:
+                # The next stream starts a new thread
+                if self.thread is current_thread():
+                    self.thread = None
+
+
+def _change_feed(q):
+    feeds = _feeds.get()
+    with _feeds_lock:
+        feed = feeds.get(id(q))
+        if feed is None:
+            feed = _ChangeFeed(q)
+            _bounded_put(feeds, id(q), feed)
+        return feed
+
+
+def _event(event, data):
+    """
+    Formats a Server-Sent Event.
+
+    >>> _event("timestatus", {"time": 10})
+    'event: timestatus\\ndata: {"time": 10}\\n\\n'
+    """
+    return "event: {0}\ndata: {1}\n\n".format(event, json.dumps(data))
+
+
+def _map_user(url, user, sessions=()):
     return {
         "@id": url,
         "@type": "User", 
-        "username": user.username
+        "username": user.username,
+        "sessions": [_map_session(session) for session in sessions]
+    }
+
+
+def _map_session(session):
+    return {
+        "@type": "Session",
+        "line": session.line,
+        "remote": session.remote,
+        "login": session.login
     }
 
 
@@ -0,0 +1,388 @@
+""" Q backend keeping the time status of the users in SQLite.
+
+    The users still come from the account databases (through the files
+    backend, queries). Their time and lock state lives in one table, so
+    reading every status is a single indexed query instead of a stat and
+    a read per user.
+
+    Writes go to the timekpr files first (.time and .lock files,
+    access.conf) through the files backend, so that PAM and timekpr see
+    them, then to the database. A status is only stored once its files
+    were written.
+
+    With follow=True, a thread of each process watches the files and
+    imports the users whose files change, e.g. the time timekpr counts.
+
+    python -m timekpr_service.sqlitequeries import PATH  => WORK_DIR to PATH
+    python -m timekpr_service.sqlitequeries export PATH  => PATH to WORK_DIR
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+from logging import getLogger
+
+from timekpr_service import lazy, queries, tracing
+
+log = getLogger(__name__)
+
+# Seconds the follower waits for changes before checking it must stop
+FOLLOW_IDLE_SECONDS = 5.0
+
+# Seconds the follower waits before watching again after an error
+FOLLOW_RETRY_SECONDS = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS timestatus (
+    username TEXT PRIMARY KEY,
+    time INTEGER NOT NULL DEFAULT 0,
+    locked INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS timestatus_locked ON timestatus (locked, username);
+CREATE INDEX IF NOT EXISTS timestatus_time ON timestatus (time);
+"""
+
+_UPSERT = """
+INSERT OR REPLACE INTO timestatus (username, time, locked, version)
+VALUES (?, ?, ?, COALESCE(
+    (SELECT version FROM timestatus WHERE username = ?), 0
+) + 1)
+"""
+
+
+class SQLiteQ(object):
+    """
+    >>> from timekpr_service.service import MockQ
+    >>> files = MockQ(
+    ...    [queries.User("eric"), queries.User("ana")],
+    ...    {"eric": queries.TimeStatus(10, False)}
+    ... )
+    >>> q = SQLiteQ(":memory:", files)
+    >>> q.import_work_dir()
+    2
+    >>> q.io_timestatus("eric"), q.io_timestatus("ana")
+    (TimeStatus(time=10, locked=False), TimeStatus(time=0, locked=False))
+    >>> version = q.io_timestatus_version("eric")
+    >>> q.io_update_timestatus("eric", queries.TimeStatus(None, True))
+    >>> files.io_timestatus("eric"), q.io_timestatus_version("eric") != version
+    (TimeStatus(time=10, locked=True), True)
+    >>> q.io_update_timestatus_list([
+    ...     ("ana", queries.TimeStatus(60, None)),
+    ...     ("eric", queries.TimeStatus("bad", None)),
+    ... ])
+    [('ana', None), ('eric', TypeError('TimeStatus.time is not an int',))]
+    >>> list(q.io_timestatus_list())
+    [(User(username='ana'), TimeStatus(time=60, locked=False)), (User(username='eric'), TimeStatus(time=10, locked=True))]
+    >>> q.io_locked_users()
+    ['eric']
+    """
+
+    def __init__(self, path, files=queries, follow=False):
+        self.path = path
+        self.files = files
+        self.follow = follow
+        self.local = threading.local()
+        self.follower = lazy.PerProcess(self._start_follower)
+        self.stopped = threading.Event()
+
+    def stop(self):
+        """ Stops the follower """
+        self.stopped.set()
+
+    # The users and their sessions come from the files backend
+    def io_user(self, username):
+        return self.files.io_user(username)
+
+    def io_user_list(self):
+        return self.files.io_user_list()
+
+    def io_user_list_version(self):
+        return self.files.io_user_list_version()
+
+    def io_sessions(self, username):
+        return self.files.io_sessions(username)
+
+    def io_sessions_index(self):
+        return self.files.io_sessions_index()
+
+    def io_sessions_version(self):
+        return self.files.io_sessions_version()
+
+    def io_timestatus_changes(self, timeout=None):
+        """
+        The changes of the files, which may have been made by timekpr
+        itself: the statuses of the changed users are imported before they
+        are reported (the follower may not have imported them yet).
+
+        >>> from timekpr_service.service import MockQ
+        >>> files = MockQ([queries.User("eric")], {})
+        >>> q = SQLiteQ(":memory:", files)
+        >>> changes = q.io_timestatus_changes(0.01)
+        >>> files.io_update_timestatus("eric", queries.TimeStatus(60, True))
+        >>> next(changes), q.io_timestatus("eric")
+        (set(['eric']), TimeStatus(time=60, locked=True))
+        """
+        for usernames in self.files.io_timestatus_changes(timeout):
+            if usernames:
+                self._import_users(usernames)
+            yield usernames
+
+    @tracing.traced("sqlite.io_timestatus", "username")
+    def io_timestatus(self, username):
+        row = self._db().execute(
+            "SELECT time, locked FROM timestatus WHERE username = ?",
+            (username,)
+        ).fetchone()
+        return _timestatus(row)
+
+    @tracing.traced("sqlite.io_timestatus_version", "username")
+    def io_timestatus_version(self, username):
+        row = self._db().execute(
+            "SELECT version FROM timestatus WHERE username = ?",
+            (username,)
+        ).fetchone()
+        return row and row[0]
+
+    @tracing.traced("sqlite.io_timestatus_list")
+    def io_timestatus_list(self):
+        """
+        Users without a row have the status of a user without timekpr
+        files: no time used, not locked.
+        """
+        rows = self._db().execute(
+            "SELECT username, time, locked FROM timestatus ORDER BY username"
+        )
+        statuses = dict((row[0], row[1:]) for row in rows)
+        for user in self.io_user_list():
+            yield user, _timestatus(statuses.get(user.username))
+
+    def io_locked_users(self):
+        """ The usernames of the locked users, from the locked index """
+        return [row[0] for row in self._db().execute(
+            "SELECT username FROM timestatus WHERE locked = 1 ORDER BY username"
+        )]
+
+    @tracing.traced("sqlite.io_update_timestatus", "username")
+    def io_update_timestatus(self, username, new_time_status, precondition=None):
+        """
+        The precondition is checked against the version of the row, in the
+        transaction of the update.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if precondition is not None and not precondition(self.io_timestatus_version(username)):
+                raise queries.PreconditionFailed(username)
+            time_status = queries._merge_time_status(
+                self.io_timestatus(username), new_time_status
+            )
+            queries._type_check_time_status(time_status)
+            # Cheaper than a batch of one for the files backend
+            self.files.io_update_timestatus(username, time_status)
+            db.execute(_UPSERT, (username, time_status.time,
+                                 int(time_status.locked), username))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    @tracing.traced("sqlite.io_update_timestatus_list")
+    def io_update_timestatus_list(self, updates):
+        """
+        Applies the updates in one transaction: the merged statuses are
+        exported to the files in one pass, then the ones that were
+        exported are stored.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            merged = {}
+            results = []
+            for username, new_time_status in updates:
+                time_status = merged.get(username) or self.io_timestatus(username)
+                time_status = queries._merge_time_status(time_status, new_time_status)
+                try:
+                    queries._type_check_time_status(time_status)
+                except TypeError as e:
+                    results.append((username, e))
+                    continue
+                merged[username] = time_status
+                results.append((username, None))
+
+            errors = dict(
+                (username, error) for username, error
+                in self.files.io_update_timestatus_list(merged.items())
+                if error is not None
+            )
+            db.executemany(_UPSERT, [
+                (username, ts.time, int(ts.locked), username)
+                for username, ts in merged.items() if username not in errors
+            ])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return [(username, error or errors.get(username))
+                for username, error in results]
+
+    def import_work_dir(self):
+        """
+        Replaces the stored statuses by those of the timekpr files.
+        Returns the number of users stored.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = [
+                (user.username, ts.time, int(ts.locked), user.username)
+                for user, ts in self.files.io_timestatus_list()
+            ]
+            # Versions keep growing, so that no ETag is ever reused
+            db.executemany(_UPSERT, rows)
+            imported = set(row[0] for row in rows)
+            db.executemany("DELETE FROM timestatus WHERE username = ?", [
+                (row[0],) for row in db.execute("SELECT username FROM timestatus").fetchall()
+                if row[0] not in imported
+            ])
+            count = len(rows)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return count
+
+    def _import_users(self, usernames):
+        """
+        Stores the statuses of usernames from the files. The unchanged ones
+        are left alone, their versions (ETags) stay valid.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for username in usernames:
+                if self.files.io_user(username) is None:
+                    db.execute("DELETE FROM timestatus WHERE username = ?", (username,))
+                    continue
+                time_status = self.files.io_timestatus(username)
+                row = db.execute(
+                    "SELECT time, locked FROM timestatus WHERE username = ?",
+                    (username,)
+                ).fetchone()
+                if row is None or _timestatus(row) != time_status:
+                    db.execute(_UPSERT, (username, time_status.time,
+                                         int(time_status.locked), username))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _start_follower(self):
+        thread = threading.Thread(target=self._follow, name="sqlitequeries.follow")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _follow(self):
+        """
+        Imports the users whose files change until stop() is called. Once
+        the watch is in place, every user is imported: changes made before
+        it was are not missed.
+
+        >>> import shutil, tempfile, time
+        >>> from timekpr_service.service import MockQ
+        >>> files = MockQ([queries.User("eric")], {})
+        >>> root = tempfile.mkdtemp()
+        >>> q = SQLiteQ(os.path.join(root, "state.db"), files, follow=True)
+        >>> try:
+        ...     print(q.io_timestatus("eric"))
+        ...     files.io_update_timestatus("eric", queries.TimeStatus(60, True))
+        ...     for _ in range(500):
+        ...         if q.io_timestatus("eric").locked:
+        ...             break
+        ...         time.sleep(0.01)
+        ...     print(q.io_timestatus("eric"))
+        ... finally:
+        ...     # A change wakes it up to stop
+        ...     q.stop(); files.changes.put("eric"); q.follower.get().join()
+        ...     shutil.rmtree(root)
+        TimeStatus(time=0, locked=False)
+        TimeStatus(time=60, locked=True)
+        """
+        synced = False
+        while not self.stopped.is_set():
+            try:
+                for usernames in self.files.io_timestatus_changes(FOLLOW_IDLE_SECONDS):
+                    if self.stopped.is_set():
+                        return
+                    if not synced:
+                        usernames = set(row[0] for row in self._db().execute(
+                            "SELECT username FROM timestatus"
+                        )) | set(user.username for user in self.files.io_user_list())
+                        synced = True
+                    if usernames:
+                        self._import_users(usernames)
+            except Exception:
+                log.exception("Importing the changes of the files failed")
+                self.stopped.wait(FOLLOW_RETRY_SECONDS)
+
+    def export_work_dir(self):
+        """
+        Writes every stored status to the timekpr files.
+        Returns [(username, Exception() | None)].
+        """
+        rows = self._db().execute("SELECT username, time, locked FROM timestatus")
+        return self.files.io_update_timestatus_list([
+            (row[0], _timestatus(row[1:])) for row in rows
+        ])
+
+    def is_empty(self):
+        return self._db().execute("SELECT 1 FROM timestatus LIMIT 1").fetchone() is None
+
+    def _db(self):
+        """
+        The connection of the current thread (and process: connections
+        must not cross a fork).
+        """
+        if self.follow:
+            self.follower.get()
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            # Usernames as str, like pwd returns them
+            db.text_factory = str
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+
+def _timestatus(row):
+    if row is None:
+        return queries.TimeStatus(0, False)
+    return queries.TimeStatus(row[0], bool(row[1]))
+
+
+def main(argv):
+    if len(argv) != 3 or argv[1] not in ("import", "export"):
+        sys.stderr.write(__doc__)
+        return 2
+    q = SQLiteQ(argv[2])
+    if argv[1] == "import":
+        print("imported {0} users".format(q.import_work_dir()))
+    else:
+        errors = [(u, e) for u, e in q.export_work_dir() if e is not None]
+        for username, error in errors:
+            sys.stderr.write("{0}: {1}\n".format(username, error))
+        return int(bool(errors))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
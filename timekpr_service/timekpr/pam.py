@@ -21,12 +21,117 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>
 
+import fcntl
+import os
 import re
-from time import strftime
+import stat
+import tempfile
+import threading
+from time import strftime, time
+
+from timekpr_service import tracing
 
 # TODO: Check/enable/disable to /etc/pam.d/gdm and /etc/pam.d/login
 
+# Time spent waiting for the lock of each file, see lockwaitstats()
+_lockwait = dict()
+_lockwait_mutex = threading.Lock()
+
+# Functions called after each rewriteconf() as observer(f, waited, elapsed):
+# seconds spent waiting for the lock and seconds of the whole rewrite
+rewriteobservers = []
+
 ## COMMON
+def rewriteconf(f, transform):
+    """Rewrites a file atomically while holding an exclusive lock on it
+
+    transform gets the current content of f and returns the new content,
+    or None to leave the file untouched. Writers, in this or any other
+    process, are serialized by an flock on f + '.lock'. The new content is
+    written to a temporary file, synced and renamed over f, so readers
+    never see a truncated or half-written file.
+    Arguments: f (filename), transform (function)
+    Returns True (even if nothing had to change) or False (if no write permission)
+
+    """
+    try:
+        lockfn = open(f + '.lock', 'a')
+    except IOError:
+        return False
+    start = time()
+    waited = 0.0
+    try:
+        with tracing.span("pam.rewriteconf", file=f) as attrs:
+            fcntl.flock(lockfn.fileno(), fcntl.LOCK_EX)
+            waited = time() - start
+            _recordlockwait(f, waited)
+            attrs["waited"] = waited
+
+            fn = open(f, 'r')
+            s = fn.read()
+            fn.close()
+            attrs["bytes_read"] = len(s)
+            m = transform(s)
+            if m is None or m == s:
+                return True
+            attrs["bytes_written"] = len(m)
+            return _replacefile(f, m)
+    finally:
+        # Closing the file releases the lock
+        lockfn.close()
+        for observer in rewriteobservers:
+            observer(f, waited, time() - start)
+
+def _replacefile(f, s):
+    """Replaces f with a file containing s, keeping the mode and owner of f"""
+    d = os.path.dirname(os.path.abspath(f))
+    try:
+        fd, tmp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(f), dir=d)
+    except OSError:
+        return False
+    try:
+        fn = os.fdopen(fd, 'w')
+        fn.write(s)
+        fn.flush()
+        os.fsync(fn.fileno())
+        fn.close()
+        st = os.stat(f)
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        if (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+            os.chown(tmp, st.st_uid, st.st_gid)
+        os.rename(tmp, f)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+    # Make the rename itself durable
+    dfd = os.open(d, os.O_RDONLY)
+    try:
+        os.fsync(dfd)
+    finally:
+        os.close(dfd)
+    return True
+
+def _recordlockwait(f, waited):
+    with _lockwait_mutex:
+        w = _lockwait.setdefault(f, {"count": 0, "total": 0.0, "max": 0.0})
+        w["count"] += 1
+        w["total"] += waited
+        w["max"] = max(w["max"], waited)
+
+def lockwaitstats():
+    """Returns the time spent waiting for the lock of each rewritten file
+
+    Return example:
+    {'/etc/security/access.conf': {'count': 12, 'total': 0.35, 'max': 0.2}}
+    (count = rewrites, total/max = seconds spent waiting for the lock)
+
+    """
+    with _lockwait_mutex:
+        return dict((f, dict(w)) for f, w in _lockwait.items())
+
 def getconfsection(conffile):
     """Returns the content of the timekpr section in a file (access.conf or time.conf)
 
@@ -34,7 +139,17 @@ def getconfsection(conffile):
     Arguments: conffile (string)
 
     """
-    s = open(conffile).read()
+    with tracing.span("pam.getconfsection", file=conffile) as attrs:
+        s = open(conffile).read()
+        attrs["bytes_read"] = len(s)
+        return _confsection(s, conffile).group(1)
+
+def _confsection(s, conffile):
+    """Finds the timekpr section in the content s of conffile
+
+    Returns the match object of the section, group(1) is its content.
+
+    """
     check = re.compile('## TIMEKPR START|## TIMEKPR END').findall(s)
     
     # If the timekpr section lines '## TIMEKPR START' or '## TIMEKPR END' are not
@@ -44,8 +159,7 @@ def getconfsection(conffile):
     elif len(check) != 2:
         exit("Error: Incorrect format of timekpr section in '%s'" % conffile)
     # Otherwise, get and return the content between the section lines.
-    m = re.compile('## TIMEKPR START\n(.*)## TIMEKPR END', re.S).findall(s)
-    return m[0]
+    return re.compile('## TIMEKPR START\n(.*)## TIMEKPR END', re.S).search(s)
 
 ## Read/Write access.conf
 def parseaccessconf(f='/etc/security/access.conf'):
@@ -54,7 +168,14 @@ def parseaccessconf(f='/etc/security/access.conf'):
     Returns a list with the (locked) usernames: ['niania','wawa']
 
     """
-    s = getconfsection(f)
+    with tracing.span("pam.parseaccessconf", file=f) as attrs:
+        s = getconfsection(f)
+        m = _parseaccesssection(s)
+        attrs["lines"] = s.count("\n")
+        attrs["locked"] = len(m)
+        return m
+
+def _parseaccesssection(s):
     m = re.compile('^-:([^:\s]+):ALL$', re.M).findall(s)
     #If no matches (or bad format?), m = []
     return m
@@ -72,6 +193,7 @@ def isuserlocked(u):
         return False
     return True
 
+@tracing.traced("pam.unlockuser", "u", "f")
 def unlockuser(u, f='/etc/security/access.conf'):
     """Removes access.conf line of user (Unblocks)
 
@@ -81,20 +203,13 @@ def unlockuser(u, f='/etc/security/access.conf'):
         False (if no write permission)
 
     """
-    if not isuserlocked(u):
-        return True
-    fn = open(f, 'r')
-    s = fn.read()
-    fn.close()
-    try:
-        fn = open(f, 'w')
-    except IOError:
-        return False
-    m = re.compile('(## TIMEKPR START\n.*)-:' + u + ':ALL\n', re.S).sub('\\1', s)
-    fn.write(m)
-    fn.close()
-    return True
+    def unlock(s):
+        if u not in _parseaccesssection(_confsection(s, f).group(1)):
+            return None
+        return re.compile('(## TIMEKPR START\n.*)-:' + u + ':ALL\n', re.S).sub('\\1', s)
+    return rewriteconf(f, unlock)
 
+@tracing.traced("pam.lockuser", "u", "f")
 def lockuser(u, f='/etc/security/access.conf'):
     """Adds access.conf line of user
 
@@ -103,19 +218,40 @@ def lockuser(u, f='/etc/security/access.conf'):
     Returns True (even if user is already locked) or False
 
     """
-    if isuserlocked(u):
-        return True
-    fn = open(f, 'r')
-    s = fn.read()
-    fn.close()
-    try:
-        fn = open(f, 'w')
-    except IOError:
-        return False
-    m = re.sub('(## TIMEKPR END)', '-:' + u + ':ALL\n\\1', s)
-    fn.write(m)
-    fn.close()
-    return True
+    def lock(s):
+        if u in _parseaccesssection(_confsection(s, f).group(1)):
+            return None
+        return re.sub('(## TIMEKPR END)', '-:' + u + ':ALL\n\\1', s)
+    return rewriteconf(f, lock)
+
+def setuserslocked(lock=(), unlock=(), f='/etc/security/access.conf'):
+    """Locks and unlocks many users with a single rewrite of access.conf
+
+    Arguments: lock (usernames), unlock (usernames)
+    A username in both lists ends up locked.
+    Returns True (even if nothing had to change) or False (if no write permission)
+
+    """
+    def update(s):
+        m = _confsection(s, f)
+        section = m.group(1)
+        locked = set(_parseaccesssection(section))
+
+        remove = (set(unlock) & locked) - set(lock)
+        add = []
+        for u in lock:
+            if u not in locked:
+                locked.add(u)
+                add.append(u)
+        if not remove and not add:
+            return None
+
+        drop = set('-:' + u + ':ALL\n' for u in remove)
+        lines = [l for l in section.splitlines(True) if l not in drop]
+        lines.extend('-:' + u + ':ALL\n' for u in add)
+        return s[:m.start(1)] + ''.join(lines) + s[m.end(1):]
+    with tracing.span("pam.setuserslocked", file=f, lock=len(lock), unlock=len(unlock)):
+        return rewriteconf(f, update)
 
 ## Read/write time.conf
 def hourize(n):
@@ -165,6 +301,7 @@ def mktimeconfline(u, hfrom, hto):
     """
     return '*;*;' + u + ';' + converttimeline(hfrom, hto)
 
+@tracing.traced("pam.adduserlimits", "username", "f")
 def adduserlimits(username, bfrom, bto, f='/etc/security/time.conf'):
     """Adds a line with the username and their from and to time limits in time.conf
 
@@ -172,37 +309,23 @@ def adduserlimits(username, bfrom, bto, f='/etc/security/time.conf'):
     Returns True or False (if no write permission)
 
     """
-    getconfsection(f) #Check if timekpr section exists
     line = mktimeconfline(username, bfrom, bto) + "\n"
-    fn = open(f, 'r')
-    s = fn.read()
-    fn.close()
-    try:
-        fn = open(f, 'w')
-    except IOError:
-        return False
-    m = re.sub('(## TIMEKPR END)', line + '\\1', s)
-    fn.write(m)
-    return True
+    def add(s):
+        _confsection(s, f) #Check if timekpr section exists
+        return re.sub('(## TIMEKPR END)', line + '\\1', s)
+    return rewriteconf(f, add)
 
+@tracing.traced("pam.removeuserlimits", "username", "f")
 def removeuserlimits(username, f='/etc/security/time.conf'):
     """Removes a line with the username in time.conf
 
     Returns True or False (if no write permission)
 
     """
-    getconfsection(f) # Check if timekpr section exists
-    fn = open(f, 'r')
-    s = fn.read()
-    fn.close()
-    try:
-        fn = open(f, 'w')
-    except IOError:
-        return False
-    m = re.compile('(## TIMEKPR START\n.*)\*;\*;' + username + ';[^\n]*\n', re.S).sub('\\1', s)
-    fn.write(m)
-    fn.close()
-    return True
+    def remove(s):
+        _confsection(s, f) # Check if timekpr section exists
+        return re.compile('(## TIMEKPR START\n.*)\*;\*;' + username + ';[^\n]*\n', re.S).sub('\\1', s)
+    return rewriteconf(f, remove)
 
 def isuserlimited(u, f='/etc/security/time.conf'):
     """Checks if user is in time.conf (if account has limited access hours)
@@ -231,47 +354,15 @@ def isuserlimitednow(u, f='/etc/security/time.conf'):
     Returns: True or False (even if user is not in time.conf)
 
     """
-    if not isuserlimited(u):
-        return False
-    s = getconfsection(f)
-    m = re.compile('^\*;\*;' + u + ';(.*)$', re.M).findall(s)
-    today = int(strftime("%w"))
-    hournow = int(strftime("%H"))
-    #If Al (All days):
-    x = re.match('Al(\d\d)00-(\d\d)00', m[0])
-    if x:
-        low = int(x.group(1)) #lowest limit
-        high= int(x.group(2)) #highest limit
-        if low <= hournow < high:
-            return False
-    else:
-        d = re.split(' \| ', m[0])[today]
-        z = re.match('\w\w(\d\d)00-(\d\d)00', d)
-        low = int(z.group(1))
-        high = int(z.group(2))
-        if low <= hournow < high:
-            return False
-    return True
+    import schedule
+    return not schedule.load(f).isallowed(u)
 
 def isuserlimitedtoday(u, f='/etc/security/time.conf'):
     #Argument: username
     #Checks if username has limitations for this day
     #Returns: True or False (even if user is not in time.conf)
-    if not isuserlimited(u):
-        return False
-    s = getconfsection(f)
-    m = re.compile('^\*;\*;' + u + ';(.*)$', re.M).findall(s)
-    today = int(strftime("%w"))
-    #If Al (All days):
-    x = re.match('Al0000-2400', m[0])
-    if x:
-        return False
-    else:
-        day = { 0:"Su", 1:"Mo", 2:"Tu", 3:"We", 4:"Th", 5:"Fr", 6:"Sa" }
-        g = re.compile(day[today] + '0000-2400').search(m[0])
-        if g:
-            return False
-        return True
+    import schedule
+    return schedule.load(f).islimitedtoday(u)
 
 def strint(x):
     #makes '08' into '8' and '10' as '10'
@@ -305,9 +396,12 @@ def parsetimeconf(f='/etc/security/time.conf'):
     [('niania', 'Al0000-2400'), ('wawa', 'Su0700-2200 | Mo0700-2200 | Tu0700-2200 | We0700-2200 | Th0700-2200 | Fr0700-2200 | Sa0900-2200')]
 
     """
-    c = getconfsection(f)
-    utlist = re.compile('^\*;\*;([^;]+);(.*)$', re.M).findall(c)
-    return utlist
+    with tracing.span("pam.parsetimeconf", file=f) as attrs:
+        c = getconfsection(f)
+        utlist = re.compile('^\*;\*;([^;]+);(.*)$', re.M).findall(c)
+        attrs["lines"] = c.count("\n")
+        attrs["users"] = len(utlist)
+        return utlist
 
 def parseutlist(utlist):
     """Parses the list from parsetimeconf()
@@ -374,716 +468,30 @@ def getuserlimits(u):
     return [bf, bt]
 
 
-"""
-
-THESE ARE THE NEW STUFF!!!
-
-"""
-
-
-""" timekprpam
-    It's a Linux-PAM parser optimized for timekpr and time/access pam modules. 
-    In other words, many of the linux-pam capabilities are not supported 
-    (and probably will never be!).
-
-    It can currently parse lines that have a comment "# Added by timekpr" at the
-    end of the line. These lines are called "active recognized lines" in docstrings
-    and comments.
-
-    pyparsing was chosen because it's easier to look at, fix and manipulate
-    (compared to simple regular expressions). However, regular expressions are
-    still used in this module for simpler tasks.
-
-    Classes:
-    pamparser()  => The parser for Linux PAM and general manipulation of
-                    time.conf and access.conf files.
-    timeconf()   => Contains functions specific to time.conf
-    accessconf() => Contains functions specific to access.conf (e.g. lockuser)
-""" 
-
-# More information on pyparsing:
-# - http://www.rexx.com/~dkuhlman/python_201/python_201.html#SECTION007600000000000000000
-# - http://pyparsing.wikispaces.com/message/view/home/7002417
-
-from pyparsing import *
-import re
-import sys
-import dirs
-
 # =============================================================================
-# CLASS: pamparser(type="time.conf", input="file", file="/etc/security/time.conf")
-
-class pamparser():
-    """ The parser for Linux PAM and general manipulation of time.conf and
-        access.conf files.
-        CLASS: pamparser(type="time.conf", input="file", file="/etc/security/time.conf")
-        Arguments:
-            type    => "time.conf" or "access.conf"
-            input   => "file" (default) or "string" (for testing)
-            file    => filename (default is blank - if blank, will use default filenames)
-            string  => text string (default is blank)
-   """
-    def __init__(self, type, input="file", file="", string=""):
-        self.type = type # "time.conf" or "access.conf"
-        self.input = input # "file" or "string"
-        self.file = file
-        self.string = string
-        self.read_input = "" # readInput()
-        self.recognized = list() # active recognized lines, see parseLines()
-        self.unrecognized = list() # active unrecognized lines, see parseLines()
-        self.userdict = dict() # Used for duplicate check and accessconf()
-        self.refresh_input = False # If True, it will rewrite and refresh the input.
-        self.time_conf_by_day_dict = dict() # see time_conf_prettyparser()
-
-        # Set default file location if file is not defined
-        self.defaultfiles = {
-            "time.conf"   : dirs.PAM_TIME_CONF,
-            "access.conf" : dirs.PAM_ACCESS_CONF
-        }
-
-        if input == "file" and not file:
-            self.file = self.defaultfiles[type]
-        elif input == "string" and not string:
-            sys.stderr.write("ERROR: pamparser() init: input is 'string' but text string is empty\n")
-            sys.exit(1)
-
-        # Parse lines and populate self.recognized (list), self.unrecognized, self.userdict
-        self.parseLines()
-
-    # Common
-    # ======
-    def refreshInput(self):
-        """ Will re-read the input and re-parse the lines.
-            See: parseLines()
-        """
-        # WARNING: BEWARE OF EVIL RECURSIONS!
-        self.refresh_input = False
-        if self.input == "string": # If the input is not file
-            self.string = self.new_input # Set new self.string
-        self.parseLines()
-
-    def prepareLine(self, ulist):
-        """ Prepare line for writing/output """
-        if self.type == "access.conf":
-            controldict = { "block": "-", "allow": "+" }
-            access = controldict[ulist[0]]
-            modified = "%s : %s : %s # Added by timekpr" % (access, ulist[1], ulist[2])
-        elif self.type == "time.conf":
-            controldict = { "block": "!", "allow": "" }
-            # TODO: TODO: Make a time.conf line
-            modified = ""
-            # Tip: "!" in time.conf means "do NOT allow during this time span" (in other words, "block")
-        return modified
-
-    def appendLine(self, line):
-        """ Add a line to text from self.read_input.
-            It does not change self.read_input.
-            Arguments:
-                line => the text of line (not the index number)
-            Returns the result
-        """
-        t = self.read_input.split("\n")
-        t.append(line)
-        result = "\n".join(t)
-        #print(result)
-        return result
-
-    def removeLine(self, line):
-        """ Removes a text line from self.read_input.
-            It does not change self.read_input.
-            Arguments:
-                line => the text of line (not the index number)
-            Returns the result
-        """
-        t = self.read_input.split("\n")
-        i = t.index(line)
-        del t[i]
-        result = "\n".join(t)
-        #print(result)
-        return result
-
-    def writeOutput(self, output, tag="OUTPUT"):
-        """ Writes to file or prints output, depending on the
-            input source.
-            Arguments:
-                output => the text of the whole output
-                tag => (useful when input=string) e.g. "OUTPUT"
-                        would be "[OUTPUT]"
-            Returns:
-                True => Operation successful
-                False => Writing to file failed
-        """
-        # If original input was from file
-        if self.input == "file":
-            fr = open(self.file, 'r')
-            source = fr.read()
-            fr.close()
-
-            # If the output is the same as the original input,
-            # don't do anything and return True
-            if source == output:
-                return True
-
-            try:
-                fw = open(self.file, 'w')
-                fw.write(output)
-                fw.close()
-            except IOError:
-                return False
-        # If original input was from text string
-        elif self.input == "string":
-            print("[%s] %s\n" % (tag, output))
-        return True # All done!
-
-    def readInput(self):
-        """ Read input, file contents or string.
-            Sets and returns self.read_input
-        """
-        if self.input == "file":
-            try:
-                f = open(self.file)
-                text = f.read()
-                f.close()
-            except IOError, e:
-                sys.stderr.write("ERROR: pamparser() readInput: %d (%s) Filename: %s\n" % (e.errno, e.strerror, self.file))
-                sys.exit(1)
-            self.read_input = text
-        elif self.input == "string":
-            self.read_input = self.string
-
-        self.new_input = self.read_input
-        return self.read_input
-
-    def precheckLine(self, line):
-        """ Pre-checks the line.
-            Returns:
-                0 = active timekpr-compatible line, with "# Added by timekpr"
-                1 = active line, without "# Added by timekpr"
-                2 = ignore this line
-        """
-        # Ignore whitespace-only, empty and commented lines
-        if re.match("^(?:\s*$|\s*#)", line):
-            return 2
-        # timekpr lines have "# Added by timekpr" in the end
-        if line[-18::] != "# Added by timekpr":
-            return 0
-        return 1
-
-    def getUserDict(self):
-        """ Returns a new user dictionary. Useful for accessconf()
-
-            Arguments:
-                dup_warning => - True (default, prints warning about duplicate lines)
-                               - False (does not print warning about duplicate lines)
-
-            Returns the dictionary, self.userdict, which is "categorized" by user.
-            The structure of self.userdict for:
-            - access.conf: {
-                "user": [
-                    "original line from input",
-                    ["block" or "allow", "user", "origins"]
-                ]
-            }
-
-            - time.conf: {
-                "user": [
-                    "original line from input",
-                    ["user", time span list with block/allow]
-                ]
-            }
-
-            Also see: parseLines()
-        """
-        return self.userdict
-
-    def checkIfDuplicateUserDict(self, user, line, dup_warning=True):
-        """ Check if there are more than one lines for a user in self.userdict.
-            Prints a warning if dup_warning=True (default).
-
-            Results:
-                True  => Duplicate! There is already another line for this user
-                         in self.userdict.
-                False => Not duplicate! This line is unique and the first one
-                         for this user in self.userdict.
-        """
-        if user in self.userdict:
-            if dup_warning:
-                print("""WARNING: checkIfDuplicateUserDict(): User %s has more than one active recognized lines:
-    %s""" % (user, line))
-            return True
-        return False
-
-    def commentLineNewInput(self, lindex):
-        """ Comments a line from self.new_input (NOT self.read_input).
-            This way we can track down changes, write them to output once and
-            refresh the input. Useful for duplicate check in parseLines().
-
-            Notes:
-                * It directly alters self.new_input.
-                * It sets self.refresh_input = True
+# The pyparsing parser lives in pamparser, imported on first use: pyparsing
+# is slow to import and the service only needs the functions above.
 
-            Arguments:
-                lindex => the line index
+def pamparser(*args, **kwargs):
+    """ See pamparser.pamparser
 
-            Doesn't return anything.
-        """
-        t = self.new_input.split("\n")
-        original = t[lindex]
+    Importing the query path of the service must not import pyparsing:
 
-        t[lindex] = "#%s" % (original)
-        self.new_input = "\n".join(t) # Set new self.new_input
-        self.refresh_input = True # Rewrite and refresh the input.
-    
-    def time_conf_by_day_parser(self, parsedlist):
-        """ Pretty-parses the list from tconf_parse.parseString().
-            This helps greatly in order to get allow/block by day.
-            
-            parsedlist[0] = user
-            parsedlist[1] = time limitations
-            
-            prettyparsed:
-            {
-                "Mo": {
-                    "allow": [
-                        [from1, to1], [from2, to2]
-                    ],
-                    "block": [
-                        ["0000", "2400"]
-                    ]
-                }
-                "Tu": ...
-            }
-        """
-        prettyparsed = {
-            "Mo": { "allow": [], "block": []},
-            "Tu": { "allow": [], "block": []},
-            "We": { "allow": [], "block": []},
-            "Th": { "allow": [], "block": []},
-            "Fr": { "allow": [], "block": []},
-            "Sa": { "allow": [], "block": []},
-            "Su": { "allow": [], "block": []},
-        }
-        
-        #print("Pretty parsing: %s %s" % (parsedlist[0], parsedlist[1]))
-        for item in parsedlist[1]:
-            if not item in ["|", "&"]:
-                # Ignore whether it's OR (|) or AND (&)
-                # timekpr will support only "AND"
-                # example of "item": ['block', ['Wd', 'Mo'], ['0000', '2400']]
-                #                item[   0   ,    1[...]   ,    2[0], 2[1]   ]
-
-                # NOTE: For some reason I can't check "item in array". I use "item in tuple(array)"
-                tuple_item = tuple(item[1])
-                ignore_days = list()
-
-                if "Wd" in tuple_item: # WEEKEND DAYS (Sa, Su)
-                    for day in ("Sa", "Su"):
-                        # Repeated days should be ignored (e.g. WdSu = "All weekend days except Sunday")
-                        if not day in tuple_item:
-                            prettyparsed[ day ][ item[0] ].append( [ item[2][0], item[2][1] ] )
-                        else:
-                            ignore_days.append(day)
-
-                if "Wk" in tuple_item: # WEEK DAYS (Mo-Fr)
-                    for day in ("Mo", "Tu", "We", "Th", "Fr"):
-                        # Repeated days should be ignored (e.g. WkFr = "All weekdays except Friday")
-                        if not day in tuple_item:
-                            prettyparsed[ day ][ item[0] ].append( [ item[2][0], item[2][1] ] )
-                        else:
-                            ignore_days.append(day)
-
-                if "Al" in tuple_item: # ALL DAYS
-                    for day in ("Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"):
-                        # Repeated days should be ignored (e.g. AlFr = "All days except Friday")
-                        if not day in tuple_item:
-                            prettyparsed[ day ][ item[0] ].append( [ item[2][0], item[2][1] ] )
-                        else:
-                            ignore_days.append(day)
-
-                # Rest of the days
-                for day in ("Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"):
-                    # FIXME: Ignore "MoMo", which means no day
-                    if day in tuple_item and not day in ignore_days:
-                        prettyparsed[ day ][ item[0] ].append( [ item[2][0], item[2][1] ] )
-
-        return prettyparsed
-
-    def parseLines(self):
-        """ Reads from input and parses lines with the appropriate parser,
-            depending on the type.
-
-            * Creates two lists:
-            - self.recognized: active (uncommented) lines, that are recognized by timekpr.
-            - self.unrecognized: active but unrecognized lines.
-
-            * Also creates a dictionary (self.userdict). This way we can cut
-            down on processing and check for duplicates. See getUserDict() for
-            more info.
-
-            * While it checks for duplicate lines of a user, it also comments
-            the duplicate lines and initiates refreshInput()
-
-            self.recognized (list)     => [original line from file, parsed list]
-            self.unrecognized (list)   => unrecognized lines list
-            self.userdict (dictionary) => see getUserDict()
-
-            * Moreover, it populates a time.conf dictionary ('by day'):
-                self.time_conf_by_day_dict:
-                {
-                "username":
-                    {
-                        "Mo": {
-                            "allow": [
-                                [from1, to1], [from2, to2]
-                            ],
-                            "block": [
-                                ["0000", "2400"]
-                            ]
-                        }
-                        "Tu": ...
-                    }
-                }
-
-            Also see: getUserDict(), precheckLine(), refreshInput()
-        """
-        self.userdict.clear()
-
-        input_list = self.readInput().split("\n")
-        lindex = 0
-        for line in input_list:
-            # line => original line (text string) from input
-            # lindex => line index
-            test = self.precheckLine(line)
-            if test == 1:
-                if self.type == "time.conf":
-                    tconf_parse = self.time_conf_parser()
-                    parsedlist = tconf_parse.parseString(line)
-                    user = parsedlist[0] # Used mainly for duplicate check
-
-                    # Also parse time.conf by day
-                    by_day_parsed_line = self.time_conf_by_day_parser(parsedlist)
-                    #print("User %s, pretty_parsed_line: %s" % (user, pretty_parsed_line))
-                    self.time_conf_by_day_dict[user] = by_day_parsed_line
-
-                elif self.type == "access.conf":
-                    aconf_parse = self.access_conf_parser()
-                    parsedlist = aconf_parse.parseString(line)
-                    user = parsedlist[1] # Used mainly for duplicate check
-
-                # Duplicate check: If the user does not have any other duplicate 
-                # lines, add this line to self.userdict (dictionary).
-                if not self.checkIfDuplicateUserDict(user, line):
-                    self.userdict[user] = [line, parsedlist]
-                    # self.recognized (list) => [original line from file (text string), parsed list (list)]
-                    self.recognized.append([line, parsedlist])
-                else:
-                    self.commentLineNewInput(lindex) # Also sets self.refresh_input = True
-            elif test == 0:
-                # self.unrecognized (list) => unrecognized lines list
-                self.unrecognized.append(line)
-            #elif test == 2: pass # Just ignore it
-            lindex += 1 # Increase lindex + 1
-
-        # WARNING: BEWARE OF EVIL RECURSIONS!
-        if self.refresh_input: # Rewrite and refresh the input.
-            self.writeOutput(self.new_input, "OUTPUT parseLines() refresh input")
-            self.refreshInput()
-
-    def testOutputLines(self):
-        """ Print active lines and unrecognized active lines.
-            Print time.conf 'by day' dictionary
-            Useful for testing purposes.
-        """
-
-        if self.type == "time.conf":
-            # Prefer parsed time.conf by day
-            print("Users: %s" % self.time_conf_by_day_dict.keys())
-            print(self.time_conf_by_day_dict)
-
-        elif self.type == "access.conf":
-            for line in self.recognized:
-                print("%s => %s" % (line[0], line[1]))
-
-        if self.unrecognized:
-            list_string = "\n".join(self.unrecognized)
-            print("\nWARNING: Unrecognized active lines found:\n%s" % (list_string))
-
-    def getParsedActiveLines(self):
-        """ Returns the self.recognized list. See parseLines() for more info. """
-        a = self.recognized
-        return a
-
-    def getUnrecognizedLines(self):
-        """ Prints out a warning if self.unrecognized list is filled.
-            See parseLines() for more info.
-        """
-        if self.unrecognized:
-            list_string = "\n".join(self.unrecognized)
-            print("WARNING: Unrecognized active lines found:\n%s" % (list_string))
-
-    # time.conf
-    # =========
-    # Define grammar:
-    # services;ttys;users;times
-    # ! = NOT, & = AND, | = OR
-    # * = ANY (can be used only once)
-
-    # Defs
-    def tconf_negation_replace(self, s, l, t):
-        """ time.conf pyparsing:
-            replace "!" and "" with "block" and "allow" respectively.
-        """
-        if t[0] == "!":
-            t[0] = "block"
-            return t
-
-    def time_conf_parser(self):
-        """ time.conf parser.
-            Note: Capital-lettered functions are from pyparsing.
-        """
-        # Common
-        tconf_commonops = "&|" # AND/OR
-        # Ignore the first two ";"-separated items (services;ttys;users)
-        tconf_start = Suppress(Regex("(?:[^;]*;){2}"))
-        # Users
-        tconf_users = Regex("[^;]*")
-        tconf_users.setParseAction(self.strip_whitespace)
-        # Split character ";"
-        tconf_splitchar = Suppress(Word(";"))
-        # Negation
-        tconf_negation = Optional("!", "allow") # block (with "!") or allow (without "!")
-        tconf_negation.setParseAction(self.tconf_negation_replace)
-        # Days of week (Note: Wk = Week [Mo-Fr], Wd = Weekend-days [Sa-Su], Al = All days)
-        daysofweek = Group(OneOrMore(Literal("Mo") | Literal("Tu") | Literal("We") | Literal("Th") | Literal("Fr") | Literal("Sa") | Literal("Su") | Literal("Wk") | Literal("Wd") | Literal("Al")))
-        # Get the timeofday (4 numbers and "-" and 4 numbers)
-        timeofday = Group(Word(nums,exact=4) + Suppress("-") + Word(nums,exact=4))
-        # Check negation, the days of week and the time of day
-        tconf_time = tconf_negation + daysofweek + timeofday
-        # While checking for & or | too
-        tconf_time_list = Group(tconf_time) + Optional(Word(tconf_commonops))
-        # Do the above all over again once or more times
-        tconf_parse = tconf_start + tconf_users + tconf_splitchar + Group(OneOrMore(tconf_time_list)) + Suppress(Regex("# Added by timekpr")) + LineEnd()
-
-        return tconf_parse
-
-    # access.conf
-    # ===========
-    # Define grammar:
-    # permission (+ or -) : users : origins
-
-    def aconf_action_replace(self, s, l, t):
-        """ access.conf pyparsing:
-            replace "-"/"+" with "block"/"allow" respectively.
-        """
-        if t[0] == "-":
-            t[0] = "block"
-            return t
-        elif t[0] == "+":
-            t[0] = "allow"
-            return t
-
-    def strip_whitespace(self, s, l, t):
-        """ pyparsing: Strip whitespace characters."""
-        stripped = t[0].strip()
-        return stripped
-
-    def access_conf_parser(self):
-        """ access.conf parser.
-            Note: Capital-lettered functions are from pyparsing.
-        """
-        # Split character ":"
-        aconf_splitchar = Suppress(Word(":"))
-        # Permission/Access control: "+" or "-", 1 character only
-        aconf_permission = Word("-+", exact=1)
-        aconf_permission.setParseAction(self.aconf_action_replace)
-        # Users - alphanumeric and one of "_*() " characters
-        aconf_users = Word(alphanums + "_*() ")
-        aconf_users.setParseAction(self.strip_whitespace)
-        # Origins - everything else excluding "# Added by timekpr"
-        aconf_origins = Regex("[^#]+")
-        aconf_origins.setParseAction(self.strip_whitespace)
-        aconf_parse = aconf_permission + aconf_splitchar + aconf_users + aconf_splitchar + aconf_origins
-
-        return aconf_parse
-
-# =============================================================================
-# CLASS: timeconf()
-
-class timeconf():
-    """ Functions specific to time.conf
-        Arguments:
-            input    => "file" (default) or "string" (for testing)
-            file     => filename (default is /etc/security/time.conf)
-            string   => text string (default is blank)        
+    >>> import subprocess, sys
+    >>> subprocess.check_output([sys.executable, "-c",
+    ...     "import sys, timekpr_service.queries; print('pyparsing' in sys.modules)"
+    ... ], cwd=os.path.join(os.path.dirname(__file__), "..", "..")).strip()
+    'False'
     """
-    def __init__(self, input="file", file=dirs.PAM_TIME_CONF, string=""):
-        self.input = input
-        self.file = file
-        self.string = string
-
-        if input == "string" and not string:
-            sys.stderr.write("ERROR: timeconf() init: input is 'string' but text string is empty\n")
-            sys.exit(1)
-
-        self.parser = pamparser(type="time.conf", input="string", string=self.string)
-
-    def test(self):
-        pass
-
-# =============================================================================
-# CLASS: accessconf()
-
-class accessconf():
-    """ Functions specific to access.conf
-        Arguments:
-            input    => "file" (default) or "string" (for testing)
-            file     => filename (default is /etc/security/access.conf)
-            string   => text string (default is blank)
-    """
-    def __init__(self, input="file", file=dirs.PAM_ACCESS_CONF, string=""):
-        self.input = input
-        self.file = file
-        self.string = string
-
-        if input == "string" and not string:
-            sys.stderr.write("ERROR: accessconf() init: input is 'string' but text string is empty\n")
-            sys.exit(1)
-
-        self.parser = pamparser(type="access.conf", input="string", string=self.string)
-        self.userdict = self.parser.getUserDict() # get a user dictionary
-
-    def isuserlocked(self, user):
-        """ Checks if user is blocked by access.conf
-            Arguments: user  => username
-            Returns:
-                True  => locked
-                False => not locked
-        """
-        if user in self.userdict: # if user is in access.conf
-            ulist = self.userdict[user][1] # Get parsed content
-            if ulist[0] == "block": # if user has "block"
-                result = True
-            else: # has "allow"
-                result = False
-        else: # if user is not in access.conf
-            result = False
-
-        #z = dict({False: "not locked", True: "locked"})
-        #print("User: %s Status: %s" % (user, z[result]))
-        return result
-
-    def unlockuser(self, user):
-        """ Removes access.conf line of user (Unblocks user)
-            Arguments: username
-            Returns the result of writeOutput():
-                True => if unlocked - even if user was already not listed (unlocked)
-                False => if writeOutput() failed
-        """
-        # If user is not locked
-        if not self.isuserlocked(user):
-            return True
-
-        loriginal = self.userdict[user][0]  # Get original line
-        output = self.parser.removeLine(loriginal) # Remove that line
-        result = self.parser.writeOutput(output) # Write to output
-
-        # TODO: Should it refresh readInput()?
-        return result
-
-    def lockuser(self, user):
-        """ Adds access.conf line of user (Blocks user)
-            Arguments: username
-            Returns the result of writeOutput():
-                True => if locked - even if user was already locked
-                False => if writeOutput() failed
-        """
-        # If user is locked
-        if self.isuserlocked(user):
-            return True
-
-        ulist = ["block", user, "ALL"] # Prepare access data
-        line = self.parser.prepareLine(ulist) # Prepare the line
-        output = self.parser.appendLine(line) # Add a line
-        result = self.parser.writeOutput(output, "OUTPUT lockuser()") # Write to output
-
-        return result
-
-    def test(self):
-        #print("getUserDict(): %s" % (str(self.getUserDict())))
-        #print("isuserlocked(): User lala, result: %d" % (self.isuserlocked("lala")))
-        #print("unlockuser(): User lala, result: %s" % (self.unlockuser("lala")))
-        #print("lockuser(): User papoutsosiko, result: %s" % (self.lockuser("papoutsosiko")))
-        #print("accessconf() test: All done!")
-        pass
-
-# =============================================================================
-# VARIOUS TESTS
-# =============================================================================
-
-def class_accessconf_test(t):
-    """ Test class accessconf() """
-    accessconf(input="string", string=t).test()
-
-def class_timeconf_test(t):
-    """ Test class timeconf() """
-    timeconf(input="string", string=t).test()
-
-def class_pamparser_test(tconf_test_data, aconf_test_data):
-    """ Test class pamparser() """
-    # A) time.conf
-    print("INFO: - TEST A1 pamparser time.conf (STRING)\n")
-    testA1 = pamparser(type="time.conf", input="string", string=tconf_test_data)
-    testA1.testOutputLines()
-    print("\nINFO: - TEST A2 pamparser time.conf (FILE)\n")
-    testA2 = pamparser(type="time.conf", input="file")
-    testA2.testOutputLines()
-
-    # B) access.conf
-#    print("\nINFO: - TEST B1 pamparser access.conf (STRING)\n")
-#    testB1 = pamparser(type="access.conf", input="string", string=aconf_test_data)
-#    testB1.testOutputLines()
-#    print("\nINFO: - TEST B2 pamparser access.conf (FILE)\n")
-#    testB2 = pamparser(type="access.conf", input="file")
-#    testB2.testOutputLines()
-
-def doctesting():
-    import doctest
-    doctest.testmod()
-
-def main():
-    doctesting()
-
-    #time.conf test data
-    tconf_test_data = """
-#xsh ; ttyp* ; root ; !WeMo1700-2030 | !WeFr0600-0830 # Added by timekpr
-xsh & login ; ttyp* ; ro0_ters;!WdMo0000-2400 # Added by timekpr
-    xsh & login ; ttyp* ; root | moot;!WdMo0200-1500
-xsh & login;ttyp*;kentauros;WdMo0000-2400 | Tu0800-2400 # Added by timekpr
-xsh & login ; ttyp* ; papoutsosiko;!WdMo0700-1500 & !MoWeFr1500-2000 # Added by timekpr
-xsh & login ; ttyp* ; pastourmas;!WdSu0700-1500 & !MoWeFr1500-2000 # Added by timekpr
-a;o; a; e
-      
-
-    """
-
-    # access.conf test data
-    aconf_test_data = """
-# testing # Added by timekpr
-- : lala : ALL # Added by timekpr
-    -:papa4a:ALL # Added by timekpr
-+ : lala : .foo.bar.org # Added by timekpr
-- : nana123_a : ALL # Added by timekpr
-- : testing : ALL # test
-- : testing : ALL EXCEPT root
-+ : john : 2001:4ca0:0:101::1# Added by timekpr
-+ : root : .foo.bar.org  # Added by timekpr
-- : john : 2001:4ca0:0:101::/64 # Added by timekpr
-     """
-
-    class_pamparser_test(tconf_test_data, aconf_test_data)
-    #class_timeconf_test(tconf_test_data)
-    #class_accessconf_test(aconf_test_data)
-
-if __name__ == "__main__":
-    main()
-
+    import pamparser as _pamparser
+    return _pamparser.pamparser(*args, **kwargs)
+
+def timeconf(*args, **kwargs):
+    """ See pamparser.timeconf """
+    import pamparser as _pamparser
+    return _pamparser.timeconf(*args, **kwargs)
+
+def accessconf(*args, **kwargs):
+    """ See pamparser.accessconf """
+    import pamparser as _pamparser
+    return _pamparser.accessconf(*args, **kwargs)
@@ -0,0 +1,817 @@
+""" timekprpam
+    It's a Linux-PAM parser optimized for timekpr and time/access pam modules. 
+    In other words, many of the linux-pam capabilities are not supported 
+    (and probably will never be!).
+
+    It can currently parse lines that have a comment "# Added by timekpr" at the
+    end of the line. These lines are called "active recognized lines" in docstrings
+    and comments.
+
+    pyparsing was chosen because it's easier to look at, fix and manipulate
+    (compared to simple regular expressions). However, regular expressions are
+    still used in this module for simpler tasks.
+
+    Classes:
+    pamparser()  => The parser for Linux PAM and general manipulation of
+                    time.conf and access.conf files.
+    timeconf()   => Contains functions specific to time.conf
+    accessconf() => Contains functions specific to access.conf (e.g. lockuser)
+
+    This module was split out of pam so that only the users of the parser
+    import pyparsing.
+""" 
+
+#    Copyright (C) 2008-2009 Savvas Radevic <vicedar@gmail.com>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# More information on pyparsing:
+# - http://www.rexx.com/~dkuhlman/python_201/python_201.html#SECTION007600000000000000000
+# - http://pyparsing.wikispaces.com/message/view/home/7002417
+
+from pyparsing import *
+import os
+import re
+import sys
+import dirs
+from pam import rewriteconf
+from timekpr_service import tracing
+
+# =============================================================================
+# CLASS: pamparser(type="time.conf", input="file", file="/etc/security/time.conf")
+
+class pamparser():
+    """ The parser for Linux PAM and general manipulation of time.conf and
+        access.conf files.
+        CLASS: pamparser(type="time.conf", input="file", file="/etc/security/time.conf")
+        Arguments:
+            type    => "time.conf" or "access.conf"
+            input   => "file" (default) or "string" (for testing)
+            file    => filename (default is blank - if blank, will use default filenames)
+            string  => text string (default is blank)
+   """
+    def __init__(self, type, input="file", file="", string=""):
+        self.type = type # "time.conf" or "access.conf"
+        self.input = input # "file" or "string"
+        self.file = file
+        self.string = string
+        self.read_input = "" # readInput()
+        self.recognized = list() # active recognized lines, see parseLines()
+        self.unrecognized = list() # active unrecognized lines, see parseLines()
+        self.userdict = dict() # Used for duplicate check and accessconf()
+        self.refresh_input = False # If True, it will rewrite and refresh the input.
+        self.time_conf_by_day_dict = dict() # see time_conf_prettyparser()
+
+        # Set default file location if file is not defined
+        self.defaultfiles = {
+            "time.conf"   : dirs.PAM_TIME_CONF,
+            "access.conf" : dirs.PAM_ACCESS_CONF
+        }
+
+        if input == "file" and not file:
+            self.file = self.defaultfiles[type]
+        elif input == "string" and not string:
+            sys.stderr.write("ERROR: pamparser() init: input is 'string' but text string is empty\n")
+            sys.exit(1)
+
+        # Parse lines and populate self.recognized (list), self.unrecognized, self.userdict
+        self.parseLines()
+
+    # Common
+    # ======
+    def refreshInput(self):
+        """ Will re-read the input and re-parse the lines.
+            See: parseLines()
+        """
+        # WARNING: BEWARE OF EVIL RECURSIONS!
+        self.refresh_input = False
+        if self.input == "string": # If the input is not file
+            self.string = self.new_input # Set new self.string
+        self.parseLines()
+
+    def prepareLine(self, ulist):
+        """ Prepare line for writing/output """
+        if self.type == "access.conf":
+            controldict = { "block": "-", "allow": "+" }
+            access = controldict[ulist[0]]
+            modified = "%s : %s : %s # Added by timekpr" % (access, ulist[1], ulist[2])
+        elif self.type == "time.conf":
+            controldict = { "block": "!", "allow": "" }
+            # TODO: TODO: Make a time.conf line
+            modified = ""
+            # Tip: "!" in time.conf means "do NOT allow during this time span" (in other words, "block")
+        return modified
+
+    def appendLine(self, line, text=None):
+        """ Add a line to text (default: self.read_input).
+            It does not change self.read_input.
+            Arguments:
+                line => the text of line (not the index number)
+            Returns the result
+        """
+        if text is None:
+            text = self.read_input
+        t = text.split("\n")
+        t.append(line)
+        result = "\n".join(t)
+        #print(result)
+        return result
+
+    def removeLine(self, line, text=None):
+        """ Removes a text line from text (default: self.read_input).
+            It does not change self.read_input.
+            Arguments:
+                line => the text of line (not the index number)
+            Returns the result
+        """
+        if text is None:
+            text = self.read_input
+        t = text.split("\n")
+        i = t.index(line)
+        del t[i]
+        result = "\n".join(t)
+        #print(result)
+        return result
+
+    def writeOutput(self, edit, tag="OUTPUT"):
+        """ Writes to file or prints output, depending on the
+            input source.
+            Arguments:
+                edit => function of the current text returning the text of
+                        the whole output, or None to leave it as it is.
+                        With input=file it is applied to the content of the
+                        file read under its lock (see rewriteconf()), so
+                        that concurrent writers don't undo each other's
+                        changes.
+                tag => (useful when input=string) e.g. "OUTPUT"
+                        would be "[OUTPUT]"
+            Returns:
+                True => Operation successful
+                False => Writing to file failed
+        """
+        # If original input was from file
+        if self.input == "file":
+            # If the output is the same as the current content,
+            # rewriteconf() doesn't do anything and returns True
+            return rewriteconf(self.file, edit)
+        # If original input was from text string
+        elif self.input == "string":
+            output = edit(self.read_input)
+            if output is not None:
+                print("[%s] %s\n" % (tag, output))
+        return True # All done!
+
+    def readInput(self):
+        """ Read input, file contents or string.
+            Sets and returns self.read_input
+        """
+        if self.input == "file":
+            try:
+                f = open(self.file)
+                text = f.read()
+                f.close()
+            except IOError, e:
+                sys.stderr.write("ERROR: pamparser() readInput: %d (%s) Filename: %s\n" % (e.errno, e.strerror, self.file))
+                sys.exit(1)
+            self.read_input = text
+        elif self.input == "string":
+            self.read_input = self.string
+
+        self.new_input = self.read_input
+        return self.read_input
+
+    def precheckLine(self, line):
+        """ Pre-checks the line.
+            Returns:
+                0 = active timekpr-compatible line, with "# Added by timekpr"
+                1 = active line, without "# Added by timekpr"
+                2 = ignore this line
+        """
+        # Ignore whitespace-only, empty and commented lines
+        if re.match("^(?:\s*$|\s*#)", line):
+            return 2
+        # timekpr lines have "# Added by timekpr" in the end
+        if line[-18::] != "# Added by timekpr":
+            return 0
+        return 1
+
+    def getUserDict(self):
+        """ Returns a new user dictionary. Useful for accessconf()
+
+            Arguments:
+                dup_warning => - True (default, prints warning about duplicate lines)
+                               - False (does not print warning about duplicate lines)
+
+            Returns the dictionary, self.userdict, which is "categorized" by user.
+            The structure of self.userdict for:
+            - access.conf: {
+                "user": [
+                    "original line from input",
+                    ["block" or "allow", "user", "origins"]
+                ]
+            }
+
+            - time.conf: {
+                "user": [
+                    "original line from input",
+                    ["user", time span list with block/allow]
+                ]
+            }
+
+            Also see: parseLines()
+        """
+        return self.userdict
+
+    def checkIfDuplicateUserDict(self, user, line, dup_warning=True, userdict=None):
+        """ Check if there are more than one lines for a user in userdict
+            (default: self.userdict).
+            Prints a warning if dup_warning=True (default).
+
+            Results:
+                True  => Duplicate! There is already another line for this user
+                         in self.userdict.
+                False => Not duplicate! This line is unique and the first one
+                         for this user in self.userdict.
+        """
+        if userdict is None:
+            userdict = self.userdict
+        if user in userdict:
+            if dup_warning:
+                print("""WARNING: checkIfDuplicateUserDict(): User %s has more than one active recognized lines:
+    %s""" % (user, line))
+            return True
+        return False
+
+    def commentLineNewInput(self, lindex):
+        """ Comments a line from self.new_input (NOT self.read_input).
+            This way we can track down changes, write them to output once and
+            refresh the input. Useful for duplicate check in parseLines().
+
+            Notes:
+                * It directly alters self.new_input.
+                * It sets self.refresh_input = True
+
+            Arguments:
+                lindex => the line index
+
+            Doesn't return anything.
+        """
+        t = self.new_input.split("\n")
+        original = t[lindex]
+
+        t[lindex] = "#%s" % (original)
+        self.new_input = "\n".join(t) # Set new self.new_input
+        self.refresh_input = True # Rewrite and refresh the input.
+    
+    def time_conf_by_day_parser(self, parsedlist):
+        """ Pretty-parses the list from tconf_parse.parseString().
+            This helps greatly in order to get allow/block by day.
+            
+            parsedlist[0] = user
+            parsedlist[1] = time limitations
+            
+            prettyparsed:
+            {
+                "Mo": {
+                    "allow": [
+                        [from1, to1], [from2, to2]
+                    ],
+                    "block": [
+                        ["0000", "2400"]
+                    ]
+                }
+                "Tu": ...
+            }
+        """
+        prettyparsed = {
+            "Mo": { "allow": [], "block": []},
+            "Tu": { "allow": [], "block": []},
+            "We": { "allow": [], "block": []},
+            "Th": { "allow": [], "block": []},
+            "Fr": { "allow": [], "block": []},
+            "Sa": { "allow": [], "block": []},
+            "Su": { "allow": [], "block": []},
+        }
+        
+        #print("Pretty parsing: %s %s" % (parsedlist[0], parsedlist[1]))
+        for item in parsedlist[1]:
+            if not item in ["|", "&"]:
+                # Ignore whether it's OR (|) or AND (&)
+                # timekpr will support only "AND"
+                # example of "item": ['block', ['Wd', 'Mo'], ['0000', '2400']]
+                #                item[   0   ,    1[...]   ,    2[0], 2[1]   ]
+
+                # NOTE: For some reason I can't check "item in array". I use "item in tuple(array)"
+                tuple_item = tuple(item[1])
+                ignore_days = list()
+
+                if "Wd" in tuple_item: # WEEKEND DAYS (Sa, Su)
+                    for day in ("Sa", "Su"):
+                        # Repeated days should be ignored (e.g. WdSu = "All weekend days except Sunday")
+                        if not day in tuple_item:
+                            prettyparsed[ day ][ item[0] ].append( [ item[2][0], item[2][1] ] )
+                        else:
+                            ignore_days.append(day)
+
+                if "Wk" in tuple_item: # WEEK DAYS (Mo-Fr)
+                    for day in ("Mo", "Tu", "We", "Th", "Fr"):
+                        # Repeated days should be ignored (e.g. WkFr = "All weekdays except Friday")
+                        if not day in tuple_item:
+                            prettyparsed[ day ][ item[0] ].append( [ item[2][0], item[2][1] ] )
+                        else:
+                            ignore_days.append(day)
+
+                if "Al" in tuple_item: # ALL DAYS
+                    for day in ("Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"):
+                        # Repeated days should be ignored (e.g. AlFr = "All days except Friday")
+                        if not day in tuple_item:
+                            prettyparsed[ day ][ item[0] ].append( [ item[2][0], item[2][1] ] )
+                        else:
+                            ignore_days.append(day)
+
+                # Rest of the days
+                for day in ("Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"):
+                    # FIXME: Ignore "MoMo", which means no day
+                    if day in tuple_item and not day in ignore_days:
+                        prettyparsed[ day ][ item[0] ].append( [ item[2][0], item[2][1] ] )
+
+        return prettyparsed
+
+    def parseLines(self):
+        """ Reads from input and parses lines with the appropriate parser,
+            depending on the type.
+
+            * Creates two lists:
+            - self.recognized: active (uncommented) lines, that are recognized by timekpr.
+            - self.unrecognized: active but unrecognized lines.
+
+            * Also creates a dictionary (self.userdict). This way we can cut
+            down on processing and check for duplicates. See getUserDict() for
+            more info.
+
+            * While it checks for duplicate lines of a user, it also comments
+            the duplicate lines. Once all lines are parsed, the commented
+            input is written once and becomes the new input; it is not
+            parsed again since the duplicate lines are already skipped.
+
+            self.recognized (list)     => [original line from file, parsed list]
+            self.unrecognized (list)   => unrecognized lines list
+            self.userdict (dictionary) => see getUserDict()
+
+            * Moreover, it populates a time.conf dictionary ('by day'):
+                self.time_conf_by_day_dict:
+                {
+                "username":
+                    {
+                        "Mo": {
+                            "allow": [
+                                [from1, to1], [from2, to2]
+                            ],
+                            "block": [
+                                ["0000", "2400"]
+                            ]
+                        }
+                        "Tu": ...
+                    }
+                }
+
+            Also see: getUserDict(), precheckLine(), refreshInput()
+        """
+        with tracing.span("pam.pamparser.parseLines", type=self.type) as attrs:
+            self._parseLines()
+            attrs["lines"] = len(self.recognized) + len(self.unrecognized)
+
+    def _parseLines(self):
+        """ See parseLines() """
+        self.userdict.clear()
+        (self.recognized, self.unrecognized, userdict,
+         self.time_conf_by_day_dict, duplicates) = self.parseText(self.readInput())
+        self.userdict.update(userdict)
+
+        if duplicates: # Comment the duplicate lines and rewrite the input.
+            self.new_input = self.commentLines(self.read_input, duplicates)
+            self.writeOutput(self.commentDuplicates, "OUTPUT parseLines() refresh input")
+            if self.input == "string":
+                self.string = self.new_input
+            self.read_input = self.new_input
+
+    def commentLines(self, text, lindexes):
+        """ Returns text with the lines of index lindexes commented """
+        input_list = text.split("\n")
+        for lindex in lindexes:
+            input_list[lindex] = "#%s" % (input_list[lindex])
+        return "\n".join(input_list)
+
+    def commentDuplicates(self, text):
+        """ Returns text with the duplicate lines of users commented,
+            or None if there are none.
+        """
+        duplicates = self.parseText(text, dup_warning=False)[4]
+        if duplicates:
+            return self.commentLines(text, duplicates)
+
+    def parseText(self, text, dup_warning=True):
+        """ Parses text, without changing the parser.
+            Returns (recognized, unrecognized, userdict, time_conf_by_day_dict,
+            duplicates: the line indexes of the duplicate lines)
+            See parseLines() for more info.
+        """
+        recognized = list()
+        unrecognized = list()
+        userdict = dict()
+        time_conf_by_day_dict = dict()
+        if self.type == "time.conf":
+            tconf_parse = self.time_conf_parser()
+        elif self.type == "access.conf":
+            aconf_parse = self.access_conf_parser()
+
+        input_list = text.split("\n")
+        duplicates = list() # line indexes of duplicate lines
+        lindex = 0
+        for line in input_list:
+            # line => original line (text string) from input
+            # lindex => line index
+            test = self.precheckLine(line)
+            if test == 1:
+                if self.type == "time.conf":
+                    parsedlist = tconf_parse.parseString(line)
+                    user = parsedlist[0] # Used mainly for duplicate check
+
+                elif self.type == "access.conf":
+                    parsedlist = aconf_parse.parseString(line)
+                    user = parsedlist[1] # Used mainly for duplicate check
+
+                # Duplicate check: If the user does not have any other duplicate 
+                # lines, add this line to userdict (dictionary).
+                if not self.checkIfDuplicateUserDict(user, line, dup_warning, userdict):
+                    userdict[user] = [line, parsedlist]
+                    # recognized (list) => [original line from file (text string), parsed list (list)]
+                    recognized.append([line, parsedlist])
+                    if self.type == "time.conf":
+                        # Also parse time.conf by day
+                        time_conf_by_day_dict[user] = self.time_conf_by_day_parser(parsedlist)
+                else:
+                    duplicates.append(lindex)
+            elif test == 0:
+                # unrecognized (list) => unrecognized lines list
+                unrecognized.append(line)
+            #elif test == 2: pass # Just ignore it
+            lindex += 1 # Increase lindex + 1
+
+        return recognized, unrecognized, userdict, time_conf_by_day_dict, duplicates
+
+    def testOutputLines(self):
+        """ Print active lines and unrecognized active lines.
+            Print time.conf 'by day' dictionary
+            Useful for testing purposes.
+        """
+
+        if self.type == "time.conf":
+            # Prefer parsed time.conf by day
+            print("Users: %s" % self.time_conf_by_day_dict.keys())
+            print(self.time_conf_by_day_dict)
+
+        elif self.type == "access.conf":
+            for line in self.recognized:
+                print("%s => %s" % (line[0], line[1]))
+
+        if self.unrecognized:
+            list_string = "\n".join(self.unrecognized)
+            print("\nWARNING: Unrecognized active lines found:\n%s" % (list_string))
+
+    def getParsedActiveLines(self):
+        """ Returns the self.recognized list. See parseLines() for more info. """
+        a = self.recognized
+        return a
+
+    def getUnrecognizedLines(self):
+        """ Prints out a warning if self.unrecognized list is filled.
+            See parseLines() for more info.
+        """
+        if self.unrecognized:
+            list_string = "\n".join(self.unrecognized)
+            print("WARNING: Unrecognized active lines found:\n%s" % (list_string))
+
+    # time.conf
+    # =========
+    # Define grammar:
+    # services;ttys;users;times
+    # ! = NOT, & = AND, | = OR
+    # * = ANY (can be used only once)
+
+    # Compiled grammars, shared by all instances. See time_conf_parser() and
+    # access_conf_parser().
+    _grammars = dict()
+
+    # Defs
+    @staticmethod
+    def tconf_negation_replace(s, l, t):
+        """ time.conf pyparsing:
+            replace "!" and "" with "block" and "allow" respectively.
+        """
+        if t[0] == "!":
+            t[0] = "block"
+            return t
+
+    def time_conf_parser(self):
+        """ time.conf parser, compiled once per process.
+            Note: Capital-lettered functions are from pyparsing.
+        """
+        if "time.conf" not in pamparser._grammars:
+            pamparser._grammars["time.conf"] = pamparser._time_conf_grammar()
+        return pamparser._grammars["time.conf"]
+
+    @staticmethod
+    def _time_conf_grammar():
+        # Common
+        tconf_commonops = "&|" # AND/OR
+        # Ignore the first two ";"-separated items (services;ttys;users)
+        tconf_start = Suppress(Regex("(?:[^;]*;){2}"))
+        # Users
+        tconf_users = Regex("[^;]*")
+        tconf_users.setParseAction(pamparser.strip_whitespace)
+        # Split character ";"
+        tconf_splitchar = Suppress(Word(";"))
+        # Negation
+        tconf_negation = Optional("!", "allow") # block (with "!") or allow (without "!")
+        tconf_negation.setParseAction(pamparser.tconf_negation_replace)
+        # Days of week (Note: Wk = Week [Mo-Fr], Wd = Weekend-days [Sa-Su], Al = All days)
+        # (oneOf() compiles the alternatives into a single regular expression)
+        daysofweek = Group(OneOrMore(oneOf("Mo Tu We Th Fr Sa Su Wk Wd Al")))
+        # Get the timeofday (4 numbers and "-" and 4 numbers)
+        timeofday = Group(Word(nums,exact=4) + Suppress("-") + Word(nums,exact=4))
+        # Check negation, the days of week and the time of day
+        tconf_time = tconf_negation + daysofweek + timeofday
+        # While checking for & or | too
+        tconf_time_list = Group(tconf_time) + Optional(Word(tconf_commonops))
+        # Do the above all over again once or more times
+        tconf_parse = tconf_start + tconf_users + tconf_splitchar + Group(OneOrMore(tconf_time_list)) + Suppress(Regex("# Added by timekpr")) + LineEnd()
+
+        return tconf_parse
+
+    # access.conf
+    # ===========
+    # Define grammar:
+    # permission (+ or -) : users : origins
+
+    @staticmethod
+    def aconf_action_replace(s, l, t):
+        """ access.conf pyparsing:
+            replace "-"/"+" with "block"/"allow" respectively.
+        """
+        if t[0] == "-":
+            t[0] = "block"
+            return t
+        elif t[0] == "+":
+            t[0] = "allow"
+            return t
+
+    @staticmethod
+    def strip_whitespace(s, l, t):
+        """ pyparsing: Strip whitespace characters."""
+        stripped = t[0].strip()
+        return stripped
+
+    def access_conf_parser(self):
+        """ access.conf parser, compiled once per process.
+            Note: Capital-lettered functions are from pyparsing.
+        """
+        if "access.conf" not in pamparser._grammars:
+            pamparser._grammars["access.conf"] = pamparser._access_conf_grammar()
+        return pamparser._grammars["access.conf"]
+
+    @staticmethod
+    def _access_conf_grammar():
+        # Split character ":"
+        aconf_splitchar = Suppress(Word(":"))
+        # Permission/Access control: "+" or "-", 1 character only
+        aconf_permission = Word("-+", exact=1)
+        aconf_permission.setParseAction(pamparser.aconf_action_replace)
+        # Users - alphanumeric and one of "_*() " characters
+        aconf_users = Word(alphanums + "_*() ")
+        aconf_users.setParseAction(pamparser.strip_whitespace)
+        # Origins - everything else excluding "# Added by timekpr"
+        aconf_origins = Regex("[^#]+")
+        aconf_origins.setParseAction(pamparser.strip_whitespace)
+        aconf_parse = aconf_permission + aconf_splitchar + aconf_users + aconf_splitchar + aconf_origins
+
+        return aconf_parse
+
+# =============================================================================
+# CLASS: timeconf()
+
+class timeconf():
+    """ Functions specific to time.conf
+        Arguments:
+            input    => "file" (default) or "string" (for testing)
+            file     => filename (default is /etc/security/time.conf)
+            string   => text string (default is blank)        
+    """
+    def __init__(self, input="file", file=dirs.PAM_TIME_CONF, string=""):
+        self.input = input
+        self.file = file
+        self.string = string
+
+        if input == "string" and not string:
+            sys.stderr.write("ERROR: timeconf() init: input is 'string' but text string is empty\n")
+            sys.exit(1)
+
+        self.parser = pamparser(type="time.conf", input="string", string=self.string)
+
+    def test(self):
+        pass
+
+# =============================================================================
+# CLASS: accessconf()
+
+class accessconf():
+    """ Functions specific to access.conf
+        Arguments:
+            input    => "file" (default) or "string" (for testing)
+            file     => filename (default is /etc/security/access.conf)
+            string   => text string (default is blank)
+    """
+    def __init__(self, input="file", file="", string=""):
+        self.input = input
+        self.file = file
+        self.string = string
+
+        if input == "string" and not string:
+            sys.stderr.write("ERROR: accessconf() init: input is 'string' but text string is empty\n")
+            sys.exit(1)
+
+        self.parser = pamparser(type="access.conf", input=self.input, file=self.file, string=self.string)
+        self.userdict = self.parser.getUserDict() # get a user dictionary
+
+    def isuserlocked(self, user, userdict=None):
+        """ Checks if user is blocked by access.conf
+            Arguments: user  => username
+                       userdict => of the parser (default: self.userdict)
+            Returns:
+                True  => locked
+                False => not locked
+        """
+        if userdict is None:
+            userdict = self.userdict
+        if user in userdict: # if user is in access.conf
+            ulist = userdict[user][1] # Get parsed content
+            if ulist[0] == "block": # if user has "block"
+                result = True
+            else: # has "allow"
+                result = False
+        else: # if user is not in access.conf
+            result = False
+
+        #z = dict({False: "not locked", True: "locked"})
+        #print("User: %s Status: %s" % (user, z[result]))
+        return result
+
+    def unlockuser(self, user):
+        """ Removes access.conf line of user (Unblocks user)
+            Arguments: username
+            Returns the result of writeOutput():
+                True => if unlocked - even if user was already not listed (unlocked)
+                False => if writeOutput() failed
+        """
+        def unlock(text):
+            # The current text: another writer may have changed it
+            userdict = self.parser.parseText(text, dup_warning=False)[2]
+            # If user is not locked
+            if not self.isuserlocked(user, userdict):
+                return None
+            loriginal = userdict[user][0]  # Get original line
+            return self.parser.removeLine(loriginal, text) # Remove that line
+
+        return self._write(unlock, "OUTPUT unlockuser()")
+
+    def lockuser(self, user):
+        """ Adds access.conf line of user (Blocks user)
+            Arguments: username
+            Returns the result of writeOutput():
+                True => if locked - even if user was already locked
+                False => if writeOutput() failed
+
+            Concurrent writers don't lose each other's changes:
+
+            >>> import tempfile
+            >>> f = tempfile.mktemp()
+            >>> with open(f, "w") as fh:
+            ...     fh.write("- : wawa : ALL # Added by timekpr\\n")
+            >>> (a, b) = (accessconf(file=f), accessconf(file=f))
+            >>> a.lockuser("eric"), b.lockuser("ana"), b.unlockuser("wawa")
+            (True, True, True)
+            >>> sorted(accessconf(file=f).userdict)
+            ['ana', 'eric']
+            >>> a.unlockuser("ana"), sorted(accessconf(file=f).userdict)
+            (True, ['eric'])
+            >>> os.remove(f); os.remove(f + ".lock")
+        """
+        ulist = ["block", user, "ALL"] # Prepare access data
+        line = self.parser.prepareLine(ulist) # Prepare the line
+
+        def lock(text):
+            # The current text: another writer may have changed it
+            userdict = self.parser.parseText(text, dup_warning=False)[2]
+            # If user is locked
+            if self.isuserlocked(user, userdict):
+                return None
+            return self.parser.appendLine(line, text) # Add a line
+
+        return self._write(lock, "OUTPUT lockuser()")
+
+    def _write(self, edit, tag):
+        result = self.parser.writeOutput(edit, tag) # Write to output
+        if result and self.input == "file":
+            # Other writers' changes are in the file too
+            self.parser.parseLines()
+        return result
+
+    def test(self):
+        #print("getUserDict(): %s" % (str(self.getUserDict())))
+        #print("isuserlocked(): User lala, result: %d" % (self.isuserlocked("lala")))
+        #print("unlockuser(): User lala, result: %s" % (self.unlockuser("lala")))
+        #print("lockuser(): User papoutsosiko, result: %s" % (self.lockuser("papoutsosiko")))
+        #print("accessconf() test: All done!")
+        pass
+
+# =============================================================================
+# VARIOUS TESTS
+# =============================================================================
+
+def class_accessconf_test(t):
+    """ Test class accessconf() """
+    accessconf(input="string", string=t).test()
+
+def class_timeconf_test(t):
+    """ Test class timeconf() """
+    timeconf(input="string", string=t).test()
+
+def class_pamparser_test(tconf_test_data, aconf_test_data):
+    """ Test class pamparser() """
+    # A) time.conf
+    print("INFO: - TEST A1 pamparser time.conf (STRING)\n")
+    testA1 = pamparser(type="time.conf", input="string", string=tconf_test_data)
+    testA1.testOutputLines()
+    print("\nINFO: - TEST A2 pamparser time.conf (FILE)\n")
+    testA2 = pamparser(type="time.conf", input="file")
+    testA2.testOutputLines()
+
+    # B) access.conf
+#    print("\nINFO: - TEST B1 pamparser access.conf (STRING)\n")
+#    testB1 = pamparser(type="access.conf", input="string", string=aconf_test_data)
+#    testB1.testOutputLines()
+#    print("\nINFO: - TEST B2 pamparser access.conf (FILE)\n")
+#    testB2 = pamparser(type="access.conf", input="file")
+#    testB2.testOutputLines()
+
+def doctesting():
+    import doctest
+    doctest.testmod()
+
+def main():
+    doctesting()
+
+    #time.conf test data
+    tconf_test_data = """
+#xsh ; ttyp* ; root ; !WeMo1700-2030 | !WeFr0600-0830 # Added by timekpr
+xsh & login ; ttyp* ; ro0_ters;!WdMo0000-2400 # Added by timekpr
+    xsh & login ; ttyp* ; root | moot;!WdMo0200-1500
+xsh & login;ttyp*;kentauros;WdMo0000-2400 | Tu0800-2400 # Added by timekpr
+xsh & login ; ttyp* ; papoutsosiko;!WdMo0700-1500 & !MoWeFr1500-2000 # Added by timekpr
+xsh & login ; ttyp* ; pastourmas;!WdSu0700-1500 & !MoWeFr1500-2000 # Added by timekpr
+a;o; a; e
+      
+
+    """
+
+    # access.conf test data
+    aconf_test_data = """
+# testing # Added by timekpr
+- : lala : ALL # Added by timekpr
+    -:papa4a:ALL # Added by timekpr
++ : lala : .foo.bar.org # Added by timekpr
+- : nana123_a : ALL # Added by timekpr
+- : testing : ALL # test
+- : testing : ALL EXCEPT root
++ : john : 2001:4ca0:0:101::1# Added by timekpr
++ : root : .foo.bar.org  # Added by timekpr
+- : john : 2001:4ca0:0:101::/64 # Added by timekpr
+     """
+
+    class_pamparser_test(tconf_test_data, aconf_test_data)
+    #class_timeconf_test(tconf_test_data)
+    #class_accessconf_test(aconf_test_data)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+""" Weekly time.conf schedules compiled into bitmaps.
+
+    A schedule is an integer with one bit per minute of the week. Bit
+    (day * 1440 + minute) is set when the user may be logged in at that
+    minute; day 0 is Sunday, as in strftime("%w").
+
+    Checking one user is a single bit test. To find every user allowed at
+    a given minute, a Schedule also keeps the week cut into segments where
+    no user's permission changes, with one bitset of users per segment.
+
+    Functions:
+    compilelimits()  => Schedule from parseutlist() output (legacy lines)
+    compilebyday()   => Schedule from pamparser.time_conf_by_day_dict
+    load()           => Schedule of a time.conf file, cached by file mtime
+"""
+
+import bisect
+from time import localtime
+
+import pam
+from timekpr_service import lazy, tracing
+
+DAY = 24 * 60
+WEEK = 7 * DAY
+FULLDAY = (1 << DAY) - 1
+ALWAYS = (1 << WEEK) - 1
+DAYS = ("Su", "Mo", "Tu", "We", "Th", "Fr", "Sa")
+
+class Schedule(object):
+    """ The compiled schedules of a set of users.
+        Users without a schedule are always allowed.
+        Arguments:
+            masks => {username: bitmap}
+    """
+    def __init__(self, masks):
+        self.masks = masks
+        self.users = sorted(masks)
+        self._segments, self._allowed = self._transpose()
+
+    def isallowed(self, u, t=None):
+        """ Is u allowed to be logged in at time t (default: now)? """
+        return bool(self.masks.get(u, ALWAYS) >> minuteofweek(t) & 1)
+
+    def islimitedtoday(self, u, t=None):
+        """ Does u have any limitation on the day of t (default: now)? """
+        day = minuteofweek(t) // DAY
+        return (self.masks.get(u, ALWAYS) >> (day * DAY)) & FULLDAY != FULLDAY
+
+    def allowedusers(self, t=None):
+        """ Returns the users of this schedule allowed at time t (default: now) """
+        i = bisect.bisect_right(self._segments, minuteofweek(t)) - 1
+        return [self.users[j] for j in _setbits(self._allowed[i])]
+
+    def nextchange(self, u, t=None):
+        """ Returns the number of minutes from the start of the minute of t
+            (default: now) until the permission of u changes, or None if it
+            never does.
+        """
+        mask = self.masks.get(u, ALWAYS)
+        if mask in (0, ALWAYS):
+            return None
+        now = minuteofweek(t)
+        allowed = mask >> now & 1
+        # Look at the week starting at now, then find the first flip
+        rotated = (mask >> now) | (mask << (WEEK - now)) & ALWAYS
+        if allowed:
+            rotated = ~rotated & ALWAYS
+        return (rotated & -rotated).bit_length() - 1
+
+    def _transpose(self):
+        """ Cuts the week into segments where no permission changes.
+            Returns the segment starts and, per segment, a bitset with bit j
+            set when self.users[j] is allowed.
+        """
+        edges = dict()
+        first = 0
+        for j, u in enumerate(self.users):
+            mask = self.masks[u]
+            first |= (mask & 1) << j
+            # Bit m of changes is set where minute m differs from minute m - 1
+            changes = (mask ^ (mask << 1)) & ALWAYS & ~1
+            for m in _setbits(changes):
+                edges.setdefault(m, []).append(j)
+
+        segments = [0]
+        allowed = [first]
+        for m in sorted(edges):
+            bits = allowed[-1]
+            for j in edges[m]:
+                bits ^= 1 << j
+            segments.append(m)
+            allowed.append(bits)
+        return segments, allowed
+
+def minuteofweek(t=None):
+    """ Returns the bit index of time t (seconds since the epoch, default: now) """
+    lt = localtime(t)
+    day = (lt.tm_wday + 1) % 7 # tm_wday is 0 on Monday
+    return day * DAY + lt.tm_hour * 60 + lt.tm_min
+
+def span(day, start, end):
+    """ Returns the bits of minutes start to end (excluded) of day.
+        If end is before start, the span wraps around midnight of the same day.
+
+        >>> span(0, 0, DAY) == FULLDAY
+        True
+        >>> bin(span(0, 2, 4))
+        '0b1100'
+        >>> span(0, 1380, 60) == span(0, 0, 60) | span(0, 1380, DAY)
+        True
+    """
+    if end < start:
+        return span(day, start, DAY) | span(day, 0, end)
+    return ((1 << (end - start)) - 1) << (day * DAY + start)
+
+def hhmm(s):
+    """ Converts time.conf "HHMM" into minutes: hhmm("0730") => 450 """
+    return int(s[:2]) * 60 + int(s[2:])
+
+def limitsmask(bfrom, bto):
+    """ Compiles the from/to hour lists of parseutlist() (Sunday first)
+
+        >>> m = limitsmask(['0'] * 7, ['24'] * 7)
+        >>> m == ALWAYS
+        True
+    """
+    mask = 0
+    for day in range(7):
+        mask |= span(day, int(bfrom[day]) * 60, int(bto[day]) * 60)
+    return mask
+
+def bydaymask(byday):
+    """ Compiles the 'by day' dictionary of one user of pamparser:
+        a day is allowed during its "allow" spans (all day if there are none)
+        except during its "block" spans.
+    """
+    mask = 0
+    for day, name in enumerate(DAYS):
+        allow = byday[name]["allow"]
+        block = byday[name]["block"]
+        if allow:
+            daymask = 0
+            for hfrom, hto in allow:
+                daymask |= span(day, hhmm(hfrom), hhmm(hto))
+        else:
+            daymask = span(day, 0, DAY)
+        for hfrom, hto in block:
+            daymask &= ~span(day, hhmm(hfrom), hhmm(hto))
+        mask |= daymask
+    return mask
+
+def compilelimits(utlist):
+    """ Returns the Schedule of a parseutlist() result
+
+        >>> s = compilelimits([
+        ...     ['niania', (['0'] * 7, ['24'] * 7)],
+        ...     ['wawa', (['7'] * 7, ['22'] * 7)],
+        ... ])
+        >>> monday_6am = DAY + 6 * 60
+        >>> bool(s.masks['wawa'] >> monday_6am & 1)
+        False
+        >>> bool(s.masks['wawa'] >> (monday_6am + 60) & 1)
+        True
+        >>> s.users
+        ['niania', 'wawa']
+    """
+    return Schedule(dict((u, limitsmask(bfrom, bto)) for u, (bfrom, bto) in utlist))
+
+def compilebyday(by_day_dict):
+    """ Returns the Schedule of pamparser.time_conf_by_day_dict
+
+        >>> byday = dict((d, {"allow": [], "block": []}) for d in DAYS)
+        >>> byday["Mo"]["block"].append(["0000", "2400"])
+        >>> s = compilebyday({"pastourmas": byday})
+        >>> s.masks["pastourmas"] == ALWAYS & ~span(1, 0, DAY)
+        True
+    """
+    return Schedule(dict((u, bydaymask(d)) for u, d in by_day_dict.items()))
+
+def load(f='/etc/security/time.conf'):
+    """ Returns the Schedule of the timekpr section of time.conf.
+        It is compiled again only when the file changes.
+    """
+    return _cache.get(f)
+
+def _compile(signature, f):
+    with tracing.span("pam.schedule.compile", file=f):
+        return compilelimits(pam.parseutlist(pam.parsetimeconf(f)))
+
+_cache = lazy.SignatureCache(lambda f: lazy.stat_signature([f]), _compile)
+
+def _setbits(x):
+    """ Yields the indexes of the bits set in x
+
+        >>> list(_setbits(0b10110))
+        [1, 2, 4]
+    """
+    while x:
+        low = x & -x
+        yield low.bit_length() - 1
+        x ^= low
@@ -0,0 +1,126 @@
+""" Tracing spans, written in the Trace Event Format of Chrome tracing.
+
+    Traces are off until configure(path) is called (TRACE_FILE). Each span
+    is then appended to the file as a complete ("X") event, with its
+    attributes as args. Open the file in chrome://tracing or
+    https://ui.perfetto.dev; a trace that was not closed with "]" is valid.
+
+    with span("queries.read", path=f) as attrs:
+        data = fh.read()
+        attrs["bytes"] = len(data)
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from types import GeneratorType
+
+_fd = None
+
+
+def configure(path=None):
+    """
+    Appends spans to path from now on, or stops tracing if path is None.
+    Processes (e.g. gunicorn workers) may share the file.
+    """
+    global _fd
+    if _fd is not None:
+        os.close(_fd)
+        _fd = None
+    if path is not None:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size == 0:
+            os.write(fd, "[\n")
+        _fd = fd
+
+
+def enabled():
+    return _fd is not None
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Records the block as a span, with attrs (which the block may update)
+    as its arguments. The category is the prefix of the name ("pam" for
+    "pam.lockuser").
+
+    >>> import tempfile
+    >>> f = tempfile.mktemp()
+    >>> configure(f)
+    >>> with span("queries.read", path="eric.time") as attrs:
+    ...     attrs["bytes"] = 2
+    >>> configure()
+    >>> event = json.loads(open(f).read().rstrip(",\\n") + "]")[0]
+    >>> event["name"], event["cat"], event["ph"], sorted(event["args"].items())
+    (u'queries.read', u'queries', u'X', [(u'bytes', 2), (u'path', u'eric.time')])
+    >>> os.remove(f)
+    """
+    if _fd is None:
+        yield attrs
+        return
+    start = time.time()
+    try:
+        yield attrs
+    finally:
+        _emit(name, start, time.time() - start, attrs)
+
+
+def traced(name, *argnames):
+    """
+    Records each call of the decorated function as a span, with the
+    arguments named in argnames as attributes. Generator functions are
+    traced until the generator is exhausted or closed.
+    """
+    def decorator(f):
+        @wraps(f)
+        def inner(*args, **kwargs):
+            if _fd is None:
+                return f(*args, **kwargs)
+            attrs = {}
+            if argnames:
+                # Imported when tracing: inspect is slow to import
+                import inspect
+                callargs = inspect.getcallargs(f, *args, **kwargs)
+                attrs = dict((a, callargs[a]) for a in argnames)
+            start = time.time()
+            result = None
+            try:
+                result = f(*args, **kwargs)
+            finally:
+                if not isinstance(result, GeneratorType):
+                    _emit(name, start, time.time() - start, attrs)
+            if isinstance(result, GeneratorType):
+                return _traced_generator(name, attrs, start, result)
+            return result
+        return inner
+    return decorator
+
+
+def _traced_generator(name, attrs, start, generator):
+    try:
+        for item in generator:
+            yield item
+    finally:
+        _emit(name, start, time.time() - start, attrs)
+
+
+def _emit(name, start, duration, attrs):
+    fd = _fd
+    if fd is None:
+        return
+    event = {
+        "name": name,
+        "cat": name.split(".", 1)[0],
+        "ph": "X",
+        "ts": int(start * 1000000),
+        "dur": int(duration * 1000000),
+        "pid": os.getpid(),
+        "tid": threading.current_thread().ident,
+        "args": attrs,
+    }
+    # One write per event: appends of concurrent writers don't interleave
+    os.write(fd, json.dumps(event, default=repr) + ",\n")
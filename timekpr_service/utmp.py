@@ -0,0 +1,90 @@
+""" Reader of utmp(5), the record of the open login sessions.
+
+    The records are unpacked with struct straight from a read-only mmap of
+    dirs.UTMP. The index of the sessions of every user is rebuilt only when
+    the file changes, so looking up who is logged in is a dict lookup.
+"""
+
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+from timekpr_service import dirs, lazy
+
+# struct utmp of glibc on Linux, the same on 32 and 64 bit machines:
+# ut_type, ut_pid, ut_line, ut_id, ut_user, ut_host, ut_exit,
+# ut_session, ut_tv (32 bit seconds and microseconds), ut_addr_v6
+RECORD = struct.Struct("=hxxi32s4s32s256shhiii16s20x")
+
+# ut_type of the record of a logged in user
+USER_PROCESS = 7
+
+# line: the terminal (e.g. "pts/1"), remote: the remote host or X display,
+# login: when the session started, in seconds since the epoch
+Session = namedtuple("Session", ["line", "remote", "login", "pid"])
+
+
+def sessions_index():
+    """
+    {username: (Session(), ...)} of the open sessions, read again only when
+    dirs.UTMP changed.
+
+    >>> import shutil, tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> try:
+    ...     dirs.configure(root); os.makedirs(os.path.dirname(dirs.UTMP))
+    ...     print(sessions_index())
+    ...     with open(dirs.UTMP, "wb") as fh:
+    ...         fh.write(_record(USER_PROCESS, "eric", "tty7", ":0", 1578312000, 100))
+    ...         fh.write(_record(8, "ana", "pts/1", "", 1578312000, 101))
+    ...     print(sessions_index())
+    ... finally:
+    ...     dirs.configure(); shutil.rmtree(root)
+    {}
+    {'eric': (Session(line='tty7', remote=':0', login=1578312000, pid=100),)}
+    """
+    return _index.get()
+
+
+def signature_of():
+    """
+    Changes whenever sessions_index() may answer differently.
+    """
+    return lazy.stat_signature([dirs.UTMP])
+
+
+def _read(f):
+    try:
+        with open(f, "rb") as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        # Missing, or empty: an empty file can't be mapped
+        return {}
+
+    sessions = {}
+    try:
+        for offset in xrange(0, len(data) - RECORD.size + 1, RECORD.size):
+            record = RECORD.unpack_from(data, offset)
+            if record[0] != USER_PROCESS:
+                continue
+            username = _string(record[4])
+            if username:
+                sessions.setdefault(username, []).append(Session(
+                    _string(record[2]), _string(record[5]), record[9], record[1]
+                ))
+    finally:
+        data.close()
+    return dict((username, tuple(s)) for username, s in sessions.items())
+
+
+_index = lazy.SignatureCache(signature_of, lambda signature: _read(dirs.UTMP))
+
+
+def _string(field):
+    return field.split("\0", 1)[0]
+
+
+def _record(type, username, line, remote, login, pid):
+    """ Packs a utmp record, for tests """
+    return RECORD.pack(type, pid, line, "", username, remote, 0, 0, 0, login, 0, "")